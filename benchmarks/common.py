@@ -0,0 +1,280 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import types
+from pathlib import Path
+
+import asyncpg
+import discord
+
+from cautious_memory import CautiousMemory
+from cautious_memory.utils import sql
+
+REPO_DIR = Path(__file__).parent.parent
+DEFAULT_DSN = 'postgresql:///cm_bench'
+
+# seeded IDs start at these so that they don't look like small integers to the planner
+GUILD_ID_BASE = 100_000_000_000_000_000
+ROLE_ID_BASE = 200_000_000_000_000_000
+MEMBER_ID_BASE = 300_000_000_000_000_000
+CHANNEL_ID_BASE = 400_000_000_000_000_000
+MESSAGE_ID_BASE = 500_000_000_000_000_000
+
+## Fake discord.py objects
+# only the attributes that the cogs use are implemented
+
+class StubHTTP:
+	"""Stands in for Discord's API. Each request takes latency seconds, and is counted by route."""
+
+	def __init__(self, latency=0):
+		self.latency = latency
+		self.requests = collections.Counter()
+
+	async def request(self, route):
+		self.requests[route] += 1
+		sql.check_held_connections(f'discord {route}')
+		await asyncio.sleep(self.latency)
+
+	# the parts of discord.http.HTTPClient that the cogs call directly
+
+	async def close(self):
+		pass
+
+	async def edit_message(self, channel_id, message_id, **fields):
+		await self.request('PATCH /channels/{channel_id}/messages/{message_id}')
+
+	async def delete_message(self, channel_id, message_id, *, reason=None):
+		await self.request('DELETE /channels/{channel_id}/messages/{message_id}')
+
+class StubMessage:
+	# these IDs are below the ones the seeder uses for bound messages
+	_ids = itertools.count(MESSAGE_ID_BASE // 2)
+
+	def __init__(self, channel, *, content=None, author=None, id=None):
+		self.id = next(self._ids) if id is None else id
+		self.channel = channel
+		self.guild = channel.guild
+		self.content = content
+		self.author = author
+
+	async def edit(self, **fields):
+		await self.guild.http.request('PATCH /channels/{channel_id}/messages/{message_id}')
+
+	async def delete(self):
+		await self.guild.http.request('DELETE /channels/{channel_id}/messages/{message_id}')
+
+	async def add_reaction(self, emoji):
+		await self.guild.http.request('PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me')
+
+	async def remove_reaction(self, emoji, member):
+		await self.guild.http.request('DELETE /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/{member_id}')
+
+	async def clear_reactions(self):
+		await self.guild.http.request('DELETE /channels/{channel_id}/messages/{message_id}/reactions')
+
+class StubChannel:
+	def __init__(self, id, guild):
+		self.id = id
+		self.guild = guild
+		self.mention = f'<#{id}>'
+
+	def __eq__(self, other):
+		return isinstance(other, StubChannel) and self.id == other.id
+
+	def __hash__(self):
+		return hash(self.id)
+
+	def permissions_for(self, member):
+		return discord.Permissions.all()
+
+	async def send(self, content=None, **kwargs):
+		await self.guild.http.request('POST /channels/{channel_id}/messages')
+		return StubMessage(self, content=content, author=self.guild.me)
+
+class FakeRole:
+	def __init__(self, id, guild, position=0):
+		self.id = id
+		self.guild = guild
+		self.position = position
+		self.name = f'role {id}'
+
+	def __eq__(self, other):
+		return isinstance(other, FakeRole) and self.id == other.id
+
+	def __hash__(self):
+		return hash(self.id)
+
+	def __lt__(self, other):
+		return (self.position, self.id) < (other.position, other.id)
+
+	def is_default(self):
+		return self.id == self.guild.id
+
+class FakeGuild:
+	def __init__(self, id, role_ids=(), *, http=None):
+		self.id = id
+		self.name = f'guild {id}'
+		self.http = http or StubHTTP()
+		self.default_role = FakeRole(id, self)
+		self.roles = [self.default_role] + [FakeRole(role_id, self, i) for i, role_id in enumerate(role_ids, 1)]
+		self._roles = {role.id: role for role in self.roles}
+		self._members = {}
+		self.me = FakeMember(0, self)
+
+	def __str__(self):
+		return self.name
+
+	def get_role(self, id):
+		return self._roles.get(id)
+
+	def get_member(self, id):
+		return self._members.get(id)
+
+	def _add_member(self, member):
+		self._members[member.id] = member
+
+	async def fetch_member(self, id):
+		await self.http.request('GET /guilds/{guild_id}/members/{user_id}')
+		try:
+			return self._members[id]
+		except KeyError:
+			# members that the benchmarks didn't make themselves have no roles
+			return FakeMember(id, self)
+
+class FakeMember:
+	def __init__(self, id, guild, roles=(), *, admin=False):
+		self.id = id
+		self.guild = guild
+		self.roles = [guild.default_role, *roles]
+		self.guild_permissions = types.SimpleNamespace(administrator=admin)
+		self.bot = False
+		self.name = self.display_name = f'member {id}'
+		self.mention = f'<@{id}>'
+		guild._add_member(self)
+
+	def __eq__(self, other):
+		return isinstance(other, FakeMember) and self.id == other.id
+
+	def __hash__(self):
+		return hash(self.id)
+
+	def __str__(self):
+		return self.name
+
+	def avatar_url_as(self, **kwargs):
+		return ''
+
+	async def send(self, content=None, **kwargs):
+		await self.guild.http.request('POST /users/@me/channels')
+		await self.guild.http.request('POST /channels/{channel_id}/messages')
+
+def fake_guild(params, guild_number, *, http=None):
+	"""return a FakeGuild matching the guild_number'th guild (from 0) created by the seeder with params"""
+	guild_id = GUILD_ID_BASE + guild_number
+	role_ids = [ROLE_ID_BASE + guild_number * params['roles'] + i for i in range(params['roles'])]
+	return FakeGuild(guild_id, role_ids, http=http)
+
+def fake_member(params, guild, member_number, *, admin=False):
+	"""return a FakeMember for a member ID used by the seeder. Members get every third role."""
+	guild_number = guild.id - GUILD_ID_BASE
+	member_id = MEMBER_ID_BASE + guild_number * params['members'] + member_number
+	roles = guild.roles[1 + member_number % 3::3]
+	return FakeMember(member_id, guild, roles, admin=admin)
+
+## Bot
+
+def bot_config(dsn):
+	return {
+		'prefixes': ['cm/'],
+		'database': {'dsn': dsn},
+		'failure_emoji': '❌',
+		'success_emoji': '✅',
+		# measure the queries, not the rate limiter
+		'ratelimits': {kind: {'user': None, 'guild': None, 'app': None} for kind in ('read', 'write')},
+	}
+
+async def make_bot(dsn):
+	"""return a bot that is connected to the database but not to Discord, with the wiki cogs loaded"""
+	bot = CautiousMemory(config=bot_config(dsn))
+	# otherwise is_owner would make an HTTP request for the application info
+	bot.owner_ids = {0}
+	await bot.init_db()
+	for extension in 'permissions', 'wiki', 'watch_lists', 'binding':
+		for kind in 'db', 'commands':
+			bot.load_extension(f'cautious_memory.cogs.{extension}.{kind}')
+	return bot
+
+async def seed_params(dsn):
+	"""return the parameters that the database was seeded with"""
+	conn = await asyncpg.connect(dsn)
+	try:
+		params = await conn.fetchval('SELECT params FROM benchmark_seed')
+	except asyncpg.UndefinedTableError:
+		raise SystemExit('This database has not been seeded. Run python -m benchmarks.seed first.')
+	finally:
+		await conn.close()
+	return json.loads(params)
+
+## Results
+
+def git_commit():
+	try:
+		return subprocess.run(
+			['git', 'rev-parse', 'HEAD'],
+			cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+async def environment(dsn):
+	conn = await asyncpg.connect(dsn)
+	try:
+		server_version = await conn.fetchval('SHOW server_version')
+	finally:
+		await conn.close()
+
+	return {
+		'commit': git_commit(),
+		'python': platform.python_version(),
+		'asyncpg': asyncpg.__version__,
+		'postgres': server_version,
+		'machine': platform.machine(),
+	}
+
+def summarize(timings):
+	"""return summary statistics, in milliseconds, of a list of timings in seconds"""
+	if not timings:
+		return {}
+	timings = sorted(timings)
+	ms = lambda x: round(x * 1000, 3)
+	return {
+		'min_ms': ms(timings[0]),
+		'median_ms': ms(statistics.median(timings)),
+		'mean_ms': ms(statistics.mean(timings)),
+		'p95_ms': ms(quantile(timings, 0.95)),
+		'p99_ms': ms(quantile(timings, 0.99)),
+		'max_ms': ms(timings[-1]),
+		'stdev_ms': ms(statistics.stdev(timings)) if len(timings) > 1 else 0,
+	}
+
+def quantile(sorted_values, q):
+	"""nearest-rank quantile of an already sorted list"""
+	return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
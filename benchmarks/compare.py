@@ -0,0 +1,68 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare two result files written by benchmarks.run, for example from before and after a commit."""
+
+import argparse
+import json
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.compare', description=__doc__)
+	parser.add_argument('old')
+	parser.add_argument('new')
+	parser.add_argument('--stat', default='median_ms', help='which statistic to compare (default: %(default)s)')
+	parser.add_argument(
+		'--threshold', type=float, default=0.1,
+		help='mark changes bigger than this fraction (default: %(default)s)')
+	return parser.parse_args(argv)
+
+def load(path):
+	with open(path) as f:
+		return json.load(f)
+
+def main():
+	args = parse_args()
+	old, new = load(args.old), load(args.new)
+
+	if old['seed'] != new['seed']:
+		print('warning: the databases were seeded with different parameters')
+	for key in 'commit', 'postgres':
+		print(f'{key}: {old["environment"][key]} → {new["environment"][key]}')
+	print()
+
+	names = [name for name in new['results'] if name in old['results']]
+	width = max(map(len, names), default=0)
+	for name in names:
+		old_value = old['results'][name].get(args.stat)
+		new_value = new['results'][name].get(args.stat)
+		if old_value is None or new_value is None:
+			print(f'{name:<{width}}  no timings (errors: {old["results"][name]["errors"]} → {new["results"][name]["errors"]})')
+			continue
+
+		change = (new_value - old_value) / old_value if old_value else 0
+		mark = ''
+		if change > args.threshold:
+			mark = '  slower'
+		elif change < -args.threshold:
+			mark = '  faster'
+		print(f'{name:<{width}}  {old_value:>9.2f}ms → {new_value:>9.2f}ms  {change:>+7.1%}{mark}')
+
+	for name in new['results'].keys() - old['results'].keys():
+		print(f'{name:<{width}}  new')
+	for name in old['results'].keys() - new['results'].keys():
+		print(f'{name:<{width}}  removed')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,317 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Run a mix of commands concurrently against a database filled by benchmarks.seed, to find where the pool saturates.
+
+The real command callbacks of the Wiki, Watch Lists and Message Binding cogs are invoked with stub contexts,
+and Discord's API is replaced by a stub that takes a fixed time per request.
+Unlike benchmarks.run, writes are committed, so reseed the database before comparing results with it.
+"""
+
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import sys
+import time
+
+import asyncpg
+from discord.ext import commands
+
+from cautious_memory.utils import sql
+from .common import (
+	CHANNEL_ID_BASE, DEFAULT_DSN, MESSAGE_ID_BASE, StubChannel, StubHTTP, StubMessage,
+	environment, fake_guild, fake_member, make_bot, seed_params, summarize)
+
+class StubContext:
+	def __init__(self, bot, command, author, channel):
+		self.bot = bot
+		self.command = command
+		self.cog = command.cog
+		self.author = author
+		self.channel = channel
+		self.guild = channel.guild
+		self.message = StubMessage(channel, author=author)
+		self.prefix = 'cm/'
+		self.invoked_with = command.name
+
+	async def send(self, content=None, **kwargs):
+		return await self.channel.send(content, **kwargs)
+
+	async def invoke(self, command, *args, **kwargs):
+		return await command.callback(command.cog, self, *args, **kwargs)
+
+class MeasuredPool(sql.Pool):
+	"""Records how long each acquire waited and how long each connection was held."""
+
+	def __init__(self, pool):
+		super().__init__(pool)
+		self.acquire_waits = []
+		self.hold_times = []
+		self.acquired_at = {}
+
+	async def _acquire(self, timeout, call_site):
+		start = time.perf_counter()
+		conn = await super()._acquire(timeout, call_site)
+		now = time.perf_counter()
+		self.acquire_waits.append(now - start)
+		self.acquired_at[conn] = now
+		return conn
+
+	async def release(self, connection, *, timeout=None):
+		try:
+			self.hold_times.append(time.perf_counter() - self.acquired_at.pop(connection))
+		except KeyError:
+			pass
+		await super().release(connection, timeout=timeout)
+
+	def reset(self):
+		self.acquire_waits.clear()
+		self.hold_times.clear()
+
+class Workload:
+	"""Chooses commands and their arguments. Everything happens in the first seeded guild."""
+
+	# relative weights. most traffic is people reading pages.
+	DEFAULT_MIX = {
+		'page': 40, 'raw': 4, 'info': 4, 'history': 8, 'stats': 2, 'list': 1, 'recent-revisions': 1, 'search': 3,
+		'create': 3, 'edit': 8, 'alias': 1, 'revert': 1, 'compare': 2,
+		'watch': 3, 'unwatch': 2, 'watch-list': 2,
+		'bind': 1, 'bindings': 1, 'unbind': 1,
+	}
+	# these need permissions that members don't have by default
+	ADMIN_COMMANDS = {'bind', 'unbind'}
+	# how many distinct members run commands
+	ACTIVE_MEMBERS = 200
+
+	def __init__(self, bot, params, http, *, mix, seed):
+		self.bot = bot
+		self.params = params
+		self.rng = random.Random(seed)
+		self.guild = fake_guild(params, 0, http=http)
+		self.members = [fake_member(params, self.guild, i) for i in range(self.ACTIVE_MEMBERS)]
+		self.admins = [fake_member(params, self.guild, i, admin=True) for i in range(self.ACTIVE_MEMBERS, self.ACTIVE_MEMBERS + 5)]
+		self.channels = [StubChannel(CHANNEL_ID_BASE + i, self.guild) for i in range(params['channels'])]
+		self.commands = {name: bot.get_command(name) for name in mix}
+		self.names = list(mix)
+		self.weights = list(mix.values())
+		self.counter = itertools.count()
+
+	async def setup(self):
+		# pairs of revisions of the same page, for compare and revert
+		self.revision_pairs = await self.bot.pool.fetch("""
+			SELECT title, min(revision_id) AS old, max(revision_id) AS new
+			FROM revisions
+			WHERE page_id <= 1000
+			GROUP BY page_id, title
+			HAVING count(*) > 1
+		""")
+
+	def page_title(self):
+		# same skew as the seeder uses for edits
+		return f'Page {1 + int(self.params["pages"] * self.rng.random() ** 2)}'
+
+	def args(self, name):
+		n = next(self.counter)
+		if name in {'page', 'raw', 'info', 'history', 'watch', 'unwatch'}:
+			return [self.page_title()]
+		if name == 'stats':
+			return [self.rng.choice([None, self.page_title()])]
+		if name == 'search':
+			return [f'page {self.rng.randrange(1000)}']
+		if name == 'create':
+			return [f'Load page {n}', f'Content of load page {n}.']
+		if name == 'edit':
+			return [self.page_title(), f'Edited by the load generator ({n}).']
+		if name == 'alias':
+			return [f'Load alias {n}', self.page_title()]
+		if name == 'revert':
+			pair = self.rng.choice(self.revision_pairs)
+			return [pair['title'], pair['old']]
+		if name == 'compare':
+			pair = self.rng.choice(self.revision_pairs)
+			return [pair['old'], pair['new']]
+		if name == 'bind':
+			return [StubMessage(self.rng.choice(self.channels), author=self.guild.me), self.page_title()]
+		if name == 'bindings':
+			return [self.rng.choice([None, self.page_title()])]
+		if name == 'unbind':
+			message_id = MESSAGE_ID_BASE + 1 + self.rng.randrange(self.params['bindings'])
+			return [StubMessage(self.rng.choice(self.channels), author=self.guild.me, id=message_id)]
+		return []
+
+	def next(self):
+		"""return (command name, context, keyword arguments) for the next command to run"""
+		name = self.rng.choices(self.names, self.weights)[0]
+		command = self.commands[name]
+		author = self.rng.choice(self.admins if name in self.ADMIN_COMMANDS else self.members)
+		ctx = StubContext(self.bot, command, author, self.rng.choice(self.channels))
+		# most of the commands take keyword only arguments
+		return name, ctx, dict(zip(command.clean_params, self.args(name)))
+
+class Recorder:
+	def __init__(self):
+		self.latencies = collections.defaultdict(list)
+		# user errors are the CommandErrors that would be shown to the user, like PageNotFoundError
+		self.user_errors = collections.Counter()
+		self.internal_errors = collections.Counter()
+
+	async def on_error(self, event, *args, **kwargs):
+		# replaces Bot.on_error, so that exceptions raised by listeners such as on_cm_page_edit are counted too
+		self.internal_errors[f'{type(sys.exc_info()[1]).__name__} ({event})'] += 1
+
+	def summary(self, elapsed, pool, http):
+		all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+		return {
+			'completed': len(all_latencies),
+			'throughput_per_second': round(len(all_latencies) / elapsed, 2),
+			'latency': summarize(all_latencies),
+			'acquire_wait': summarize(pool.acquire_waits),
+			'hold_time': summarize(pool.hold_times),
+			'user_errors': dict(self.user_errors),
+			'internal_errors': dict(self.internal_errors),
+			'discord_requests': sum(http.requests.values()),
+			# call sites that held a connection while waiting on Discord, and how often they did
+			'held_during_discord_requests': {
+				call_site: stats.http_requests for call_site, stats in sql.pool_stats if stats.http_requests},
+			'commands': {name: summarize(latencies) for name, latencies in sorted(self.latencies.items())},
+		}
+
+async def worker(workload, recorder, deadline, timeout):
+	while time.perf_counter() < deadline:
+		name, ctx, kwargs = workload.next()
+		start = time.perf_counter()
+		try:
+			# a command that never finishes (e.g. waiting on a pool that it has exhausted itself) would stall the step
+			await asyncio.wait_for(ctx.invoke(ctx.command, **kwargs), timeout)
+		except asyncio.TimeoutError:
+			recorder.internal_errors[f'timeout ({name})'] += 1
+		except commands.CommandError as exc:
+			recorder.user_errors[type(exc).__name__] += 1
+		except Exception as exc:
+			recorder.internal_errors[type(exc).__name__] += 1
+		else:
+			recorder.latencies[name].append(time.perf_counter() - start)
+
+def stub_discord(bot, workload, http):
+	"""point the parts of the bot that would talk to Discord at the stubs"""
+	bot.http = http
+	bot.get_guild = {workload.guild.id: workload.guild}.get
+
+	async def wait_for(event, *, check=None, timeout=None):
+		if event == 'message':
+			# the only command that waits for a message is unbind, which asks whether to delete the bound message
+			return StubMessage(workload.channels[0], content='n')
+		# nobody reacts to paginators
+		raise asyncio.TimeoutError
+
+	bot.wait_for = wait_for
+
+def parse_mix(arg):
+	mix = {}
+	for item in arg.split(','):
+		name, _, weight = item.partition('=')
+		if name not in Workload.DEFAULT_MIX:
+			raise argparse.ArgumentTypeError(f'unknown command {name!r}')
+		mix[name] = float(weight or 1)
+	return mix
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.load', description=__doc__)
+	parser.add_argument('--dsn', default=DEFAULT_DSN, help='a database filled by benchmarks.seed (default: %(default)s)')
+	parser.add_argument('--pool-size', type=int, default=10, help='maximum pool size (default: %(default)s)')
+	parser.add_argument(
+		'--concurrency', type=lambda arg: list(map(int, arg.split(','))), default=[1, 2, 4, 8, 16, 32],
+		help='comma separated numbers of concurrent commands to step through (default: 1,2,4,8,16,32)')
+	parser.add_argument('--duration', type=float, default=30, help='seconds to run each step for (default: %(default)s)')
+	parser.add_argument(
+		'--mix', type=parse_mix, default=Workload.DEFAULT_MIX,
+		help='comma separated command=weight pairs, e.g. page=10,edit=1 (default: a read-heavy mix of every command)')
+	parser.add_argument(
+		'--discord-latency', type=float, default=0.05,
+		help='seconds each stub Discord API request takes (default: %(default)s)')
+	parser.add_argument(
+		'--timeout', type=float, default=30,
+		help='seconds after which a command is abandoned and counted as an error (default: %(default)s)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', '-o', help='write the results as JSON to this file')
+	return parser.parse_args(argv)
+
+async def load(args):
+	params = await seed_params(args.dsn)
+	bot = await make_bot(args.dsn)
+	await bot.pool.close()
+	pool = bot.pool = MeasuredPool(await asyncpg.create_pool(
+		args.dsn, min_size=args.pool_size, max_size=args.pool_size, connection_class=sql.Connection))
+	http = StubHTTP(args.discord_latency)
+	workload = Workload(bot, params, http, mix=args.mix, seed=args.seed)
+	stub_discord(bot, workload, http)
+
+	steps = []
+	try:
+		await workload.setup()
+		print(
+			f'{"concurrency":>11} {"req/s":>8} {"p50":>9} {"p95":>9} {"p99":>9}'
+			f' {"wait p99":>9} {"hold p99":>9} {"errors":>6}')
+		for concurrency in args.concurrency:
+			pool.reset()
+			sql.pool_stats.clear()
+			http.requests.clear()
+			recorder = Recorder()
+			bot.on_error = recorder.on_error
+			start = time.perf_counter()
+			deadline = start + args.duration
+			await asyncio.gather(*(worker(workload, recorder, deadline, args.timeout) for _ in range(concurrency)))
+			summary = recorder.summary(time.perf_counter() - start, pool, http)
+			steps.append({'concurrency': concurrency, **summary})
+
+			latency, wait, hold = summary['latency'], summary['acquire_wait'], summary['hold_time']
+			ms = lambda stats, key: f'{stats.get(key, 0):>7.1f}ms'
+			print(
+				f'{concurrency:>11} {summary["throughput_per_second"]:>8.1f}'
+				f' {ms(latency, "median_ms")} {ms(latency, "p95_ms")} {ms(latency, "p99_ms")}'
+				f' {ms(wait, "p99_ms")} {ms(hold, "p99_ms")} {sum(summary["internal_errors"].values()):>6}')
+			if summary['internal_errors']:
+				print(f'{"":>11} internal errors: {summary["internal_errors"]}')
+			if summary['held_during_discord_requests']:
+				print(f'{"":>11} connections held during Discord requests: {summary["held_during_discord_requests"]}')
+	finally:
+		try:
+			# event listeners started by the last step may still be running, or be stuck waiting for a connection
+			await asyncio.wait_for(pool.close(), args.timeout)
+		except asyncio.TimeoutError:
+			print(f'the pool did not close within {args.timeout}s, so some event listeners are stuck', file=sys.stderr)
+			pool.terminate()
+		await bot.close()
+
+	if args.output:
+		output = {
+			'environment': await environment(args.dsn),
+			'seed': params,
+			'settings': {
+				key: value for key, value in vars(args).items() if key not in {'dsn', 'output'}},
+			'steps': steps,
+		}
+		with open(args.output, 'w') as f:
+			json.dump(output, f, indent=2)
+		print(f'wrote {args.output}')
+
+def main():
+	asyncio.run(load(parse_args()))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Measure how much memory the rows of large listings take, against a database filled by benchmarks.seed.
+
+Each listing is fetched once per row format: asyncpg's Records as they are, those Records copied into AttrDicts
+(what the database cogs used to hand out), and the slotted record types of utils.records (what they hand out now).
+The memory still allocated once the rows are built, and the raw Records dropped, is divided by the number of rows.
+"""
+
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import tracemalloc
+
+from cautious_memory.utils import AttrDict
+
+from .common import DEFAULT_DSN, environment, fake_guild, make_bot, seed_params
+
+FORMATS = {
+	'asyncpg.Record': lambda query, rows: rows,
+	'AttrDict': lambda query, rows: list(map(AttrDict, rows)),
+	'record type': lambda query, rows: query.records(rows),
+}
+
+async def listings(bot, params):
+	"""return {name: (query, args)} for each listing to measure, all in the first seeded guild"""
+	wiki_db = bot.cogs['WikiDatabase']
+	binding_db = bot.cogs['MessageBindingDatabase']
+	guild = fake_guild(params, 0)
+	newest = await bot.pool.fetchval(
+		'SELECT max(revised) FROM revisions INNER JOIN pages USING (page_id) WHERE guild_id = $1', guild.id)
+	return {
+		# page IDs are skewed towards the first page, so it has the most revisions
+		'get_page_history[hot]': (wiki_db.queries.get_page_history(), (guild.id, 'Page 1', None, 0, None)),
+		'get_all_pages': (wiki_db.queries.get_all_pages(), (guild.id,)),
+		'get_recent_revisions[week]': (
+			wiki_db.queries.get_recent_revisions(), (guild.id, newest - datetime.timedelta(weeks=1))),
+		'guild_bindings': (binding_db.queries.guild_bindings(), (guild.id,)),
+	}
+
+async def measure(bot, query, args, convert):
+	"""return (rows, bytes still allocated for them)"""
+	gc.collect()
+	before, _ = tracemalloc.get_traced_memory()
+	rows = convert(query, await bot.pool.fetch(query, *args))
+	gc.collect()
+	after, _ = tracemalloc.get_traced_memory()
+	count = len(rows)
+	del rows
+	return count, after - before
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.memory', description=__doc__)
+	parser.add_argument('--dsn', default=DEFAULT_DSN, help='a database filled by benchmarks.seed (default: %(default)s)')
+	parser.add_argument('--output', '-o', help='also write the results to this JSON file')
+	return parser.parse_args(argv)
+
+async def run(args):
+	params = await seed_params(args.dsn)
+	bot = await make_bot(args.dsn)
+	results = {}
+	try:
+		for name, (query, query_args) in (await listings(bot, params)).items():
+			# the first fetch prepares the statement, and the first conversion makes the record type
+			FORMATS['record type'](query, await bot.pool.fetch(query, *query_args))
+
+			results[name] = result = {}
+			tracemalloc.start()
+			try:
+				for row_format, convert in FORMATS.items():
+					rows, size = await measure(bot, query, query_args, convert)
+					result[row_format] = {'rows': rows, 'bytes': size, 'bytes_per_row': round(size / rows, 1) if rows else None}
+			finally:
+				tracemalloc.stop()
+
+			print(f'{name} ({rows} rows)')
+			for row_format, format_result in result.items():
+				per_row = format_result['bytes_per_row']
+				print(f'\t{row_format:<16} {"-" if per_row is None else f"{per_row:>9.1f}"} bytes/row')
+	finally:
+		await bot.close()
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({'environment': await environment(args.dsn), 'seed': params, 'results': results}, f, indent=2)
+		print(f'wrote {args.output}')
+
+def main():
+	asyncio.run(run(parse_args()))
+
+if __name__ == '__main__':
+	main()
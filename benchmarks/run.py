@@ -0,0 +1,397 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Time each public method of the database cogs against a database filled by benchmarks.seed.
+
+Methods that write run inside a transaction that is rolled back afterwards, so the database is left as it was.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import re
+import sys
+import time
+
+from bot_bin.sql import connection
+
+from .common import (
+	DEFAULT_DSN, MEMBER_ID_BASE, MESSAGE_ID_BASE,
+	environment, fake_guild, fake_member, make_bot, seed_params, summarize)
+
+# maps name to (coroutine function, whether it writes)
+CASES = {}
+
+def case(name, *, write=False):
+	def decorator(func):
+		CASES[name] = func, write
+		return func
+	return decorator
+
+async def drain(aiter):
+	"""exhaust an async iterator, like the paginators do"""
+	async for _ in aiter:
+		pass
+
+class FakeMessage:
+	def __init__(self, id, channel_id):
+		self.id = id
+		self.channel = type('FakeChannel', (), {'id': channel_id})()
+
+class Fixture:
+	"""Everything the benchmark cases need, all in the first seeded guild."""
+
+	CONTENT = 'Benchmark content. ' * 20
+
+	def __init__(self, bot, params):
+		self.bot = bot
+		self.params = params
+		self.wiki_db = bot.cogs['WikiDatabase']
+		self.permissions_db = bot.cogs['PermissionsDatabase']
+		self.watch_lists_db = bot.cogs['WatchListsDatabase']
+		self.binding_db = bot.cogs['MessageBindingDatabase']
+		# load_extension executes each module again, so the Permissions imported by this module would be a different class
+		self.Permissions = sys.modules[type(self.permissions_db).__module__].Permissions
+
+		self.guild = fake_guild(params, 0)
+		self.member = fake_member(params, self.guild, 1)
+		self.admin = fake_member(params, self.guild, 2, admin=True)
+		self.role = self.guild.roles[1]
+
+		# page IDs are skewed towards the first page, so it has the most revisions, uses, and subscribers
+		self.hot_title = 'Page 1'
+		self.typical_title = f'Page {params["pages"] // 2}'
+		self.alias_title = 'Alias 1'
+		self.revision_ids = [1, params['revisions'] // 2, params['revisions']]
+
+	async def setup(self):
+		"""find some existing rows to update or delete"""
+		pool = self.bot.pool
+		self.overwrite_title, self.overwrite_entity = await pool.fetchrow("""
+			SELECT title, entity
+			FROM page_permissions INNER JOIN pages USING (page_id)
+			WHERE guild_id = $1
+			ORDER BY page_id, entity
+			LIMIT 1
+		""", self.guild.id)
+		self.subscribed_page_id, self.subscribed_title, subscriber_id = await pool.fetchrow("""
+			SELECT page_id, title, user_id
+			FROM page_subscribers INNER JOIN pages USING (page_id)
+			WHERE guild_id = $1
+			ORDER BY page_id, user_id
+			LIMIT 1
+		""", self.guild.id)
+		self.subscriber = fake_member(self.params, self.guild, subscriber_id - MEMBER_ID_BASE)
+		message_id, channel_id, self.bound_page_id = await pool.fetchrow(
+			'SELECT message_id, channel_id, page_id FROM bound_messages WHERE message_id = $1',
+			MESSAGE_ID_BASE + 1)
+		self.bound_message = FakeMessage(message_id, channel_id)
+		self.new_message = FakeMessage(MESSAGE_ID_BASE, channel_id)
+		# where the history command would continue from halfway through the hot page's history
+		self.hot_history_key = await pool.fetchval("""
+			SELECT revision_id
+			FROM revisions INNER JOIN pages USING (page_id)
+			WHERE guild_id = $1 AND title = $2
+			ORDER BY revision_id
+			OFFSET (SELECT count(*) / 2 FROM revisions INNER JOIN pages USING (page_id) WHERE guild_id = $1 AND title = $2)
+			LIMIT 1
+		""", self.guild.id, self.hot_title)
+
+	@property
+	def cutoff(self):
+		return datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
+
+## WikiDatabase
+
+@case('WikiDatabase.get_page')
+async def _(f): await f.wiki_db.get_page(f.member, f.typical_title)
+
+@case('WikiDatabase.get_page[partial]')
+async def _(f): await f.wiki_db.get_page(f.member, f.typical_title, partial=True)
+
+@case('WikiDatabase.get_page[alias]')
+async def _(f): await f.wiki_db.get_page(f.member, f.alias_title)
+
+@case('WikiDatabase.get_pages[100]')
+async def _(f): await f.wiki_db.get_pages(f.member, [f'Page {i}' for i in range(1, 101)])
+
+@case('WikiDatabase.get_page_history[hot]')
+async def _(f): await drain(f.wiki_db.get_page_history(f.member, f.hot_title, limit=7))
+
+@case('WikiDatabase.get_page_history[hot, later page]')
+async def _(f): await drain(f.wiki_db.get_page_history(f.member, f.hot_title, before=f.hot_history_key, limit=7))
+
+@case('WikiDatabase.get_page_history[typical]')
+async def _(f): await drain(f.wiki_db.get_page_history(f.member, f.typical_title, limit=7))
+
+@case('WikiDatabase.get_all_pages')
+async def _(f): await drain(f.wiki_db.get_all_pages(f.member))
+
+@case('WikiDatabase.get_recent_revisions')
+async def _(f): await drain(f.wiki_db.get_recent_revisions(f.member, datetime.datetime.utcnow() - datetime.timedelta(days=1)))
+
+@case('WikiDatabase.resolve_page')
+async def _(f): await f.wiki_db.resolve_page(f.member, f.typical_title)
+
+@case('WikiDatabase.resolve_page[alias]')
+async def _(f): await f.wiki_db.resolve_page(f.member, f.alias_title)
+
+@case('WikiDatabase.search_pages')
+async def _(f): await drain(f.wiki_db.search_pages(f.member, 'page 123'))
+
+@case('WikiDatabase.get_individual_revisions')
+async def _(f): await f.wiki_db.get_individual_revisions(f.guild.id, f.revision_ids)
+
+@case('WikiDatabase.get_revision')
+async def _(f): await f.wiki_db.get_revision(f.guild.id, f.revision_ids[1])
+
+@case('WikiDatabase.page_count')
+async def _(f): await f.wiki_db.page_count(f.guild.id)
+
+@case('WikiDatabase.revisions_count')
+async def _(f): await f.wiki_db.revisions_count(f.guild.id)
+
+@case('WikiDatabase.page_uses[hot]')
+async def _(f): await f.wiki_db.page_uses(f.guild.id, f.hot_title)
+
+@case('WikiDatabase.page_revisions_count[hot]')
+async def _(f): await f.wiki_db.page_revisions_count(f.guild.id, f.hot_title)
+
+@case('WikiDatabase.top_page_editors[hot]')
+async def _(f): await f.wiki_db.top_page_editors(f.guild.id, f.hot_title, cutoff=f.cutoff)
+
+@case('WikiDatabase.total_page_uses')
+async def _(f): await f.wiki_db.total_page_uses(f.guild.id)
+
+@case('WikiDatabase.top_pages')
+async def _(f): await f.wiki_db.top_pages(f.guild.id)
+
+@case('WikiDatabase.top_editors')
+async def _(f): await f.wiki_db.top_editors(f.guild.id)
+
+@case('WikiDatabase.check_permissions')
+async def _(f): await f.wiki_db.check_permissions(f.member, f.Permissions.view, f.typical_title)
+
+@case('WikiDatabase.create_page', write=True)
+async def _(f): await f.wiki_db.create_page(f.member, 'Benchmark page', f.CONTENT)
+
+@case('WikiDatabase.alias_page', write=True)
+async def _(f): await f.wiki_db.alias_page(f.member, 'Benchmark alias', f.typical_title)
+
+@case('WikiDatabase.revise_page', write=True)
+async def _(f): await f.wiki_db.revise_page(f.member, f.typical_title, f.CONTENT)
+
+@case('WikiDatabase.rename_page', write=True)
+async def _(f): await f.wiki_db.rename_page(f.member, f.typical_title, 'Benchmark page')
+
+@case('WikiDatabase.delete_page[hot]', write=True)
+async def _(f): await f.wiki_db.delete_page(f.admin, f.hot_title)
+
+@case('WikiDatabase.delete_page[alias]', write=True)
+async def _(f): await f.wiki_db.delete_page(f.admin, f.alias_title)
+
+@case('WikiDatabase.log_page_use', write=True)
+async def _(f): await f.wiki_db.log_page_use(f.guild.id, f.hot_title)
+
+## PermissionsDatabase
+
+@case('PermissionsDatabase.permissions_for')
+async def _(f): await f.permissions_db.permissions_for(f.member, f.typical_title)
+
+@case('PermissionsDatabase.member_permissions')
+async def _(f): await f.permissions_db.member_permissions(f.member)
+
+@case('PermissionsDatabase.highest_manage_permissions_role')
+async def _(f): await f.permissions_db.highest_manage_permissions_role(f.member)
+
+@case('PermissionsDatabase.get_role_permissions')
+async def _(f): await f.permissions_db.get_role_permissions(f.role)
+
+@case('PermissionsDatabase.get_page_overwrites')
+async def _(f): await f.permissions_db.get_page_overwrites(f.guild.id, f.overwrite_title)
+
+@case('PermissionsDatabase.get_page_overwrites_for')
+async def _(f): await f.permissions_db.get_page_overwrites_for(f.guild.id, f.overwrite_entity, f.overwrite_title)
+
+@case('PermissionsDatabase.check_permissions')
+async def _(f): await f.permissions_db.check_permissions(f.admin, f.role)
+
+@case('PermissionsDatabase.check_permissions_for')
+async def _(f): await f.permissions_db.check_permissions_for(f.admin, f.typical_title)
+
+@case('PermissionsDatabase.set_role_permissions', write=True)
+async def _(f): await f.permissions_db.set_role_permissions(f.role, f.Permissions.default)
+
+@case('PermissionsDatabase.delete_role_permissions', write=True)
+async def _(f): await f.permissions_db.delete_role_permissions(f.role)
+
+@case('PermissionsDatabase.set_default_permissions', write=True)
+async def _(f): await f.permissions_db.set_default_permissions(f.guild.id)
+
+@case('PermissionsDatabase.allow_role_permissions', write=True)
+async def _(f): await f.permissions_db.allow_role_permissions(f.admin, f.role, f.Permissions.delete)
+
+@case('PermissionsDatabase.deny_role_permissions', write=True)
+async def _(f): await f.permissions_db.deny_role_permissions(f.admin, f.role, f.Permissions.delete)
+
+@case('PermissionsDatabase.set_page_overwrites', write=True)
+async def _(f):
+	await f.permissions_db.set_page_overwrites(
+		guild_id=f.guild.id, title=f.typical_title, entity_id=f.member.id, allow_perms=f.Permissions.delete)
+
+@case('PermissionsDatabase.unset_page_overwrites', write=True)
+async def _(f):
+	await f.permissions_db.unset_page_overwrites(
+		guild_id=f.guild.id, title=f.overwrite_title, entity_id=f.overwrite_entity)
+
+@case('PermissionsDatabase.add_page_permissions', write=True)
+async def _(f):
+	await f.permissions_db.add_page_permissions(
+		member=f.admin, title=f.typical_title, entity_id=f.member.id, new_allow_perms=f.Permissions.delete)
+
+@case('PermissionsDatabase.unset_page_permissions', write=True)
+async def _(f):
+	await f.permissions_db.unset_page_permissions(
+		member=f.admin, title=f.overwrite_title, entity_id=f.overwrite_entity, perms=f.Permissions.delete)
+
+## WatchListsDatabase
+
+@case('WatchListsDatabase.watch_list')
+async def _(f): await drain(f.watch_lists_db.watch_list(f.subscriber))
+
+@case('WatchListsDatabase.page_subscribers[hot]')
+async def _(f): await f.watch_lists_db.page_subscribers(f.subscribed_page_id)
+
+@case('WatchListsDatabase.get_revision_and_previous')
+async def _(f): await f.watch_lists_db.get_revision_and_previous(f.revision_ids[-1])
+
+@case('WatchListsDatabase.watch_page', write=True)
+async def _(f): await f.watch_lists_db.watch_page(f.member, f.typical_title)
+
+@case('WatchListsDatabase.unwatch_page', write=True)
+async def _(f): await f.watch_lists_db.unwatch_page(f.subscriber, f.subscribed_title)
+
+@case('WatchListsDatabase.delete_page_subscribers[hot]', write=True)
+async def _(f): await f.watch_lists_db.delete_page_subscribers(f.subscribed_page_id)
+
+## MessageBindingDatabase
+
+@case('MessageBindingDatabase.get_revision')
+async def _(f): await f.binding_db.get_revision(f.revision_ids[-1])
+
+@case('MessageBindingDatabase.bound_messages')
+async def _(f): await drain(f.binding_db.bound_messages(f.member, f.hot_title))
+
+@case('MessageBindingDatabase.guild_bindings')
+async def _(f): await drain(f.binding_db.guild_bindings(f.member))
+
+@case('MessageBindingDatabase.get_bound_page')
+async def _(f): await f.binding_db.get_bound_page(f.bound_message)
+
+@case('MessageBindingDatabase.bind', write=True)
+async def _(f): await f.binding_db.bind(f.admin, f.new_message, f.typical_title)
+
+@case('MessageBindingDatabase.unbind', write=True)
+async def _(f): await f.binding_db.unbind(f.admin, f.bound_message)
+
+@case('MessageBindingDatabase.delete_all_bindings', write=True)
+async def _(f): await f.binding_db.delete_all_bindings(f.bound_page_id)
+
+## Runner
+
+async def time_once(fixture, func, write):
+	if not write:
+		start = time.perf_counter()
+		await func(fixture)
+		return time.perf_counter() - start
+
+	async with fixture.bot.pool.acquire() as conn:
+		# the methods' own transactions become savepoints of this one.
+		# it has to be serializable because some of them ask for that isolation level.
+		tx = conn.transaction(isolation='serializable')
+		await tx.start()
+		connection.set(conn)
+		try:
+			start = time.perf_counter()
+			await func(fixture)
+			return time.perf_counter() - start
+		finally:
+			await tx.rollback()
+
+async def run_case(fixture, func, write, *, iterations, warmup):
+	timings = []
+	errors = collections.Counter()
+	for i in range(warmup + iterations):
+		try:
+			elapsed = await time_once(fixture, func, write)
+		except Exception as exc:
+			errors[type(exc).__name__] += 1
+			continue
+		if i >= warmup:
+			timings.append(elapsed)
+
+	return {'iterations': len(timings), 'errors': dict(errors), **summarize(timings)}
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__)
+	parser.add_argument('--dsn', default=DEFAULT_DSN, help='a database filled by benchmarks.seed (default: %(default)s)')
+	parser.add_argument('--output', '-o', default='benchmark-results.json', help='default: %(default)s')
+	parser.add_argument('--iterations', '-n', type=int, default=30)
+	parser.add_argument('--warmup', type=int, default=3)
+	parser.add_argument('--filter', '-k', type=re.compile, help='only run benchmarks whose names match this regex')
+	parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+	return parser.parse_args(argv)
+
+async def run(args):
+	cases = {name: case for name, case in CASES.items() if args.filter is None or args.filter.search(name)}
+
+	params = await seed_params(args.dsn)
+	bot = await make_bot(args.dsn)
+	try:
+		fixture = Fixture(bot, params)
+		await fixture.setup()
+
+		results = {}
+		for name, (func, write) in cases.items():
+			# in a new task so that setting the connection contextvar for writes doesn't leak into the next case
+			results[name] = result = await asyncio.create_task(
+				run_case(fixture, func, write, iterations=args.iterations, warmup=args.warmup))
+			errors = f' errors: {result["errors"]}' if result['errors'] else ''
+			median = f'{result["median_ms"]:>9.2f}ms' if result['iterations'] else ' ' * 11
+			print(f'{name:<60} {median}{errors}')
+	finally:
+		await bot.close()
+
+	output = {
+		'environment': await environment(args.dsn),
+		'seed': params,
+		'settings': {'iterations': args.iterations, 'warmup': args.warmup},
+		'results': results,
+	}
+	with open(args.output, 'w') as f:
+		json.dump(output, f, indent=2)
+	print(f'wrote {args.output}')
+
+def main():
+	args = parse_args()
+	if args.list:
+		print('\n'.join(CASES))
+		return
+	asyncio.run(run(args))
+
+if __name__ == '__main__':
+	main()
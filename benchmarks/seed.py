@@ -0,0 +1,227 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Fill a throwaway database with synthetic guilds for the benchmarks.
+
+The database is wiped, then schema.sql and functions.sql are applied to it with psql.
+Given the same parameters and seed, the generated data is the same every time.
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import time
+
+import asyncpg
+
+from cautious_memory import SQL_DIR
+from cautious_memory.cogs.permissions.db import Permissions
+from .common import (
+	DEFAULT_DSN, GUILD_ID_BASE, ROLE_ID_BASE, MEMBER_ID_BASE, CHANNEL_ID_BASE, MESSAGE_ID_BASE)
+
+# seeded overwrites never deny these, so that the benchmarks don't fail permission checks by chance
+NEVER_DENIED = Permissions.default
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m benchmarks.seed', description=__doc__)
+	parser.add_argument('--dsn', default=DEFAULT_DSN, help='the database to wipe and seed (default: %(default)s)')
+	parser.add_argument('--force', action='store_true', help="wipe the database even if its name doesn't contain \"bench\"")
+	parser.add_argument('--seed', type=float, default=0.5, help='seed for random(), between -1 and 1')
+	parser.add_argument('--guilds', type=int, default=1)
+	# the rest are per guild
+	parser.add_argument('--pages', type=int, default=50_000)
+	parser.add_argument('--alias-ratio', type=float, default=0.2, help='how many aliases to create, relative to pages')
+	parser.add_argument('--revisions', type=int, default=2_000_000, help='including the first revision of each page')
+	parser.add_argument('--content-length', type=int, default=400, help='average length of each revision')
+	parser.add_argument('--usage', type=int, default=10_000_000, help='page usage history rows')
+	parser.add_argument('--members', type=int, default=5_000)
+	parser.add_argument('--roles', type=int, default=30)
+	parser.add_argument('--overwrites-per-page', type=float, default=4)
+	parser.add_argument('--subscribers-per-page', type=float, default=2)
+	parser.add_argument('--bindings', type=int, default=2_000)
+	parser.add_argument('--channels', type=int, default=50)
+	args = parser.parse_args(argv)
+
+	if args.revisions < args.pages:
+		parser.error('every page needs at least one revision')
+	if not -1 <= args.seed <= 1:
+		parser.error('the seed must be between -1 and 1')
+
+	return args
+
+def apply_sql_file(dsn, path):
+	# schema.sql uses psql variables, so it has to be run by psql
+	subprocess.run(['psql', '--quiet', '--set', 'ON_ERROR_STOP=1', '--dbname', dsn, '--file', str(path)], check=True)
+
+async def reset_database(conn, args):
+	database = await conn.fetchval('SELECT current_database()')
+	if 'bench' not in database and not args.force:
+		raise SystemExit(
+			f'Refusing to wipe database {database!r} because its name does not contain "bench". '
+			'Pass --force if you are sure.')
+
+	await conn.execute("""
+		DROP SCHEMA public CASCADE;
+		CREATE SCHEMA public;
+		CREATE EXTENSION pg_trgm;
+	""")
+
+async def seed_guild(conn, args, guild_number):
+	guild_id = GUILD_ID_BASE + guild_number
+	role_id_base = ROLE_ID_BASE + guild_number * args.roles
+	member_id_base = MEMBER_ID_BASE + guild_number * args.members
+	channel_id_base = CHANNEL_ID_BASE + guild_number * args.channels
+
+	# IDs are given explicitly so that rows can refer to each other by arithmetic alone
+	page_offset = await conn.fetchval('SELECT coalesce(max(page_id), 0) FROM pages')
+	revision_offset = await conn.fetchval('SELECT coalesce(max(revision_id), 0) FROM revisions')
+	content_offset = await conn.fetchval('SELECT coalesce(max(content_id), 0) FROM contents')
+	message_offset = await conn.fetchval('SELECT coalesce(max(message_id), $1) FROM bound_messages', MESSAGE_ID_BASE)
+
+	# revision i (from 1) is made at the fraction i / revisions of the way through the last two years.
+	# page i is created by revision i. the remaining revisions edit random pages,
+	# skewed towards the lower page IDs so that there are some very popular pages.
+	await conn.execute("""
+		INSERT INTO pages (page_id, title, guild_id, created)
+		SELECT $1::int + i, 'Page ' || i, $2, now() - interval '2 years' * (1 - i::float8 / $4)
+		FROM generate_series(1, $3::int) i
+	""", page_offset, guild_id, args.pages, args.revisions)
+
+	await conn.execute("""
+		INSERT INTO contents (content_id, content)
+		SELECT $1::int + i, left(repeat(md5(i::text) || ' ', 1 + (random() * $3 / 16)::int), 2000)
+		FROM generate_series(1, $2::int) i
+	""", content_offset, args.revisions, args.content_length)
+
+	await conn.execute("""
+		INSERT INTO revisions (
+			revision_id, page_id, author_id, title, content_id, revised,
+			chars_added, chars_removed, lines_added, lines_removed)
+		SELECT
+			$1::int + i,
+			$2::int + page_number,
+			$3::bigint + floor($4 * random() ^ 2)::int,
+			'Page ' || page_number,
+			$5::int + i,
+			now() - interval '2 years' * (1 - i::float8 / $7),
+			-- the contents are unrelated to each other, so these are made up
+			(random() * 200)::int, (random() * 200)::int, (random() * 5)::int, (random() * 5)::int
+		FROM
+			generate_series(1, $7::int) i,
+			LATERAL (SELECT CASE WHEN i <= $6 THEN i ELSE 1 + floor($6 * random() ^ 2)::int END AS page_number) p
+	""", revision_offset, page_offset, member_id_base, args.members, content_offset, args.pages, args.revisions)
+
+	await conn.execute("""
+		UPDATE pages
+		SET latest_revision_id = latest.revision_id
+		FROM (
+			SELECT page_id, max(revision_id) AS revision_id
+			FROM revisions
+			WHERE page_id > $1
+			GROUP BY page_id
+		) latest
+		WHERE pages.page_id = latest.page_id
+	""", page_offset)
+
+	await conn.execute("""
+		INSERT INTO aliases (title, page_id, guild_id, aliased)
+		SELECT 'Alias ' || i, $1::int + 1 + floor($3 * random())::int, $2, now() - interval '1 year' * random()
+		FROM generate_series(1, $4::int) i
+	""", page_offset, guild_id, args.pages, round(args.pages * args.alias_ratio))
+
+	# most usage is recent, and of popular pages
+	await conn.execute("""
+		INSERT INTO page_usage_history (page_id, time)
+		SELECT $1::int + 1 + floor($2 * random() ^ 3)::int, (now() AT TIME ZONE 'UTC') - interval '8 weeks' * random() ^ 2
+		FROM generate_series(1, $3::int)
+	""", page_offset, args.pages, args.usage)
+
+	await conn.execute("""
+		INSERT INTO role_permissions (entity, permissions)
+		SELECT $1::bigint, $2::int
+		UNION ALL
+		SELECT $3::bigint + i, $2::int | floor(128 * random())::int
+		FROM generate_series(0, $4::int - 1) i
+	""", guild_id, Permissions.default.value, role_id_base, args.roles)
+
+	# half of the overwrites are for roles and half are for members
+	await conn.execute("""
+		INSERT INTO page_permissions (page_id, entity, allow, deny)
+		SELECT page_id, entity, allow, floor(128 * random())::int & ~allow & ~$7::int
+		FROM (
+			SELECT
+				$1::int + 1 + floor($2 * random())::int AS page_id,
+				CASE WHEN random() < 0.5
+					THEN $3::bigint + floor($4 * random())::int
+					ELSE $5::bigint + floor($6 * random())::int
+				END AS entity,
+				floor(128 * random())::int AS allow
+			FROM generate_series(1, $8::int)
+		) overwrites
+		ON CONFLICT DO NOTHING
+	""",
+		page_offset, args.pages, role_id_base, args.roles, member_id_base, args.members,
+		NEVER_DENIED.value, round(args.pages * args.overwrites_per_page))
+
+	await conn.execute("""
+		INSERT INTO page_subscribers (page_id, user_id)
+		SELECT $1::int + 1 + floor($2 * random() ^ 2)::int, $3::bigint + floor($4 * random())::int
+		FROM generate_series(1, $5::int)
+		ON CONFLICT DO NOTHING
+	""", page_offset, args.pages, member_id_base, args.members, round(args.pages * args.subscribers_per_page))
+
+	await conn.execute("""
+		INSERT INTO bound_messages (message_id, channel_id, page_id)
+		SELECT $1::bigint + i, $2::bigint + floor($3 * random())::int, $4::int + 1 + floor($5 * random())::int
+		FROM generate_series(1, $6::int) i
+	""", message_offset, channel_id_base, args.channels, page_offset, args.pages, args.bindings)
+
+async def seed(args):
+	conn = await asyncpg.connect(args.dsn)
+	try:
+		await reset_database(conn, args)
+		for filename in 'schema.sql', 'functions.sql':
+			apply_sql_file(args.dsn, SQL_DIR / filename)
+
+		await conn.execute('SELECT setseed($1)', args.seed)
+		async with conn.transaction():
+			# nobody needs to be notified about millions of fake edits
+			await conn.execute('ALTER TABLE revisions DISABLE TRIGGER notify_page_edit')
+			for guild_number in range(args.guilds):
+				start = time.perf_counter()
+				await seed_guild(conn, args, guild_number)
+				print(f'seeded guild {guild_number + 1}/{args.guilds} in {time.perf_counter() - start:.1f}s')
+			await conn.execute('ALTER TABLE revisions ENABLE TRIGGER notify_page_edit')
+
+			# since the IDs were given explicitly, the identity sequences are still at the start
+			for table, column in ('pages', 'page_id'), ('revisions', 'revision_id'), ('contents', 'content_id'):
+				await conn.execute(
+					f'SELECT setval(pg_get_serial_sequence($1, $2), (SELECT max({column}) FROM {table}))',
+					table, column)
+
+			await conn.execute('CREATE TABLE benchmark_seed (params JSONB NOT NULL)')
+			params = {key: value for key, value in vars(args).items() if key not in {'dsn', 'force'}}
+			await conn.execute('INSERT INTO benchmark_seed (params) VALUES ($1)', json.dumps(params))
+
+		await conn.execute('VACUUM ANALYZE')
+	finally:
+		await conn.close()
+
+def main():
+	asyncio.run(seed(parse_args()))
+
+if __name__ == '__main__':
+	main()
@@ -34,6 +34,12 @@ from bot_bin.bot import Bot
 from discord.ext import commands
 
 from . import utils
+from .utils import databases, sql, tracing
+from .utils.leader import LeaderElection
+from .utils.loop_monitor import LoopLagMonitor
+from .utils.ratelimit import RateLimiter
+from .utils.workload import WORKLOADS, WorkloadPool, workload_scope
+from .utils.workers import WorkerPool
 
 BASE_DIR = Path(__file__).parent
 SQL_DIR = BASE_DIR / 'sql'
@@ -43,13 +49,41 @@ logger = logging.getLogger('bot')
 
 class CautiousMemory(Bot):
 	def __init__(self, *args, **kwargs):
+		cluster = kwargs['config'].get('cluster', {})
+		kwargs.setdefault('shard_count', cluster.get('shard_count'))
+		kwargs.setdefault('shard_ids', cluster.get('shard_ids'))
 		super().__init__(*args, setup_db=True, **kwargs)
+		self.ratelimiter = RateLimiter(self.config.get('ratelimits', {}))
+		self.tracer = tracing.TraceRecorder(**self.config.get('tracing', {}))
+		self.loop_monitor = LoopLagMonitor(**self.config.get('loop_monitor', {}))
+		self.workers = WorkerPool(**self.config.get('workers', {}))
+		# processes running the same shards compete for background duties, so that only one of them does each
+		scope = 'all shards' if self.shard_ids is None else f'shards {sorted(self.shard_ids)} of {self.shard_count}'
+		self.leader_election = LeaderElection(
+			self.direct_database_configs[0], scope=scope, **self.config.get('leader_election', {}))
+		self.before_invoke(self.start_trace)
+		self.after_invoke(self.finish_trace)
+		self.trace_http_requests()
 		self.jinja_env = jinja2.Environment(
 			loader=jinja2.FileSystemLoader(str(SQL_DIR)),
 			line_statement_prefix='-- :')
 
 	def process_config(self):
 		self.owners = set(self.config.get('extra_owners', []))
+		# the rest of the database section is passed to asyncpg as is
+		database = self.config['database']
+		self.replica_config = database.pop('replica', None)
+		# more databases to spread guilds across, by name
+		self.databases_config = self.config.get('databases', {})
+		if databases.HOME in self.databases_config:
+			raise ValueError(f'{databases.HOME!r} is the name of the main database, so it cannot be used for another')
+		self.transaction_pooler = database.pop('transaction_pooler', False)
+		# LISTEN and session advisory locks need a server connection of their own, so they bypass the pooler
+		self.direct_database_configs = [
+			self.direct_config(config) for config in [database, *self.databases_config.values()]]
+		unknown_workloads = set(self.config.get('pools', {})) - set(WORKLOADS)
+		if unknown_workloads:
+			raise ValueError(f'unknown workloads in pools: {", ".join(sorted(unknown_workloads))}')
 		self.config['success_emojis'] = {False: self.config['failure_emoji'], True: self.config['success_emoji']}
 
 		super().process_config()
@@ -60,52 +94,171 @@ class CautiousMemory(Bot):
 
 	### Utility functions
 
+	# keys of the database section that are for asyncpg.create_pool, not for connecting
+	POOL_KEYS = {'min_size', 'max_size', 'max_queries', 'max_inactive_connection_lifetime'}
+
+	@classmethod
+	def direct_config(cls, database):
+		"""remove the direct section from a database's config, and return the config for connecting directly"""
+		direct = database.pop('direct', {})
+		return {key: value for key, value in {**database, **direct}.items() if key not in cls.POOL_KEYS}
+
+	def pool_config(self, database):
+		"""return the keyword arguments for create_pool for a database"""
+		if self.transaction_pooler:
+			# a server connection may be handed to another client after every transaction,
+			# so statements can't be prepared by name and reused in later ones
+			return {'statement_cache_size': 0, **database}
+		return database
+
+	async def create_pool(self, name, database, *, routes_reads=True):
+		"""return a pool for a database, which is a WorkloadPool if pools are configured"""
+		database = self.pool_config(database)
+		if not self.config.get('pools'):
+			return await sql.create_pool(**database, name=name, routes_reads=routes_reads)
+
+		pools = {}
+		for workload, pool_config in {'interactive': {}, **self.config['pools']}.items():
+			pools[workload] = await sql.create_pool(
+				**{**database, **pool_config}, name=name, workload=workload, routes_reads=routes_reads)
+		return WorkloadPool(pools)
+
+	def runs_guild(self, guild_id):
+		"""return whether this process runs the shard that the given guild is on"""
+		if self.shard_ids is None:
+			# we run every shard
+			return True
+		return (guild_id >> 22) % self.shard_count in self.shard_ids
+
 	async def is_privileged(self, member):
 		return member.guild_permissions.administrator or await self.is_owner(member)
 
 	def queries(self, template_name):
-		return self.jinja_env.get_template(template_name).module
+		return sql.Queries(template_name, self.jinja_env.get_template(template_name).module)
+
+	async def invoke(self, ctx):
+		# the author's reads go to the primary until the replica has what they wrote (see utils.replica)
+		with databases.guild_scope(ctx.guild and ctx.guild.id), workload_scope('interactive'):
+			async with sql.replica_router.session(ctx.author.id):
+				await super().invoke(ctx)
+
+	### Tracing
+
+	async def start_trace(self, ctx):
+		trace = getattr(ctx, 'trace', None)
+		if trace is not None and not trace.finished:
+			# a group's before_invoke hook ran but its after_invoke hook won't, because a subcommand was invoked
+			trace.root.name = ctx.command.qualified_name
+			return
 
-	### Init / Shutdown
+		ctx.trace, ctx.trace_token = self.tracer.start(ctx.command.qualified_name)
+
+	async def finish_trace(self, ctx):
+		self.tracer.finish(ctx.trace, ctx.trace_token, failed=ctx.command_failed)
+
+	def trace_http_requests(self):
+		request = self.http.request
+
+		async def traced_request(route, **kwargs):
+			# route.path has the parameters left in, so that requests to the same endpoint get the same name
+			name = f'discord {route.method} {route.path}'
+			sql.check_held_connections(name)
+			with tracing.span(name):
+				return await request(route, **kwargs)
+
+		self.http.request = traced_request
+
+	### Init / Shutdown
+
+	async def start(self):
+		self.loop_monitor.start(self.loop)
+		await super().start()
 
 	async def init_db(self):
-		await super().init_db()
+		# self.pool is a DatabaseRouter when guilds are spread across several databases.
+		# home_pool is the main database, for what doesn't belong to any guild.
+		self.pool = self.home_pool = await self.create_pool(databases.HOME, self.config['database'])
+		if self.databases_config:
+			pools = {databases.HOME: self.home_pool}
+			for name, database_config in self.databases_config.items():
+				# the replica is a replica of the home database only
+				pools[name] = await self.create_pool(name, database_config, routes_reads=False)
+			self.pool = databases.DatabaseRouter(pools, self.queries('databases.sql'))
+			await self.pool.start()
+		if self.config.get('slow_queries'):
+			sql.slow_query_log.configure(self.pool, **self.config['slow_queries'])
+		if self.replica_config is not None:
+			replica_config = dict(self.replica_config)
+			poll_interval = replica_config.pop('poll_interval', 0.1)
+			replica = await sql.create_pool(**self.pool_config(replica_config), name='replica', routes_reads=False)
+			sql.replica_router.configure(self.home_pool, replica, poll_interval=poll_interval)
+		await self.leader_election.start()
 		await self.init_listener()
 
 	async def init_listener(self):
-		self.listener_conn = await asyncpg.connect(**self.config['database'])
+		# one for each database, since each one notifies of edits to its own guilds
+		self.listener_conns = [await asyncpg.connect(**config) for config in self.direct_database_configs]
 		self.listener_conn_callbacks = []
 
-		def listener(func):
-			channel_name = func.__name__[len('on_'):]
-			self.listener_conn_callbacks.append((channel_name, func))
+		def listener(*, home_only=False):
+			def decorator(func):
+				channel_name = func.__name__[len('on_'):]
+				for conn in self.listener_conns[:1] if home_only else self.listener_conns:
+					self.listener_conn_callbacks.append((conn, channel_name, func))
+				return func
+			return decorator
 
-			return func
+		# every process gets every notification, so each one drops those for guilds on other processes' shards
+		# before its listeners make any queries
 
-		@listener
-		def on_page_edit(connection, pid, channel, revision_id):
-			# convert an asyncpg event into a discord event
-			self.dispatch('cm_page_edit', int(revision_id))
+		@listener()
+		def on_page_edit(connection, pid, channel, payload):
+			guild_id, revision_id = map(int, payload.split(','))
+			if self.runs_guild(guild_id):
+				# convert an asyncpg event into a discord event.
+				# the listeners' tasks copy the current context, so their queries go to the guild's database.
+				with databases.guild_scope(guild_id):
+					self.dispatch('cm_page_edit', revision_id)
 
-		@listener
+		@listener()
 		def on_page_delete(connection, pid, channel, payload):
 			guild_id, page_id, title = payload.split(',', 2)
-			self.dispatch('cm_page_delete', int(guild_id), int(page_id), title)
+			if self.runs_guild(int(guild_id)):
+				with databases.guild_scope(int(guild_id)):
+					self.dispatch('cm_page_delete', int(guild_id), int(page_id), title)
+
+		@listener(home_only=True)
+		def on_api_token_revoke(connection, pid, channel, payload):
+			user_id, app_id = payload.split(',')
+			self.dispatch('cm_api_token_revoke', int(user_id), int(app_id))
+
+		if self.databases_config:
+			@listener(home_only=True)
+			def on_guild_database_change(connection, pid, channel, payload):
+				self.pool.directory_changed(payload)
 
-		for channel, callback in self.listener_conn_callbacks:
-			await self.listener_conn.add_listener(channel, callback)
+		for conn, channel, callback in self.listener_conn_callbacks:
+			await conn.add_listener(channel, callback)
 
 	async def close(self):
+		self.loop_monitor.stop()
 		with contextlib.suppress(AttributeError):
-			for channel, callback in self.listener_conn_callbacks:
-				await self.listener_conn.remove_listener(channel, callback)
-			await self.listener_conn.close()
+			for conn, channel, callback in self.listener_conn_callbacks:
+				await conn.remove_listener(channel, callback)
+			for conn in self.listener_conns:
+				await conn.close()
+		await self.leader_election.stop()
+		await sql.replica_router.close()
 		await super().close()
+		self.workers.shutdown()
 
 	startup_extensions = utils.expand("""{
 		cautious_memory.cogs.{
 			{permissions,wiki,watch_lists,binding}.{db,commands},
 			api,
+			api_server,
+			diagnostics,
+			databases,
 			meta},
 		jishaku,
 		bot_bin.{
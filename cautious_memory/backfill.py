@@ -0,0 +1,101 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Fills in the change statistics of revisions that were made before they were recorded.
+
+	$ python -m cautious_memory.backfill
+
+Each page is done in its own transaction, so this can be run while the bot is up, and run again if it's interrupted.
+"""
+
+import argparse
+import asyncio
+import time
+
+import asyncpg
+import json5
+
+from . import BASE_DIR
+from .utils.diff import change_stats
+
+async def backfill_page(conn, page_id):
+	"""fill in the change statistics of one page's revisions, and return how many were filled in"""
+	async with conn.transaction():
+		# every revision is needed, because the statistics are relative to the revision before
+		rows = await conn.fetch("""
+			SELECT revision_id, chars_added IS NULL AS missing, content
+			FROM revisions INNER JOIN contents USING (content_id)
+			WHERE page_id = $1
+			ORDER BY revision_id
+		""", page_id)
+
+		updates = []
+		previous = ''
+		for revision_id, missing, content in rows:
+			if missing:
+				updates.append((revision_id, *change_stats(previous, content)))
+			previous = content
+
+		await conn.executemany("""
+			UPDATE revisions
+			SET chars_added = $2, chars_removed = $3, lines_added = $4, lines_removed = $5
+			WHERE revision_id = $1
+		""", updates)
+		return len(updates)
+
+async def backfill(args):
+	if args.dsn:
+		await backfill_database(await asyncpg.connect(args.dsn))
+		return
+
+	with open(BASE_DIR.parent / 'config.json5') as f:
+		config = json5.load(f)
+	database = config['database']
+	database.pop('replica', None)
+	database.pop('transaction_pooler', None)
+	await backfill_database(await connect_directly(database))
+	for name, other in config.get('databases', {}).items():
+		print(f'database {name}:')
+		await backfill_database(await connect_directly(other))
+
+async def connect_directly(database):
+	# bypassing the transaction pooler, if there is one, since it doesn't support prepared statements
+	direct = database.pop('direct', {})
+	return await asyncpg.connect(**{**database, **direct})
+
+async def backfill_database(conn):
+	try:
+		page_ids = [page_id for page_id, in await conn.fetch(
+			'SELECT DISTINCT page_id FROM revisions WHERE chars_added IS NULL ORDER BY page_id')]
+
+		start = time.perf_counter()
+		revisions = 0
+		for i, page_id in enumerate(page_ids, 1):
+			revisions += await backfill_page(conn, page_id)
+			if i % 1000 == 0 or i == len(page_ids):
+				print(f'{i}/{len(page_ids)} pages, {revisions} revisions ({time.perf_counter() - start:.1f}s)')
+	finally:
+		await conn.close()
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m cautious_memory.backfill', description=__doc__)
+	parser.add_argument('--dsn', help='the database to backfill. By default, the ones in config.json5 are used.')
+	return parser.parse_args(argv)
+
+def main():
+	asyncio.run(backfill(parse_args()))
+
+if __name__ == '__main__':
+	main()
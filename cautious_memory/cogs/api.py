@@ -15,7 +15,10 @@
 
 import base64
 import contextlib
+import hashlib
+import hmac
 import secrets
+import time
 
 import discord
 from discord.ext import commands
@@ -25,10 +28,23 @@ from .. import utils
 
 class API(commands.Cog):
 	TOKEN_DELIMITER = b';'
+	# the maximum number of (user_id, app_id) pairs to keep in the token cache
+	TOKEN_CACHE_SIZE = 10_000
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.queries = self.bot.queries('api.sql')
+		token_hash_key = self.bot.config['api'].get('token_hash_key')
+		if not token_hash_key:
+			# otherwise every secret would be hashed with the same empty key
+			raise ValueError('api.token_hash_key must be set to a long random string to use API tokens')
+		self.token_hash_key = token_hash_key.encode()
+		self.token_cache_ttl = self.bot.config['api'].get('token_cache_ttl', 60)
+		# maps (user_id, app_id) to (secret_hash, expiry)
+		self.token_cache = {}
+		# incremented whenever tokens are invalidated, so that a secret hash that was being fetched at the time
+		# (and may be the old one) isn't cached afterwards
+		self.token_cache_generation = 0
 
 	@staticmethod
 	def any_parent_command_is(command, parent_command):
@@ -85,14 +101,29 @@ class API(commands.Cog):
 		await ctx.message.add_reaction(self.bot.config['success_emoji'])
 
 	@api_token.command(name='show', aliases=['get'])
-	async def token_show(self, ctx, *, app_id: int):
-		"""Sends you your token for a particular API application."""
-		app_name, token = await self.existing_token(ctx.author.id, app_id)
-		if token is None:
+	async def token_show(self, ctx):
+		"""Explains how to get the token of an API application."""
+		await ctx.send(
+			'Tokens are not stored, so they cannot be shown again. '
+			f'Use the __{ctx.prefix}api-token regenerate__ command to get a new one. The old one will stop working.')
+
+	@api_token.command(name='regenerate', aliases=['regen'])
+	async def token_regenerate(self, ctx, *, app_id: int):
+		"""Sends you a new token for a particular API application.
+
+		Tokens are not stored, so they cannot be shown again. The old token will stop working immediately.
+		"""
+		result = await self.regenerate_token(ctx.author.id, app_id)
+		if result is None:
 			await ctx.send('Error: no such app found.')
 			return
 
-		await self.send_token(ctx, token, app_name)
+		app_name, token = result
+		await self.send_token(ctx, token, app_name, new=True)
+
+	@commands.Cog.listener()
+	async def on_cm_api_token_revoke(self, user_id, app_id):
+		self.invalidate_tokens([(user_id, app_id)])
 
 	async def send_token(self, ctx, token, app_name, *, new=False):
 		message = (
@@ -109,49 +140,87 @@ class API(commands.Cog):
 				await ctx.message.add_reaction('📬')
 
 	async def list_apps(self, user_id):
-		return await self.bot.pool.fetch(self.queries.list_apps(), user_id)
-
-	async def existing_token(self, user_id, app_id):
-		row = await self.bot.pool.fetchrow(self.queries.existing_token(), user_id, app_id)
-		if row is None:
-			return None
-		app_name, secret = row
-		return app_name, self.encode_token(user_id, app_id, secret)
+		return await self.bot.home_pool.fetch(self.queries.list_apps(), user_id)
 
 	async def new_token(self, user_id, app_name):
 		secret = secrets.token_bytes()
-		app_id = await self.bot.pool.fetchval(self.queries.new_token(), user_id, app_name, secret)
+		app_id = await self.bot.home_pool.fetchval(self.queries.new_token(), user_id, app_name, self.hash_secret(secret))
 		return self.encode_token(user_id, app_id, secret)
 
 	async def regenerate_token(self, user_id, app_id):
-		await self.delete_app(user_id, app_id)
-		return await self.new_token(user_id)
+		"""replace the secret of an existing app. return (app_name, token), or None if the app does not exist."""
+		secret = secrets.token_bytes()
+		app_name = await self.bot.home_pool.fetchval(
+			self.queries.regenerate_token(),
+			user_id, app_id, self.hash_secret(secret))
+		# other processes are told by the api_token_revoke notification
+		self.invalidate_tokens([(user_id, app_id)])
+		if app_name is None:
+			return None
+		return app_name, self.encode_token(user_id, app_id, secret)
 
 	async def validate_token(self, token, user_id=None, app_id=None):
+		"""return (user_id, app_id) if the token is valid, or (None, None) otherwise"""
 		try:
 			token_user_id, token_app_id, secret = self.decode_token(token)
 		except:
 			secrets.compare_digest(token, token)
-			return False
+			return None, None
 
 		if user_id is None:
 			user_id = token_user_id
 		if app_id is None:
 			app_id = token_app_id
 
-		db_secret = await self.bot.pool.fetchval(self.queries.get_secret(), user_id, app_id)
-		if db_secret is None:
+		secret_hash = await self.get_secret_hash(user_id, app_id)
+		if secret_hash is None:
 			secrets.compare_digest(token, token)
-			return False
-
-		db_token = self.encode_token(user_id, app_id, db_secret)
-		return (user_id, app_id) if secrets.compare_digest(token, db_token) else (None, None)
+			return None, None
+
+		valid = (
+			hmac.compare_digest(self.hash_secret(secret), secret_hash)
+			# base64 decoding is lenient, so make sure the token was encoded the way we encode tokens
+			& secrets.compare_digest(token, self.encode_token(token_user_id, token_app_id, secret)))
+		if valid and (token_user_id, token_app_id) == (user_id, app_id):
+			return user_id, app_id
+		return None, None
+
+	async def get_secret_hash(self, user_id, app_id):
+		key = user_id, app_id
+		now = time.monotonic()
+		with contextlib.suppress(KeyError):
+			secret_hash, expiry = self.token_cache[key]
+			if now < expiry:
+				return secret_hash
+			del self.token_cache[key]
+
+		generation = self.token_cache_generation
+		secret_hash = await self.bot.home_pool.fetchval(self.queries.get_secret_hash(), user_id, app_id)
+		if secret_hash is None or generation != self.token_cache_generation:
+			return secret_hash
+
+		if len(self.token_cache) >= self.TOKEN_CACHE_SIZE:
+			# dicts are ordered, so this evicts the entry that was cached first
+			del self.token_cache[next(iter(self.token_cache))]
+		self.token_cache[key] = secret_hash, now + self.token_cache_ttl
+		return secret_hash
 
 	async def delete_user_account(self, user_id):
-		await self.bot.pool.execute(self.queries.delete_user_account(), user_id)
+		await self.bot.home_pool.execute(self.queries.delete_user_account(), user_id)
+		self.invalidate_tokens([key for key in self.token_cache if key[0] == user_id])
 
 	async def delete_app(self, user_id, app_id):
-		await self.bot.pool.execute(self.queries.delete_app(), user_id, app_id)
+		await self.bot.home_pool.execute(self.queries.delete_app(), user_id, app_id)
+		self.invalidate_tokens([(user_id, app_id)])
+
+	def invalidate_tokens(self, keys):
+		"""remove (user_id, app_id) pairs from the token cache, and keep lookups in progress from caching them again"""
+		self.token_cache_generation += 1
+		for key in keys:
+			self.token_cache.pop(key, None)
+
+	def hash_secret(self, secret: bytes):
+		return hmac.new(self.token_hash_key, secret, hashlib.sha256).digest()
 
 	def generate_token(self, user_id, app_id):
 		secret = base64.b64encode(secrets.token_bytes())
@@ -0,0 +1,394 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import datetime
+import functools
+import json
+import logging
+import math
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+from .permissions.db import Permissions
+from .. import utils
+from ..utils import errors
+from ..utils.databases import current_guild_id
+from ..utils.ratelimit import current_app_id
+from ..utils.sql import replica_router
+from ..utils.workload import workload_scope
+
+logger = logging.getLogger(__name__)
+
+def json_default(x):
+	if isinstance(x, datetime.datetime):
+		return x.isoformat()
+	raise TypeError(f'Object of type {type(x).__name__} is not JSON serializable')
+
+dumps = functools.partial(json.dumps, default=json_default)
+
+def json_error(exc_type, message):
+	return exc_type(text=dumps({'error': message}), content_type='application/json')
+
+def etag(*parts):
+	return '"' + '-'.join(map(str, parts)) + '"'
+
+def page_json(page):
+	return {
+		'page_id': page.page_id,
+		'title': page.title,
+		'alias': page.alias,
+		'content': page.content,
+		'created': page.created,
+		'latest_revision_id': page.latest_revision_id,
+	}
+
+def revision_json(revision):
+	return {
+		'revision_id': revision.revision_id,
+		'page_id': revision.page_id,
+		'author_id': revision.author_id,
+		'title': revision.title,
+		'content': revision.content,
+		'revised': revision.revised,
+	}
+
+def revision_metadata_json(revision):
+	return {
+		'revision_id': revision.revision_id,
+		'page_id': revision.page_id,
+		'author_id': revision.author_id,
+		'title': revision.title,
+		'revised': revision.revised,
+		'chars_added': revision.chars_added,
+		'chars_removed': revision.chars_removed,
+		'lines_added': revision.lines_added,
+		'lines_removed': revision.lines_removed,
+	}
+
+class StubGuild(discord.Object):
+	def __init__(self, id):
+		super().__init__(id)
+		self.default_role = discord.Object(id)
+
+class StubMember(discord.Object):
+	"""Has as much of a discord.Member as the database cogs use."""
+
+	def __init__(self, id, guild, role_ids=(), *, administrator=False):
+		super().__init__(id)
+		self.guild = guild
+		self.roles = [guild.default_role, *map(discord.Object, role_ids)]
+		self.guild_permissions = discord.Permissions(administrator=administrator)
+		self.bot = False
+
+class StubMemberResolver:
+	"""Makes up members from their IDs, for serving the API without a connection to Discord.
+
+	roles maps user IDs to the IDs of the roles they have in every guild. Users left out only have @everyone.
+	"""
+
+	def __init__(self, roles=None, *, administrators=()):
+		self.roles = roles or {}
+		self.administrators = frozenset(administrators)
+
+	async def __call__(self, guild_id, user_id):
+		return StubMember(
+			user_id, StubGuild(guild_id), self.roles.get(user_id, ()), administrator=user_id in self.administrators)
+
+class APIServer(commands.Cog):
+	"""An HTTP API served from inside the bot process.
+
+	All routes require an API token in the Authorization header.
+	The app returned by make_app only needs the WikiDatabase and API cogs to be loaded. Given a StubMemberResolver,
+	it doesn't need to be logged in to Discord either, so it can be served against a local database.
+	"""
+
+	# the most titles that may be requested in one bulk fetch
+	BULK_LIMIT = 100
+	# the most revisions that may be listed at once
+	HISTORY_LIMIT = 100
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.config = self.bot.config['api']['server']
+		self.runner = None
+		self.bot.loop.create_task(self.start())
+
+	def cog_unload(self):
+		if self.runner is not None:
+			self.bot.loop.create_task(self.runner.cleanup())
+
+	@property
+	def db(self):
+		return self.bot.cogs['WikiDatabase']
+
+	@property
+	def api(self):
+		return self.bot.cogs['API']
+
+	async def start(self):
+		self.runner = web.AppRunner(self.make_app())
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, self.config.get('host', '127.0.0.1'), self.config.get('port', 8080))
+		await site.start()
+		logger.info('API server listening on %s', site.name)
+
+	def make_app(self, *, resolve_member=None):
+		"""return the API's aiohttp app.
+
+		resolve_member is a coroutine function that takes a guild ID and a user ID, and returns the member,
+		or None if there is no such member. By default, members are looked up through Discord.
+		"""
+		app = web.Application(middlewares=[self.session_middleware, self.error_middleware])
+		app['resolve_member'] = resolve_member or self.get_member
+		app.add_routes([
+			web.get('/guilds/{guild_id:\\d+}/pages', self.pages),
+			web.get('/guilds/{guild_id:\\d+}/pages/{title}', self.page),
+			web.put('/guilds/{guild_id:\\d+}/pages/{title}', self.edit_page),
+			web.get('/guilds/{guild_id:\\d+}/pages/{title}/revisions', self.page_revisions),
+			web.get('/guilds/{guild_id:\\d+}/revisions/{revision_id:\\d+}', self.revision),
+			web.get('/guilds/{guild_id:\\d+}/search', self.search),
+		])
+		return app
+
+	@web.middleware
+	async def session_middleware(self, request, handler):
+		# the user is filled in once the request is authorized
+		with workload_scope('interactive'):
+			async with replica_router.session() as session:
+				request['replica_session'] = session
+				return await handler(request)
+
+	@web.middleware
+	async def error_middleware(self, request, handler):
+		try:
+			return await handler(request)
+		except errors.RateLimitedError as exc:
+			response = json_error(web.HTTPTooManyRequests, str(exc))
+			response.headers['Retry-After'] = str(math.ceil(exc.retry_after))
+			raise response
+		except errors.PageNotFoundError as exc:
+			raise json_error(web.HTTPNotFound, str(exc))
+		except errors.MissingPagePermissionsError as exc:
+			raise json_error(web.HTTPForbidden, str(exc))
+		except errors.GuildMovingError as exc:
+			raise json_error(web.HTTPServiceUnavailable, str(exc))
+		except errors.EditConflictError as exc:
+			response = json_error(web.HTTPConflict, str(exc))
+			response.headers['ETag'] = etag(exc.latest_revision_id)
+			raise response
+		except commands.UserInputError as exc:
+			raise json_error(web.HTTPBadRequest, str(exc))
+
+	## Routes
+
+	async def pages(self, request):
+		"""List all pages, or fetch several pages at once if any title query parameters are given."""
+		member = await self.authorize(request)
+		titles = request.query.getall('title', [])
+		if not titles:
+			return await self.stream_json(
+				request, self.db.get_all_page_batches(member), lambda page: {'title': page.title})
+
+		if len(titles) > self.BULK_LIMIT:
+			raise json_error(web.HTTPBadRequest, f'At most {self.BULK_LIMIT} titles may be requested at once.')
+
+		pages = await self.db.get_pages(member, titles)
+		return web.json_response(list(map(page_json, pages)), dumps=dumps)
+
+	async def page(self, request):
+		member = await self.authorize(request)
+		title = request.match_info['title']
+
+		if 'If-None-Match' in request.headers:
+			# this query is a lot cheaper than fetching the whole page
+			page = await self.db.get_page(member, title, partial=True)
+			self.check_not_modified(request, etag(page.latest_revision_id))
+
+		page = await self.db.get_page(member, title)
+		return web.json_response(page_json(page), dumps=dumps, headers={'ETag': etag(page.latest_revision_id)})
+
+	async def edit_page(self, request):
+		"""Replace a page's content with the content key of the JSON body.
+
+		To make sure nobody else's edit is overwritten, send the ETag of the page as fetched in an If-Match header.
+		If the page has been edited since, the edits are merged, or 409 Conflict is returned if they overlap,
+		with the ETag of the latest revision. The response says whether the edits were merged.
+		"""
+		member = await self.authorize(request)
+		try:
+			content = (await request.json())['content']
+		except (ValueError, TypeError, KeyError):
+			raise json_error(web.HTTPBadRequest, 'The body must be a JSON object with a content key.')
+		if not isinstance(content, str):
+			raise json_error(web.HTTPBadRequest, 'The content must be a string.')
+
+		revision = await self.db.revise_page(
+			member, request.match_info['title'], content, base_revision_id=self.if_match_revision_id(request))
+		return web.json_response(
+			{'title': revision.title, 'latest_revision_id': revision.revision_id, 'merged': revision.merged},
+			dumps=dumps, headers={'ETag': etag(revision.revision_id)})
+
+	async def page_revisions(self, request):
+		"""List a page's revisions without their content, newest first.
+
+		This is paginated by revision ID: the Link header gives the URL of the next page, if there might be one.
+		Use the revision route to get the content of a revision.
+		"""
+		member = await self.authorize(request)
+		before = self.int_query(request, 'before')
+		limit = self.int_query(request, 'limit', self.HISTORY_LIMIT)
+		if not 1 <= limit <= self.HISTORY_LIMIT:
+			raise json_error(web.HTTPBadRequest, f'The limit must be between 1 and {self.HISTORY_LIMIT}.')
+
+		page = await self.db.get_page(member, request.match_info['title'], partial=True)
+		tag = etag('revisions', page.latest_revision_id, before, limit)
+		self.check_not_modified(request, tag)
+
+		revisions = [
+			revision_metadata_json(revision) async for revision in
+			self.db.get_page_history(member, page.original_title, before=before, limit=limit)]
+
+		headers = {'ETag': tag}
+		if len(revisions) == limit:
+			next_url = request.rel_url.update_query(before=revisions[-1]['revision_id'], limit=limit)
+			headers['Link'] = f'<{next_url}>; rel="next"'
+		return web.json_response(revisions, dumps=dumps, headers=headers)
+
+	async def revision(self, request):
+		member = await self.authorize(request)
+		revision_id = int(request.match_info['revision_id'])
+		try:
+			revision = await self.db.get_revision(member.guild.id, revision_id)
+		except ValueError:
+			raise json_error(web.HTTPNotFound, 'Revision not found.')
+
+		await self.db.check_permissions(member, Permissions.view, revision.current_title)
+		# revisions never change, so they leave out their page's current title, which does.
+		# the tag is only checked now so that it doesn't reveal which ones exist
+		tag = etag('revision', revision_id)
+		self.check_not_modified(request, tag)
+		return web.json_response(revision_json(revision), dumps=dumps, headers={'ETag': tag})
+
+	async def search(self, request):
+		member = await self.authorize(request)
+		try:
+			query = request.query['q']
+		except KeyError:
+			raise json_error(web.HTTPBadRequest, 'The q query parameter is required.')
+
+		# there are at most 100 results, so they're sent all at once, after the connection is released
+		pages = [{'title': page.title} async for page in self.db.search_pages(member, query)]
+		return web.json_response(pages, dumps=dumps)
+
+	## Helpers
+
+	async def authorize(self, request) -> discord.Member:
+		"""validate the request's API token and return the member it's acting as"""
+		token = request.headers.get('Authorization', '').encode()
+		user_id, app_id = await self.api.validate_token(token)
+		if user_id is None:
+			raise json_error(web.HTTPUnauthorized, 'Invalid or missing API token.')
+
+		member = await request.app['resolve_member'](int(request.match_info['guild_id']), user_id)
+		if member is None:
+			raise json_error(web.HTTPNotFound, 'Guild not found.')
+
+		# database methods for expensive reads and writes charge the app's rate limits along with the member's
+		current_app_id.set(app_id)
+		request['replica_session'].user_id = user_id
+		# the rest of the request's queries go to the guild's database
+		current_guild_id.set(member.guild.id)
+		return member
+
+	async def get_member(self, guild_id, user_id):
+		guild = self.bot.get_guild(guild_id)
+		if guild is None:
+			return None
+
+		try:
+			return await utils.fetch_member(guild, user_id)
+		except discord.NotFound:
+			return None
+
+	@staticmethod
+	def int_query(request, name, default=None):
+		try:
+			value = request.query[name]
+		except KeyError:
+			return default
+
+		try:
+			return int(value)
+		except ValueError:
+			raise json_error(web.HTTPBadRequest, f'The {name} query parameter must be an integer.')
+
+	@staticmethod
+	def if_match_revision_id(request):
+		"""return the revision ID in the If-Match header, or None if there isn't one"""
+		tag = request.headers.get('If-Match', '*').strip()
+		if tag == '*':
+			return None
+
+		try:
+			# weak tags never match, so they're rejected along with anything else that isn't one of ours
+			return int(tag.strip('"'))
+		except ValueError:
+			raise json_error(web.HTTPBadRequest, 'If-Match must be the ETag of the page.')
+
+	@staticmethod
+	def check_not_modified(request, tag):
+		candidates = {candidate.strip() for candidate in request.headers.get('If-None-Match', '').split(',')}
+		# weak comparison, since we never send weak tags but intermediaries may weaken them
+		if '*' in candidates or tag in candidates or 'W/' + tag in candidates:
+			raise web.HTTPNotModified(headers={'ETag': tag})
+
+	@staticmethod
+	async def stream_json(request, batches, to_json, *, headers=None):
+		"""send an async generator of lists of rows as one JSON array, converting each row with to_json,
+		without buffering all of them. Each batch is written before the next one is fetched,
+		so batches should release their connection in between rather than hold it while a slow client reads.
+		"""
+		def join(batch):
+			return ','.join(dumps(to_json(row)) for row in batch)
+
+		try:
+			# get the first batch before we commit to a 200 OK so that errors raised up front (e.g. permissions)
+			# can still be sent as error responses
+			batch = await batches.__anext__()
+			if not batch:
+				return web.json_response([], headers=headers)
+
+			response = web.StreamResponse(headers=headers)
+			response.content_type = 'application/json'
+			await response.prepare(request)
+
+			await response.write(('[' + join(batch)).encode())
+			async for batch in batches:
+				if batch:
+					await response.write((',' + join(batch)).encode())
+			await response.write(b']')
+			await response.write_eof()
+			return response
+		except StopAsyncIteration:
+			return web.json_response([], headers=headers)
+		finally:
+			# if the client went away in the middle, don't leave the rest of the generator to the garbage collector
+			await batches.aclose()
+
+def setup(bot):
+	if bot.config.get('api', {}).get('server'):
+		bot.add_cog(APIServer(bot))
@@ -14,6 +14,7 @@
 # along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import contextlib
 import re
 import functools
 import operator
@@ -76,7 +77,7 @@ class MessageBinding(commands.Cog, name='Message Binding'):
 		If a binding already exists for the given message, it will be updated.
 		"""
 		if isinstance(target, discord.TextChannel):
-			async with self.bot.pool.acquire() as conn, conn.transaction():
+			async with self.bot.pool.acquire() as conn:
 				connection.set(conn)
 				# I really don't like this design as it requires me to look up the page by title three times
 				# Probably some more thought has to go into the separation of concerns between
@@ -84,18 +85,25 @@ class MessageBinding(commands.Cog, name='Message Binding'):
 				await self.wiki_db.check_permissions(ctx.author, Permissions.manage_bindings, title)
 				page = await self.wiki_db.get_page(ctx.author, title)
 
-				try:
-					message = await target.send(page.content)
-				except discord.Forbidden:
-					raise commands.UserInputError("I can't send messages to that channel.")
+			# the connection is released first so that it isn't held while we wait on Discord
+			try:
+				message = await target.send(page.content)
+			except discord.Forbidden:
+				raise commands.UserInputError("I can't send messages to that channel.")
 
-				await self.db.bind(ctx.author, message, title, check_permissions=False)
+			try:
+				# this checks the permissions again, in case they changed while the message was being sent
+				await self.db.bind(ctx.author, message, title)
+			except:
+				with contextlib.suppress(discord.HTTPException):
+					await message.delete()
+				raise
 		else:
 			page = await self.db.bind(ctx.author, target, title)
 			try:
 				await target.edit(content=page.content)
 			except discord.Forbidden:
-				raise commands.UserInput("I can't edit that message.")
+				raise commands.UserInputError("I can't edit that message.")
 
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
 
@@ -22,19 +22,34 @@ from discord.ext import commands
 from bot_bin.sql import connection, optional_connection
 
 from ..wiki.db import Permissions
-from ...utils import AttrDict, errors
+from ...utils import errors
+from ...utils.workload import workload
 
 logger = logging.getLogger(__name__)
 
 class MessageBindingDatabase(commands.Cog):
+	# the background duty of keeping bound messages up to date, done by one process per shard
+	DUTY = 'binding sync'
+
 	def __init__(self, bot):
 		self.bot = bot
 		self.wiki_db = bot.cogs['WikiDatabase']
 		self.queries = bot.queries('binding.sql')
+		self.bot.leader_election.register(self.DUTY)
+
+	def cog_unload(self):
+		self.bot.loop.create_task(self.bot.leader_election.unregister(self.DUTY))
 
 	@commands.Cog.listener()
+	@workload('background')
 	async def on_cm_page_edit(self, revision_id):
+		if not self.bot.leader_election.is_leader(self.DUTY):
+			return
+
 		async with self.bot.pool.acquire() as conn, conn.transaction():
+			# otherwise each query below would acquire a connection of its own while this one is held,
+			# which deadlocks once enough pages are edited at once to use up the pool
+			connection.set(conn)
 			try:
 				revision = await self.get_revision(revision_id)
 			except ValueError:
@@ -58,7 +73,11 @@ class MessageBindingDatabase(commands.Cog):
 		await asyncio.gather(*coros)
 
 	@commands.Cog.listener()
+	@workload('background')
 	async def on_cm_page_delete(self, guild_id, page_id, title):
+		if not self.bot.leader_election.is_leader(self.DUTY):
+			return
+
 		if not self.bot.get_guild(guild_id):
 			logger.error(
 				'on_cm_page_delete: page %r (ID %s) is part of guild ID %s, which we are not in!',
@@ -67,6 +86,7 @@ class MessageBindingDatabase(commands.Cog):
 			return
 
 		async with self.bot.pool.acquire() as conn, conn.transaction():
+			connection.set(conn)
 			coros = []
 			async for binding in self._bound_messages(page_id):
 				coros.append(self.bot.http.delete_message(channel_id=binding.channel_id, message_id=binding.message_id))
@@ -76,10 +96,11 @@ class MessageBindingDatabase(commands.Cog):
 
 	@optional_connection
 	async def get_revision(self, revision_id):
-		row = await connection().fetchrow(self.queries.get_revision(), revision_id)
+		query = self.queries.get_revision()
+		row = await connection().fetchrow(query, revision_id)
 		if row is None:
 			raise ValueError('revision_id not found')
-		return AttrDict(row)
+		return query.record(row)
 
 	@optional_connection
 	async def bound_messages(self, member, title):
@@ -91,16 +112,18 @@ class MessageBindingDatabase(commands.Cog):
 	@optional_connection
 	async def _bound_messages(self, page_id):
 		async with connection().transaction():
-			async for row in connection().cursor(self.queries.bound_messages(), page_id):
-				yield AttrDict(row)
+			query = self.queries.bound_messages()
+			async for row in connection().cursor(query, page_id):
+				yield query.record(row)
 
 	@optional_connection
 	async def guild_bindings(self, member):
 		"""Return all bound messages for guild_id."""
 		async with connection().transaction():
 			await self.wiki_db.check_permissions(member, Permissions.view)
-			async for row in connection().cursor(self.queries.guild_bindings(), member.guild.id):
-				yield AttrDict(row)
+			query = self.queries.guild_bindings()
+			async for row in connection().cursor(query, member.guild.id):
+				yield query.record(row)
 
 	@optional_connection
 	async def bind(self, member, message: discord.Message, title, *, check_permissions=True):
@@ -109,17 +132,15 @@ class MessageBindingDatabase(commands.Cog):
 			if check_permissions:
 				await self.wiki_db.check_permissions(member, Permissions.manage_bindings, title)
 			await connection().execute(self.queries.bind(), message.channel.id, message.id, page.page_id)
-		binding = page
-		binding.channel_id = message.channel.id
-		binding.message_id = message.id
-		return binding
+		return page
 
 	@optional_connection
 	async def get_bound_page(self, message: discord.Message):
-		row = await connection().fetchrow(self.queries.get_bound_page(), message.id)
+		query = self.queries.get_bound_page()
+		row = await connection().fetchrow(query, message.id)
 		if row is None:
 			raise errors.BindingNotFoundError
-		return AttrDict(row)
+		return query.record(row)
 
 	@optional_connection
 	async def unbind(self, member, message: discord.Message):
@@ -0,0 +1,65 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+from discord.ext import commands
+
+from ..utils.databases import DatabaseRouter
+
+class Databases(commands.Cog, command_attrs=dict(hidden=True)):
+	"""Owner only commands for guilds spread across several databases (see utils.databases)."""
+
+	def __init__(self, bot):
+		self.bot = bot
+
+	async def cog_check(self, ctx):
+		if not await self.bot.is_owner(ctx.author):
+			raise commands.NotOwner
+		if not isinstance(self.bot.pool, DatabaseRouter):
+			raise commands.CheckFailure('Guilds are not spread across several databases. Set databases to do so.')
+		return True
+
+	@commands.group(name='databases', invoke_without_command=True)
+	async def databases_command(self, ctx):
+		"""Show how many guilds are on each database."""
+		counts = await self.bot.pool.guild_counts()
+		width = max(len(name) for name in ['database', *counts])
+		lines = [f'{"database":<{width}} {"guilds":>8} {"moving":>6}']
+		for name, (guilds, frozen) in sorted(counts.items()):
+			lines.append(f'{name:<{width}} {guilds:>8} {frozen:>6}')
+		if ctx.guild is not None:
+			lines.append(f'\nthis server is on {await self.bot.pool.database_of(ctx.guild.id)}')
+
+		await ctx.send('```\n' + '\n'.join(lines) + '```')
+
+	@databases_command.command(name='move')
+	async def move_command(self, ctx, guild_id: int, database):
+		"""Move a server's pages to another database. Their pages can't be changed until it's done."""
+		guild = self.bot.get_guild(guild_id)
+		if guild is None:
+			# its role permissions can only be found by the IDs of its roles
+			raise commands.BadArgument(
+				'I am not in that server, or it is on a shard that this process does not run. '
+				'Run this command on the process that runs it.')
+
+		async with ctx.typing():
+			try:
+				copied = await self.bot.pool.move_guild(guild_id, database, role_ids=[role.id for role in guild.roles])
+			except ValueError as exc:
+				raise commands.BadArgument(str(exc))
+
+		await ctx.send(f'Moved {guild.name} to {database} ({copied} rows).')
+
+def setup(bot):
+	bot.add_cog(Databases(bot))
@@ -0,0 +1,351 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import json
+import logging
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+from ..utils.metrics import exposition
+from ..utils.paginator import TextPages
+from ..utils.profiler import MAX_DURATION, SamplingProfiler
+from ..utils.sql import pool_saturation, pool_stats, query_stats, replica_router, retry_stats, slow_query_log
+
+logger = logging.getLogger(__name__)
+
+class Diagnostics(commands.Cog, command_attrs=dict(hidden=True)):
+	"""Owner only commands for finding out why the bot is slow, and an optional Prometheus metrics endpoint."""
+
+	QUERY_STATS_SORT_KEYS = {
+		'total': lambda s: s.latency.sum,
+		'calls': lambda s: s.calls,
+		'mean': lambda s: s.latency.mean,
+		'p99': lambda s: s.latency.quantile(0.99),
+		'errors': lambda s: s.errors,
+		'conflicts': lambda s: s.conflicts,
+		'rows': lambda s: s.rows,
+	}
+
+	POOL_STATS_SORT_KEYS = {
+		'total': lambda s: s.hold.sum,
+		'max': lambda s: s.max_hold,
+		'p99': lambda s: min(s.hold.quantile(0.99), s.max_hold),
+		'wait': lambda s: s.acquire_wait.quantile(0.99),
+		'http': lambda s: s.http_requests,
+		'acquires': lambda s: s.acquires,
+	}
+
+	def __init__(self, bot):
+		self.bot = bot
+		# each of these returns some metric families in the Prometheus text format
+		self.collectors = [
+			query_stats.prometheus, pool_stats.prometheus, pool_saturation.prometheus, self.bot.loop_monitor.prometheus,
+			self.bot.leader_election.prometheus, replica_router.prometheus, retry_stats.prometheus, self.ratelimit_metrics]
+		self.runner = None
+		self.profiler = None
+		if self.bot.config.get('metrics'):
+			self.bot.loop.create_task(self.start_metrics_server())
+
+	def cog_unload(self):
+		if self.runner is not None:
+			self.bot.loop.create_task(self.runner.cleanup())
+		if self.profiler is not None:
+			self.profiler.stop()
+
+	async def cog_check(self, ctx):
+		if not await self.bot.is_owner(ctx.author):
+			raise commands.NotOwner
+		return True
+
+	@commands.group(name='querystats', invoke_without_command=True)
+	async def query_stats_command(self, ctx, sort_by='total'):
+		"""Show statistics for each SQL macro since the bot started or the stats were reset.
+
+		The conflicts column counts errors caused by concurrent transactions, which are retried by the callers that can be.
+		Sort by one of: total, calls, mean, p99, errors, conflicts, rows.
+		"""
+		try:
+			key = self.QUERY_STATS_SORT_KEYS[sort_by]
+		except KeyError:
+			raise commands.BadArgument(f'Invalid sort key. Try one of these: {", ".join(self.QUERY_STATS_SORT_KEYS)}.')
+
+		stats = sorted(query_stats, key=lambda item: key(item[1]), reverse=True)
+		if not stats:
+			await ctx.send('No queries have been run yet.')
+			return
+
+		width = max(len(name) for name, s in stats)
+		lines = [
+			f'{"query":<{width}} {"calls":>7} {"errors":>6} {"conflicts":>9} {"rows":>8}'
+			f' {"mean":>8} {"p95":>8} {"p99":>8} {"total":>8}']
+		for name, s in stats:
+			lines.append(
+				f'{name:<{width}} {s.calls:>7} {s.errors:>6} {s.conflicts:>9} {s.rows:>8}'
+				f' {s.latency.mean * 1000:>6.1f}ms'
+				f' {s.latency.quantile(0.95) * 1000:>6.1f}ms'
+				f' {s.latency.quantile(0.99) * 1000:>6.1f}ms'
+				f' {s.latency.sum:>7.1f}s')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@query_stats_command.command(name='reset')
+	async def query_stats_reset(self, ctx):
+		"""Forget all query statistics gathered so far."""
+		query_stats.clear()
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
+	@commands.command(name='slowqueries')
+	async def slow_queries_command(self, ctx):
+		"""List recent queries that took longer than the slow query threshold."""
+		if slow_query_log.threshold is None:
+			await ctx.send('The slow query log is disabled. Set slow_queries in the config file to enable it.')
+			return
+
+		queries = list(slow_query_log)[::-1]
+		if not queries:
+			await ctx.send('No slow queries have been logged yet.')
+			return
+
+		width = max(len(query.name) for query in queries)
+		lines = [f'{"id":>6} {"query":<{width}} {"duration":>10} {"plan":<4} at']
+		for query in queries:
+			lines.append(
+				f'{query.id:>6} {query.name:<{width}} {query.duration * 1000:>8.1f}ms'
+				f' {"yes" if query.plan is not None else "":<4} {query.at:%Y-%m-%d %H:%M:%S}')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@commands.command(name='slowquery')
+	async def slow_query_command(self, ctx, query_id: int):
+		"""Show the parameters and, if it was sampled, the plan of one of the queries listed by slowqueries."""
+		query = slow_query_log.get(query_id)
+		if query is None:
+			raise commands.BadArgument('No slow query with that ID was found. It may have been pushed out by newer ones.')
+
+		text = (
+			f'{query.name} took {query.duration * 1000:.1f}ms at {query.at:%Y-%m-%d %H:%M:%S}\n'
+			f'parameters: {", ".join(query.params) or "none"}\n\n'
+			f'{query.plan or "This query was not sampled for EXPLAIN, or its EXPLAIN has not finished yet."}')
+		await TextPages(ctx, text).begin()
+
+	@commands.group(name='poolstats', invoke_without_command=True)
+	async def pool_stats_command(self, ctx, sort_by='total'):
+		"""Show how long each call site waited for and held pooled connections.
+
+		The http column counts Discord API requests made while the connection was held; ideally it is always 0.
+		Sort by one of: total, max, p99, wait, http, acquires.
+		"""
+		try:
+			key = self.POOL_STATS_SORT_KEYS[sort_by]
+		except KeyError:
+			raise commands.BadArgument(f'Invalid sort key. Try one of these: {", ".join(self.POOL_STATS_SORT_KEYS)}.')
+
+		stats = sorted(pool_stats, key=lambda item: key(item[1]), reverse=True)
+		if not stats:
+			await ctx.send('No connections have been acquired yet.')
+			return
+
+		width = max(len(call_site) for call_site, s in stats)
+		lines = [
+			f'{"call site":<{width}} {"acquires":>8} {"wait p99":>9} {"hold p99":>9} {"max hold":>9} {"total":>8} {"http":>5}']
+		for call_site, s in stats:
+			lines.append(
+				f'{call_site:<{width}} {s.acquires:>8}'
+				f' {s.acquire_wait.quantile(0.99) * 1000:>7.1f}ms'
+				# the quantile is interpolated within a histogram bucket, so it can overshoot the true maximum
+				f' {min(s.hold.quantile(0.99), s.max_hold) * 1000:>7.1f}ms'
+				f' {s.max_hold * 1000:>7.1f}ms'
+				f' {s.hold.sum:>7.1f}s'
+				f' {s.http_requests:>5}')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@pool_stats_command.command(name='reset')
+	async def pool_stats_reset(self, ctx):
+		"""Forget all connection pool statistics gathered so far."""
+		pool_stats.clear()
+		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
+
+	@commands.command(name='pools')
+	async def pools_command(self, ctx):
+		"""Show how full each connection pool is right now."""
+		pools = list(pool_saturation)
+		width = max(len(pool.name) for pool in pools)
+		lines = [f'{"database":<{width}} {"workload":<11} {"in use":>6} {"idle":>4} {"max":>4} {"waiting":>7} {"timeouts":>8}']
+		for pool in pools:
+			lines.append(
+				f'{pool.name:<{width}} {pool.workload:<11} {pool.in_use():>6} {pool.get_idle_size():>4}'
+				f' {pool.get_max_size():>4} {pool.waiting:>7} {pool.acquire_timeouts:>8}')
+
+		await ctx.send('```\n' + '\n'.join(lines) + '```')
+
+	@commands.command(name='traces')
+	async def traces_command(self, ctx):
+		"""List the slowest recent command invocations that were traced."""
+		traces = self.bot.tracer.slowest()
+		if not traces:
+			await ctx.send('No slow commands have been traced yet.')
+			return
+
+		width = max(len(trace.name) for trace in traces)
+		lines = [f'{"id":>6} {"command":<{width}} {"duration":>10} started']
+		for trace in traces:
+			lines.append(
+				f'{trace.id:>6} {trace.name:<{width}} {trace.duration * 1000:>8.1f}ms'
+				f' {trace.started_at:%Y-%m-%d %H:%M:%S}')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@commands.command(name='trace')
+	async def trace_command(self, ctx, trace_id: int, format='tree'):
+		"""Show one of the traces listed by the traces command.
+
+		Format may be "tree" to show it here, or "json" to upload it as a file.
+		"""
+		trace = self.bot.tracer.get(trace_id)
+		if trace is None:
+			raise commands.BadArgument('No trace with that ID was found. It may have been pushed out by newer traces.')
+
+		if format == 'tree':
+			await TextPages(ctx, trace.format_tree()).begin()
+		elif format == 'json':
+			data = json.dumps(trace.to_dict(), indent=2).encode()
+			await ctx.send(file=discord.File(io.BytesIO(data), f'trace-{trace.id}.json'))
+		else:
+			raise commands.BadArgument('Format must be "tree" or "json".')
+
+	@commands.command(name='lag')
+	async def lag_command(self, ctx, block_id: int = None):
+		"""Show event loop lag and the recent times the loop was blocked.
+
+		Pass the ID of one of those times to see the stack of the code that was blocking the loop.
+		"""
+		monitor = self.bot.loop_monitor
+		if block_id is not None:
+			block = monitor.get(block_id)
+			if block is None:
+				raise commands.BadArgument('No block with that ID was found. It may have been pushed out by newer ones.')
+			duration = f'{block.duration * 1000:.1f}ms' if block.duration is not None else 'so far'
+			await TextPages(ctx, f'Blocked for {duration} in {block.task}:\n{block.stack}').begin()
+			return
+
+		lines = [
+			f'lag: p50 {monitor.lag.quantile(0.5) * 1000:.1f}ms, p99 {monitor.lag.quantile(0.99) * 1000:.1f}ms,'
+			f' max {monitor.max_lag * 1000:.1f}ms over {monitor.lag.count} heartbeats',
+			f'blocked for over {monitor.threshold * 1000:.0f}ms {monitor.blocks_total} times',
+		]
+		if monitor.blocks:
+			width = max(len(block.task) for block in monitor.blocks)
+			lines.append('')
+			lines.append(f'{"id":>6} {"task":<{width}} {"duration":>10} at')
+			for block in reversed(monitor.blocks):
+				duration = f'{block.duration * 1000:>8.1f}ms' if block.duration is not None else f'{"ongoing":>10}'
+				lines.append(f'{block.id:>6} {block.task:<{width}} {duration} {block.at:%Y-%m-%d %H:%M:%S}')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@commands.command(name='leaders')
+	async def leaders_command(self, ctx):
+		"""Show which process is doing each background duty for this process' shards."""
+		election = self.bot.leader_election
+		if not election.duties:
+			await ctx.send('No background duties have been registered.')
+			return
+
+		# the locks are taken on the home database
+		async with self.bot.home_pool.acquire() as conn:
+			owners = await election.owners(conn)
+
+		width = max(len(name) for name in election.duties)
+		lines = [f'scope: {election.scope}', f'this process: {election.identity}', '']
+		lines.append(f'{"duty":<{width}} {"here":<4} {"since":<19} owner')
+		for name, duty in sorted(election.duties.items()):
+			since = f'{duty.since:%Y-%m-%d %H:%M:%S}' if election.is_leader(name) else ''
+			try:
+				application_name, pid, _ = owners[name]
+			except KeyError:
+				owner = 'nobody'
+			else:
+				owner = f'{application_name or "unknown"} (backend pid {pid})'
+			lines.append(f'{name:<{width}} {"yes" if election.is_leader(name) else "no":<4} {since:<19} {owner}')
+
+		await TextPages(ctx, '\n'.join(lines)).begin()
+
+	@commands.command(name='profile')
+	async def profile_command(self, ctx, seconds: float = 10, mode='wall', format='speedscope'):
+		"""Record which code the bot spends its time in for some seconds, and upload the profile.
+
+		Mode is "wall" to count time spent waiting as well, or "cpu" to only count time spent running code.
+		Format is "speedscope" (open it at https://www.speedscope.app) or "collapsed" (for flamegraph.pl).
+		"""
+		if self.profiler is not None:
+			raise commands.BadArgument('A profile is already being recorded.')
+		if not 0 < seconds <= MAX_DURATION:
+			raise commands.BadArgument(f'The duration must be between 0 and {MAX_DURATION} seconds.')
+		if format not in ('speedscope', 'collapsed'):
+			raise commands.BadArgument('Format must be "speedscope" or "collapsed".')
+		try:
+			profiler = SamplingProfiler(self.bot.loop, mode=mode)
+		except ValueError as exc:
+			raise commands.BadArgument(str(exc))
+
+		self.profiler = profiler
+		profiler.start()
+		async with ctx.typing():
+			try:
+				await asyncio.sleep(seconds)
+			finally:
+				profile = profiler.stop()
+				self.profiler = None
+
+		if format == 'speedscope':
+			data, filename = json.dumps(profile.speedscope()).encode(), f'profile-{mode}.speedscope.json'
+		else:
+			data, filename = profile.collapsed().encode(), f'profile-{mode}.txt'
+		await ctx.send(
+			f'{profile.samples} samples over {seconds:g} seconds.',
+			file=discord.File(io.BytesIO(data), filename))
+
+	## Metrics
+
+	def ratelimit_metrics(self):
+		return exposition(
+			'cm_ratelimit_rejections_total', 'counter', 'Requests rejected by a rate limit, by kind and scope.',
+			(
+				('cm_ratelimit_rejections_total', {'kind': kind, 'scope': scope}, count)
+				for (kind, scope), count in sorted(self.bot.ratelimiter.rejections.items())))
+
+	def prometheus(self):
+		return ''.join(collector() for collector in self.collectors)
+
+	async def start_metrics_server(self):
+		config = self.bot.config['metrics']
+		app = web.Application()
+		app.add_routes([web.get('/metrics', self.metrics_handler)])
+		self.runner = web.AppRunner(app)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, config.get('host', '127.0.0.1'), config.get('port', 9090))
+		await site.start()
+		logger.info('metrics server listening on %s', site.name)
+
+	async def metrics_handler(self, request):
+		return web.Response(text=self.prometheus(), content_type='text/plain', headers={'X-Content-Type-Options': 'nosniff'})
+
+def setup(bot):
+	bot.add_cog(Diagnostics(bot))
@@ -23,6 +23,9 @@ from bot_bin.sql import connection, optional_connection
 from discord.ext import commands
 
 from ...utils import errors
+from ...utils.databases import guild_scope
+from ...utils.tracing import traced
+from ...utils.workload import workload
 
 class Permissions(enum.Flag):
 	# this class is the single source of truth for the permissions values
@@ -66,9 +69,12 @@ class PermissionsDatabase(commands.Cog):
 		self.queries = self.bot.queries('permissions.sql')
 
 	@commands.Cog.listener()
+	@workload('background')
 	async def on_guild_role_delete(self, role):
-		await self.delete_role_permissions(role)
+		with guild_scope(role.guild.id):
+			await self.delete_role_permissions(role)
 
+	@traced()
 	@optional_connection
 	async def permissions_for(self, member: discord.Member, title):
 		role_ids = [role.id for role in member.roles if role != member.guild.default_role]
@@ -81,6 +87,7 @@ class PermissionsDatabase(commands.Cog):
 
 		return Permissions(perms)
 
+	@traced()
 	@optional_connection
 	async def member_permissions(self, member: discord.Member):
 		roles = [role.id for role in member.roles]
@@ -183,7 +190,7 @@ class PermissionsDatabase(commands.Cog):
 		deny_perms: Permissions = Permissions.none
 	):
 		"""set the allowed, denied, or both permissions for a particular page and entity (role or member)"""
-		if new_allow_perms & new_deny_perms != Permissions.none:
+		if allow_perms & deny_perms != Permissions.none:
 			# don't allow someone to both deny and allow a permission
 			raise ValueError('allowed and denied permissions must not intersect')
 
@@ -239,6 +246,7 @@ class PermissionsDatabase(commands.Cog):
 			self.queries.unset_page_permissions(),
 			member.guild.id, title, entity_id, perms.value) or (None, None)))
 
+	@traced()
 	@optional_connection
 	async def check_permissions(self, member, role):
 		if await self.bot.is_privileged(member):
@@ -250,6 +258,7 @@ class PermissionsDatabase(commands.Cog):
 
 		raise errors.MissingPagePermissionsError(Permissions.manage_permissions)
 
+	@traced()
 	@optional_connection
 	async def check_permissions_for(self, member, title):
 		"""raise if the member doesn't have Manage Permissions for this page"""
@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
 
-from bot_bin.sql import connection, optional_connection
+from bot_bin.sql import connection
 from discord.ext import commands
 
 from ...utils.paginator import Pages
@@ -38,10 +38,10 @@ class WatchLists(commands.Cog, name='Watch Lists'):
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
 
 	@commands.command()
-	@optional_connection
 	async def unwatch(self, ctx, *, title: clean_content):
 		"""Removes a page from your watch list."""
-		async with connection().transaction():
+		async with self.bot.pool.acquire() as conn, conn.transaction():
+			connection.set(conn)
 			await self.wiki_db.get_page(ctx.author, title, partial=True, check_permissions=False)
 			await self.db.unwatch_page(ctx.author, title)
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
@@ -24,83 +24,110 @@ from bot_bin.sql import connection, optional_connection
 
 from ..permissions.db import Permissions
 from ... import utils
-from ...utils import AttrDict, errors
+from ...utils import errors
+from ...utils.workload import workload
 
 logger = logging.getLogger(__name__)
 
 class WatchListsDatabase(commands.Cog):
 	NOTIFICATION_EMBED_COLOR = discord.Color.from_hsv(262/360, 55/100, 76/100)
+	# the background duty of sending notifications, done by one process per shard so that nobody gets them twice
+	DUTY = 'watch list notifications'
 
 	def __init__(self, bot):
 		self.bot = bot
 		self.wiki_commands = self.bot.cogs['Wiki']
 		self.wiki_db = self.bot.cogs['WikiDatabase']
 		self.queries = self.bot.queries('watch_lists.sql')
+		self.bot.leader_election.register(self.DUTY)
+
+	def cog_unload(self):
+		self.bot.loop.create_task(self.bot.leader_election.unregister(self.DUTY))
 
 	@commands.Cog.listener()
-	@optional_connection
+	@workload('background')
 	async def on_cm_page_edit(self, revision_id):
-		async with connection().transaction():
-			old, new = await self.get_revision_and_previous(revision_id)
-			guild = self.bot.get_guild(new.guild_id)
-			if guild is None:
-				logger.warning(f'on_cm_page_edit: guild_id {new.guild_id} not found!')
-				return
-
-			async def send(user_id):
-				# editing a page you subscribe to should not notify yourself
-				if user_id == new.author_id:
-					return
+		if not self.bot.leader_election.is_leader(self.DUTY):
+			return
 
-				try:
-					recipient = await utils.fetch_member(guild, user_id)
-				except discord.NotFound:
-					return
+		async with self.bot.pool.acquire() as conn, conn.transaction():
+			connection.set(conn)
+			old, new = await self.get_revision_and_previous(revision_id)
+			subscribers = await self.page_subscribers(new.page_id)
 
-				try:
-					await self.wiki_db.check_permissions(recipient, Permissions.view, new.current_title)
-				except errors.MissingPagePermissionsError:
-					return
+		guild = self.bot.get_guild(new.guild_id)
+		if guild is None:
+			logger.warning(f'on_cm_page_edit: guild_id {new.guild_id} not found!')
+			return
 
-				with contextlib.suppress(discord.NotFound):
-					new.author = await utils.fetch_member(guild, new.author_id)
+		# editing a page you subscribe to should not notify yourself
+		subscribers = [user_id for user_id in subscribers if user_id != new.author_id]
+		if not subscribers:
+			return
 
-				with contextlib.suppress(discord.NotFound):
-					old.author = await utils.fetch_member(guild, old.author_id)
+		# fetching members may take a request to Discord for each one, so no connection is held while it happens
+		recipients = await self.fetch_members(guild, subscribers)
+		async with self.bot.pool.acquire() as conn:
+			connection.set(conn)
+			recipients = [recipient for recipient in recipients if await self.can_view(recipient, new.current_title)]
+		if not recipients:
+			return
 
-				await recipient.send(embed=self.page_edit_notification(recipient, old, new))
+		new.author, old.author = await self.fetch_members(guild, [new.author_id, old.author_id], keep_missing=True)
 
-			await asyncio.gather(*map(send, await self.page_subscribers(new.page_id)))
+		# the diff is the same for everyone, so it is only computed once
+		embed = await self.page_edit_notification(guild, old, new)
+		await asyncio.gather(*(recipient.send(embed=embed) for recipient in recipients))
 
 	@commands.Cog.listener()
-	@optional_connection
+	@workload('background')
 	async def on_cm_page_delete(self, guild_id, page_id, title):
+		if not self.bot.leader_election.is_leader(self.DUTY):
+			return
+
 		guild = self.bot.get_guild(guild_id)
 		if guild is None:
 			logger.warning(f'on_cm_page_delete: guild_id {guild_id} not found!')
 			return
 
-		async def send(user_id):
-			try:
-				member = await utils.fetch_member(guild, user_id)
-			except discord.NotFound:
-				return
+		async with self.bot.pool.acquire() as conn, conn.transaction():
+			connection.set(conn)
+			subscribers = await self.page_subscribers(page_id)
+			await self.delete_page_subscribers(page_id)
 
-			await member.send(embed=self.page_delete_notification(guild, title))
+		recipients = await self.fetch_members(guild, subscribers)
+		await asyncio.gather(*(
+			recipient.send(embed=self.page_delete_notification(guild, title))
+			for recipient in recipients))
 
-		await asyncio.gather(*map(send, await self.page_subscribers(page_id)))
-		await self.delete_page_subscribers(page_id)
+	async def fetch_members(self, guild, user_ids, *, keep_missing=False):
+		"""Fetch several members concurrently.
+		Members who have left the guild are left out, or replaced with None if keep_missing is True.
+		"""
+		async def fetch(user_id):
+			with contextlib.suppress(discord.NotFound):
+				return await utils.fetch_member(guild, user_id)
+
+		members = await asyncio.gather(*map(fetch, user_ids))
+		return members if keep_missing else [member for member in members if member is not None]
+
+	async def can_view(self, member, title):
+		try:
+			await self.wiki_db.check_permissions(member, Permissions.view, title)
+		except errors.MissingPagePermissionsError:
+			return False
+		return True
 
-	def page_edit_notification(self, recipient, old, new):
+	async def page_edit_notification(self, guild, old, new):
 		embed = discord.Embed()
-		embed.title = f'Page “{new.current_title}” was edited in server {recipient.guild}'
+		embed.title = f'Page “{new.current_title}” was edited in server {guild}'
 		embed.color = self.NOTIFICATION_EMBED_COLOR
 		embed.set_footer(text='Edited')
 		embed.timestamp = new.revised
 		if new.author is not None:
 			embed.set_author(name=new.author.name, icon_url=new.author.avatar_url_as(static_format='png', size=64))
 		try:
-			embed.description = self.wiki_commands.diff(old, new)
+			embed.description = await self.wiki_commands.diff(old, new)
 		except commands.UserInputError as exc:
 			embed.description = str(exc)
 		return embed
@@ -148,8 +175,8 @@ class WatchListsDatabase(commands.Cog):
 
 	@optional_connection
 	async def get_revision_and_previous(self, revision_id):
-		rows = list(map(AttrDict, await connection().fetch(self.queries.get_revision_and_previous(), revision_id)))
-		for row in rows: row.author = None
+		query = self.queries.get_revision_and_previous()
+		rows = query.records(await connection().fetch(query, revision_id))
 		if len(rows) == 1: rows.append(None)
 		return rows[::-1]  # old to new
 
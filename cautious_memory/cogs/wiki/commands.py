@@ -16,9 +16,7 @@
 import asyncio
 import contextlib
 import datetime
-import difflib
 import io
-import re
 import typing
 
 import discord
@@ -28,8 +26,9 @@ from discord.ext import commands
 
 from ..permissions.db import Permissions
 from ... import utils
-from ...utils import errors
-from ...utils.paginator import Pages, TextPages
+from ...utils import errors, ratelimit, text
+from ...utils.diff import word_diff
+from ...utils.paginator import KeysetPages, Pages, TextPages
 
 # if someone names a page with an @mention, we should use the username of that user
 # instead of a nickname, because pages are usually longer-lived than nicknames
@@ -51,10 +50,15 @@ class RevisionID(commands.Converter):
 		return self
 
 class Wiki(commands.Cog):
+	# the maximum number of revision pairs to keep diffs of
+	DIFF_CACHE_SIZE = 1000
+
 	def __init__(self, bot):
 		self.bot = bot
 		self.db = self.bot.cogs['WikiDatabase']
 		self.permissions_db = self.bot.cogs['PermissionsDatabase']
+		# maps (old revision ID, new revision ID) to the diff of their content, least recently used first
+		self.diff_cache = {}
 
 	def cog_check(self, ctx):
 		if not ctx.guild:
@@ -100,54 +104,52 @@ class Wiki(commands.Cog):
 		cutoff = datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 		e = discord.Embed(title='Page stats')
 		# no transaction because maybe doing a lot of COUNTing would require table wide locks
-		# to maintain consistency (dunno, just a hunch)
-		async with self.bot.pool.acquire() as conn:
-			connection.set(conn)
-			page_count = await self.db.page_count(ctx.guild.id)
-			revisions_count = await self.db.revisions_count(ctx.guild.id)
-			total_page_uses = await self.db.total_page_uses(ctx.guild.id, cutoff=cutoff)
-			e.description = f'{page_count} pages, {revisions_count} revisions, {total_page_uses} recent page uses'
+		# to maintain consistency (dunno, just a hunch).
+		# each of these acquires a connection of its own from the analytics pool.
+		page_count = await self.db.page_count(ctx.guild.id)
+		revisions_count = await self.db.revisions_count(ctx.guild.id)
+		total_page_uses = await self.db.total_page_uses(ctx.guild.id, cutoff=cutoff)
+		e.description = f'{page_count} pages, {revisions_count} revisions, {total_page_uses} recent page uses'
 
-			first_place = ord('🥇')
+		first_place = ord('🥇')
 
-			top_pages = await self.db.top_pages(ctx.guild.id, cutoff=cutoff)
-			if top_pages:
-				value = '\n'.join(
-					f'{chr(first_place + i)} {page.title} ({page.count} recent uses)'
-					for i, page in enumerate(top_pages))
-			else:
-				value = 'No recent page uses.'
+		top_pages = await self.db.top_pages(ctx.guild.id, cutoff=cutoff)
+		if top_pages:
+			value = '\n'.join(
+				f'{chr(first_place + i)} {page.title} ({page.count} recent uses)'
+				for i, page in enumerate(top_pages))
+		else:
+			value = 'No recent page uses.'
 
-			e.add_field(name='Top pages', inline=False, value=value)
+		e.add_field(name='Top pages', inline=False, value=value)
 
-			top_editors = await self.db.top_editors(ctx.guild.id, cutoff=cutoff)
-			if top_editors:
-				value = '\n'.join(
-					f'{chr(first_place + i)} <@{editor.id}> ({editor.count} revisions)'
-					for i, editor in enumerate(top_editors))
-			else:
-				value = 'No recent page edits.'
+		top_editors = await self.db.top_editors(ctx.guild.id, cutoff=cutoff)
+		if top_editors:
+			value = '\n'.join(
+				f'{chr(first_place + i)} <@{editor.id}> ({editor.count} revisions)'
+				for i, editor in enumerate(top_editors))
+		else:
+			value = 'No recent page edits.'
 
-			e.add_field(name='Top editors', inline=False, value=value)
+		e.add_field(name='Top editors', inline=False, value=value)
 
 		await ctx.send(embed=e)
 
 	async def page_stats(self, ctx, title):
 		cutoff = datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 
-		e = discord.Embed(title=f'Stats for “{title}”')
-		async with self.bot.pool.acquire() as conn:
-			connection.set(conn)
-			page = await self.db.get_page(ctx.author, title, partial=True)
-			if page.alias:  # TODO try and defer this HTTP call till after conn is closed
-				await ctx.send(f'That page is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.original}.')
-				return
+		# get_page releases its connection before the stats are counted,
+		# each of which acquires a connection of its own from the analytics pool, like guild_stats
+		page = await self.db.get_page(ctx.author, title, partial=True)
+		if page.alias:
+			raise commands.UserInputError(
+				f'That page is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.original_title}.')
 
-			top_editors = await self.db.top_page_editors(ctx.guild.id, title)
-			revisions_count = await self.db.page_revisions_count(ctx.guild.id, title)
-			usage_count = await self.db.page_uses(ctx.guild.id, title, cutoff=cutoff)
+		top_editors = await self.db.top_page_editors(ctx.guild.id, title)
+		revisions_count = await self.db.page_revisions_count(ctx.guild.id, title)
+		usage_count = await self.db.page_uses(ctx.guild.id, title, cutoff=cutoff)
 
-		e = discord.Embed(title=f'Stats for {page.original}')
+		e = discord.Embed(title=f'Stats for {page.original_title}')
 		e.description = f'{revisions_count} all time revisions, {usage_count} recent uses'
 
 		first_place = ord('🥇')
@@ -157,9 +159,6 @@ class Wiki(commands.Cog):
 
 		await ctx.send(embed=e)
 
-	emoji_escape_regex = re.compile(r'<a?(:\w+:)\d+>', re.ASCII)
-	emoji_remove_escaped_underscores_regex = re.compile(r':(?:\w|\\_)+:', re.ASCII)
-
 	@commands.command()
 	async def raw(self, ctx, *, title: clean_content):
 		"""Shows the raw contents of a page.
@@ -171,18 +170,12 @@ class Wiki(commands.Cog):
 			page = await self.db.get_page(ctx.author, title)
 			await self.db.log_page_use(ctx.guild.id, title)
 
-		# replace emojis with their names for mobile users, since on android at least, copying a message
-		# with emojis in it copies just the name, not the name and colons
-		# we also don't want the user to see the raw <:name:1234> form because they can't send that directly
-		escaped = self.emoji_escape_regex.sub(r'\1', page.content)
-		if len(escaped) > 2000:
+		escaped, escaped2 = await self.bot.workers.run(text.escape_raw, page.content, size=len(page.content))
+		if escaped2 is None:
 			# in this case we don't want to send the fully escaped version
 			# since there is no markdown in a plaintext file
-			await ctx.send(discord.File(io.StringIO(escaped), page.title + '.md'))
+			await ctx.send(file=discord.File(io.StringIO(escaped), page.title + '.md'))
 		else:
-			# escape_markdown messes up emojis for mobile users
-			escaped2 = self.emoji_remove_escaped_underscores_regex.sub(
-				lambda m: m[0].replace(r'\_', '_'), discord.utils.escape_markdown(escaped))
 			if len(escaped2) > 2000:
 				await ctx.send(file=discord.File(io.StringIO(escaped), page.title + '.md'))
 			await ctx.send(escaped2)
@@ -198,8 +191,8 @@ class Wiki(commands.Cog):
 			page = await self.db.get_page(ctx.author, title)
 			await self.db.log_page_use(ctx.guild.id, title)
 
-		emoji_escaped = self.emoji_escape_regex.sub(r'\1', page.content)
-		code_blocked = utils.code_block(utils.escape_code_blocks(emoji_escaped))
+		emoji_escaped, code_blocked = await self.bot.workers.run(
+			text.code_block_raw, page.content, size=len(page.content))
 		if len(code_blocked) > 2000:
 			await ctx.send(file=discord.File(io.StringIO(emoji_escaped), page.title + '.md'))
 		else:
@@ -213,7 +206,7 @@ class Wiki(commands.Cog):
 			page = await self.db.get_page(ctx.author, title)
 			await self.db.log_page_use(ctx.guild.id, title)
 
-		escaped = self.emoji_escape_regex.sub(r'\1', page.content)
+		escaped = await self.bot.workers.run(text.escape_emojis, page.content, size=len(page.content))
 		await ctx.send(file=discord.File(io.StringIO(escaped), page.title + '.md'))
 
 	@commands.command(aliases=['pages'])
@@ -236,19 +229,21 @@ class Wiki(commands.Cog):
 		cutoff_delta = datetime.timedelta(weeks=2)
 		cutoff = datetime.datetime.utcnow() - cutoff_delta
 
-		entries = []
-		async for revision in self.db.get_recent_revisions(ctx.author, cutoff):
-			with contextlib.suppress(discord.NotFound):
-				revision.author = await utils.fetch_member(ctx.guild, revision.author_id)
-
-			entries.append(self.revision_summary(revision))
+		# the cursor's connection would be held while each author is fetched, so read all the revisions first
+		revisions = [revision async for revision in self.db.get_recent_revisions(ctx.author, cutoff)]
 
-		if not entries:
+		if not revisions:
 			delta = absolute_natural_timedelta(cutoff_delta.total_seconds())
 			await ctx.send(f'No pages have been created or revised within the past {delta}.')
 			return
 
-		await Pages(ctx, entries=entries, numbered=False).begin()
+		async def set_author(revision):
+			with contextlib.suppress(discord.NotFound):
+				revision.author = await utils.fetch_member(ctx.guild, revision.author_id)
+
+		await asyncio.gather(*map(set_author, revisions))
+
+		await Pages(ctx, entries=list(map(self.revision_history_entry, revisions)), numbered=False).begin()
 
 	@commands.command()
 	async def search(self, ctx, *, query):
@@ -276,10 +271,10 @@ class Wiki(commands.Cog):
 		"""Edits an existing wiki page.
 		If the title has spaces, you must surround it in quotes.
 		"""
-		original_title = await self.db.revise_page(ctx.author, title, content)
+		revision = await self.db.revise_page(ctx.author, title, content)
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
-		if original_title is not None:
-			await ctx.send(f'Page “{original_title}” edited successfully.')
+		if revision.is_alias:
+			await ctx.send(f'Page “{revision.title}” edited successfully.')
 
 	@commands.command(aliases=['delete', 'rm', 'del'])
 	async def remove(self, ctx, *, title: clean_content):
@@ -331,47 +326,57 @@ class Wiki(commands.Cog):
 	@commands.command(aliases=['revisions'])
 	async def history(self, ctx, *, title: clean_content):
 		"""Shows the revisions of a particular page"""
+		# charged once, rather than every time the paginator fetches the revisions on another page
+		ratelimit.charge(self.bot, 'read', ctx.author)
 
 		async with self.bot.pool.acquire() as conn:
 			connection.set(conn)
 			page = await self.db.resolve_page(ctx.author, title)
 			if page.alias:
-				await ctx.send(f'“{page.alias}” is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.target}.')
-				return
+				raise commands.UserInputError(
+					f'“{page.alias}” is an alias. Try {ctx.prefix}{ctx.invoked_with} {page.target}.')
 
-			revisions = [x async for x in self.db.get_page_revisions(ctx.author, title)]
+			count = await self.db.page_revisions_count(ctx.guild.id, title, connection=conn)
 
-		if not revisions:
+		if not count:
 			raise errors.PageNotFoundError(title)
 
-		async def set_author(revision):
-			revision.author = await utils.fetch_member(ctx.guild, revision.author_id)
+		async def fetch(before, offset, limit):
+			# pages with thousands of revisions are common, so only the ones shown are fetched
+			revisions = [
+				revision async for revision in
+				self.db._get_page_history(ctx.author, title, before=before, offset=offset, limit=limit)]
 
-		await asyncio.gather(
-			*(asyncio.create_task(set_author(revision)) for revision in revisions),
-			return_exceptions=True,
-		)
+			async def set_author(revision):
+				with contextlib.suppress(discord.NotFound):
+					revision.author = await utils.fetch_member(ctx.guild, revision.author_id)
 
-		await Pages(ctx, entries=list(map(self.revision_summary, revisions)), numbered=False).begin()
+			await asyncio.gather(*map(set_author, revisions))
+			return [(revision.revision_id, self.revision_history_entry(revision)) for revision in revisions]
+
+		await KeysetPages(ctx, fetch=fetch, count=count, numbered=False).begin()
 
 	@commands.command(usage='<title> <revision ID>', ignore_extra=False)
 	async def revert(self, ctx, title: clean_content, revision_id: int):
 		"""Reverts a page to a previous revision ID.
 		To get the revision ID, you can use the history command.
 		"""
-		async with self.bot.pool.acquire() as conn, conn.transaction(isolation='serializable'):
+		async with self.bot.pool.acquire() as conn:
 			connection.set(conn)
 			try:
 				revision = await self.db.get_revision(ctx.guild.id, revision_id)
 			except ValueError:
-				await ctx.send(f'Error: revision not found. Try using the {ctx.prefix}history command to find revisions.')
-				return
+				raise commands.UserInputError(
+					f'Error: revision not found. Try using the {ctx.prefix}history command to find revisions.')
 
 			if revision.current_title.lower() != title.lower():
-				await ctx.send('Error: This revision is for another page.')
-				return
+				raise commands.UserInputError('Error: This revision is for another page.')
 
-			await self.db.revise_page(ctx.author, title, revision.content)
+			page = await self.db.get_page(ctx.author, title, partial=True)
+
+		# this reverts the changes since the latest revision as of now. if there are more by the time it's written,
+		# they're kept unless they change the same parts of the page
+		await self.db.revise_page(ctx.author, title, revision.content, base_revision_id=page.latest_revision_id)
 
 		await ctx.message.add_reaction(self.bot.config['success_emojis'][True])
 
@@ -392,10 +397,9 @@ class Wiki(commands.Cog):
 			try:
 				old, new = await self.db.get_individual_revisions(ctx.guild.id, (revision_id_1, revision_id_2))
 			except ValueError:
-				await ctx.send(
+				raise commands.UserInputError(
 					'One or more provided revision IDs were invalid. '
 					f'Use the {ctx.prefix}history command to get valid revision IDs.')
-				return
 			await self.db.check_permissions(ctx.author, Permissions.edit, new.current_title)
 
 		with contextlib.suppress(discord.NotFound):
@@ -404,28 +408,37 @@ class Wiki(commands.Cog):
 		with contextlib.suppress(discord.NotFound):
 			new.author = await utils.fetch_member(ctx.guild, new.author_id)
 
-		await TextPages(ctx, self.diff(old, new), prefix='', suffix='').begin()
+		await TextPages(ctx, await self.diff(old, new), prefix='', suffix='').begin()
 
-	@classmethod
-	def diff(cls, old, new):
+	async def diff(self, old, new):
 		# wew this was hard to get right
 		if new.prev_title != old.title or new.title != old.title:
-			return cls.renamed_revision_summary(new, old_title=old.title)
+			return self.renamed_revision_summary(new, old_title=old.title)
 
 		if old.page_id != new.page_id:
 			raise commands.UserInputError('You can only compare revisions of the same page.')
 
-		diff = list(difflib.unified_diff(
-			old.content.splitlines(),
-			new.content.splitlines(),
-			fromfile=cls.revision_summary(old),
-			tofile=cls.revision_summary(new),
-			lineterm=''))
-
-		if not diff:
+		diff = await self.content_diff(old, new)
+		if diff is None:
 			raise commands.UserInputError('These revisions appear to be identical.')
 
-		return '```diff\n' + '\n'.join(map(utils.escape_code_blocks, diff)) + '```'
+		header = f'--- {self.revision_summary(old)}\n+++ {self.revision_summary(new)}'
+		return f'```diff\n{utils.escape_code_blocks(header)}\n{diff}```'
+
+	async def content_diff(self, old, new):
+		# the content of a revision never changes, unlike the titles and author names in the header
+		key = old.revision_id, new.revision_id
+		try:
+			# reinserted below, so that the dict stays in order of use
+			diff = self.diff_cache.pop(key)
+		except KeyError:
+			diff = await self.bot.workers.run(
+				word_diff, old.content, new.content, size=len(old.content) + len(new.content))
+			if len(self.diff_cache) >= self.DIFF_CACHE_SIZE:
+				# dicts are ordered, so this evicts the least recently used entry
+				del self.diff_cache[next(iter(self.diff_cache))]
+		self.diff_cache[key] = diff
+		return diff
 
 	@classmethod
 	def revision_summary(cls, revision):
@@ -438,6 +451,14 @@ class Wiki(commands.Cog):
 		verb = 'created' if revision.first else 'revised'
 		return f'#{revision.revision_id}) {title} was {verb} by {author_at}'
 
+	@classmethod
+	def revision_history_entry(cls, revision):
+		summary = cls.revision_summary(revision)
+		if revision.chars_added is None:
+			# this revision predates change statistics and hasn't been backfilled
+			return summary
+		return f'{summary} (+{revision.chars_added}/−{revision.chars_removed})'
+
 	@classmethod
 	def renamed_revision_summary(cls, revision, *, old_title):
 		author = cls.format_author(revision)
@@ -16,19 +16,24 @@
 import datetime
 import enum
 import operator
-import typing
 
-import asyncpg
 import discord
 from bot_bin.sql import connection, optional_connection
 from discord.ext import commands
 
 from ..permissions.db import Permissions
 from ...utils import AttrDict, errors, round_down
+from ...utils.diff import change_stats, three_way_merge
+from ...utils.ratelimit import ratelimited
+from ...utils.sql import CONFLICT_ATTEMPTS, replica_router
+from ...utils.tracing import traced
+from ...utils.workload import workload
 
 class WikiDatabase(commands.Cog):
 	TITLE_LENGTH_LIMIT = 200
 	CONTENT_LENGTH_LIMIT = round_down(2000 - len('cm/edit "" ') - TITLE_LENGTH_LIMIT, multiple=50)
+	# how many pages get_all_pages fetches at a time behind a transaction pooler, and get_all_page_batches always
+	KEYSET_BATCH_SIZE = 500
 
 	def __init__(self, bot):
 		self.bot = bot
@@ -43,28 +48,81 @@ class WikiDatabase(commands.Cog):
 		if row is None:
 			raise errors.PageNotFoundError(title)
 
-		return AttrDict(row)
+		return query.record(row)
 
 	@optional_connection
-	async def get_page_revisions(self, member, title):
+	async def get_pages(self, member, titles):
+		"""return a list of every page in titles that exists and that member may view, using a single query"""
+		role_ids = [role.id for role in member.roles if role != member.guild.default_role]
+		query = self.queries.get_pages()
+		return query.records(await connection().fetch(
+			query,
+			member.guild.id, titles, member.id, role_ids,
+			Permissions.default.value, Permissions.view.value, await self.bot.is_privileged(member)))
+
+	@ratelimited('read')
+	async def get_page_history(self, member, title, *, before=None, offset=0, limit=None):
+		"""return an async iterator over the revisions of a page, newest first, without their content.
+
+		To get the next page of results, pass the ID of the last revision returned as before.
+		"""
+		async for row in self._get_page_history(member, title, before=before, offset=offset, limit=limit):
+			yield row
+
+	@optional_connection
+	async def _get_page_history(self, member, title, *, before=None, offset=0, limit=None):
+		"""get_page_history without the rate limit, for paginators that charge it once for every page they show"""
 		await self.check_permissions(member, Permissions.view, title)
-		async for row in self.cursor(self.queries.get_page_revisions(), member.guild.id, title):
-			row.author = None
+		async for row in self.cursor(self.queries.get_page_history(), member.guild.id, title, before, offset, limit):
 			yield row
 
+	@workload('bulk')
 	@optional_connection
 	async def get_all_pages(self, member):
 		"""return an async iterator over all pages for the given guild"""
 		await self.check_permissions(member, Permissions.view)
-		async for row in self.cursor(self.queries.get_all_pages(), member.guild.id):
-			yield row
+		if not self.bot.transaction_pooler:
+			async for row in self.cursor(self.queries.get_all_pages(), member.guild.id):
+				yield row
+			return
+
+		# there may be a lot of them, so rather than fetching them all at once (see cursor()),
+		# fetch a batch at a time, each starting after the last title of the one before
+		async for batch in self._page_batches(member.guild.id):
+			for row in batch:
+				yield row
+
+	@workload('bulk')
+	async def get_all_page_batches(self, member):
+		"""return an async iterator over lists of all pages for the given guild, KEYSET_BATCH_SIZE at a time.
+
+		Unlike get_all_pages, no connection is held while the caller handles a batch, so it may take its time.
+		"""
+		await self.check_permissions(member, Permissions.view)
+		async for batch in self._page_batches(member.guild.id):
+			yield batch
+
+	async def _page_batches(self, guild_id):
+		after = ''
+		while True:
+			batch = await self._page_batch(guild_id, after)
+			yield batch
+			if len(batch) < self.KEYSET_BATCH_SIZE:
+				return
+			after = batch[-1].title
 
+	@optional_connection
+	async def _page_batch(self, guild_id, after):
+		query = self.queries.get_all_pages(batched=True)
+		return query.records(await connection().fetch(query, guild_id, after, self.KEYSET_BATCH_SIZE))
+
+	@ratelimited('read')
+	@workload('bulk')
 	@optional_connection
 	async def get_recent_revisions(self, member, cutoff: datetime.datetime):
 		"""return an async iterator over recent (after cutoff) revisions for the given guild, sorted by time"""
 		await self.check_permissions(member, Permissions.view)
 		async for row in self.cursor(self.queries.get_recent_revisions(), member.guild.id, cutoff):
-			row.author = None
 			yield row
 
 	@optional_connection
@@ -76,16 +134,19 @@ class WikiDatabase(commands.Cog):
 		# were globally denied view permissions.
 		async with connection().transaction():
 			await self.check_permissions(member, Permissions.view, title)
-			row = await connection().fetchrow(self.queries.get_alias(), member.guild.id, title)
+			query = self.queries.get_alias()
+			row = await connection().fetchrow(query, member.guild.id, title)
 			if row is not None:
-				return AttrDict(row)
+				return query.record(row)
 
-			row = await connection().fetchrow(self.queries.get_page_no_alias(), member.guild.id, title)
+			query = self.queries.get_page_no_alias()
+			row = await connection().fetchrow(query, member.guild.id, title)
 			if row is not None:
-				return AttrDict(row)
+				return query.record(row)
 
 			raise errors.PageNotFoundError(title)
 
+	@ratelimited('read')
 	@optional_connection
 	async def search_pages(self, member, query):
 		"""return an async iterator over all pages whose title is similar to query"""
@@ -95,174 +156,223 @@ class WikiDatabase(commands.Cog):
 
 	@optional_connection
 	async def cursor(self, query, *args):
-		"""return an async iterator over all rows matched by query and args. Lazy equivalent to fetch()"""
-		async with connection().transaction():
-			async for row in connection().cursor(query, *args):
-				yield AttrDict(row)
+		"""return an async iterator over all rows matched by query and args. Lazy equivalent to fetch()
+
+		Behind a transaction pooler, the rows are fetched all at once instead, because a cursor's transaction
+		would keep a server connection from everyone else for as long as the caller takes to handle them.
+		"""
+		if self.bot.transaction_pooler:
+			for row in query.records(await connection().fetch(query, *args)):
+				yield row
+			return
+
+		async with replica_router.cursor_connection(query, connection()) as conn, conn.transaction():
+			async for row in conn.cursor(query, *args):
+				yield query.record(row)
 
 	@optional_connection
 	async def get_individual_revisions(self, guild_id, revision_ids):
 		"""return a list of page revisions for the given guild.
 		the revisions are sorted by their revision ID.
 		"""
-		results = list(map(AttrDict, await connection().fetch(
-			self.queries.get_individual_revisions(),
-			guild_id, revision_ids)))
+		query = self.queries.get_individual_revisions()
+		results = query.records(await connection().fetch(query, guild_id, revision_ids))
 
 		if len(results) != len(set(revision_ids)):
 			raise ValueError('one or more revision IDs not found')
 
-		for revision in results:
-			revision.author = None
-
 		return results
 
 	async def get_revision(self, guild_id, revision_id):
 		"""convenience wrapper for get_individual_revisions"""
 		return (await self.get_individual_revisions(guild_id, [revision_id]))[0]
 
+	@workload('analytics')
 	async def page_count(self, guild_id, *, connection=None):
 		return await (connection or self.bot.pool).fetchval(self.queries.page_count(), guild_id)
 
+	@workload('analytics')
 	async def revisions_count(self, guild_id, *, connection=None):
 		return await (connection or self.bot.pool).fetchval(self.queries.revisions_count(), guild_id)
 
+	@workload('analytics')
 	async def page_uses(self, guild_id, title, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 		return await (connection or self.bot.pool).fetchval(self.queries.page_uses(), guild_id, title, cutoff)
 
+	@workload('analytics')
 	async def page_revisions_count(self, guild_id, title, *, connection=None):
 		return await (connection or self.bot.pool).fetchval(self.queries.page_revisions_count(), guild_id, title)
 
+	@workload('analytics')
+	@ratelimited('read')
 	async def top_page_editors(self, guild_id, title, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		editors = list(map(AttrDict, await (connection or self.bot.pool).fetch(
-			self.queries.top_page_editors(),
-			guild_id, title, cutoff)))
+		query = self.queries.top_page_editors()
+		editors = query.records(await (connection or self.bot.pool).fetch(query, guild_id, title, cutoff))
 		if not editors:
 			raise errors.PageNotFoundError(title)
 		return editors
 
+	@workload('analytics')
 	async def total_page_uses(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
 		return await (connection or self.bot.pool).fetchval(self.queries.total_page_uses(), guild_id, cutoff)
 
+	@workload('analytics')
+	@ratelimited('read')
 	async def top_pages(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return list(map(AttrDict, await (connection or self.bot.pool).fetch(self.queries.top_pages(), guild_id, cutoff)))
+		query = self.queries.top_pages()
+		return query.records(await (connection or self.bot.pool).fetch(query, guild_id, cutoff))
 
+	@workload('analytics')
+	@ratelimited('read')
 	async def top_editors(self, guild_id, *, cutoff=None, connection=None):
 		cutoff = cutoff or datetime.datetime.utcnow() - datetime.timedelta(weeks=4)
-		return list(map(AttrDict, await (connection or self.bot.pool).fetch(
-			self.queries.top_editors(),
-			guild_id, cutoff)))
+		query = self.queries.top_editors()
+		return query.records(await (connection or self.bot.pool).fetch(query, guild_id, cutoff))
 
+	@ratelimited('write')
 	@optional_connection
 	async def create_page(self, member, title, content):
 		self.check_title(title)
 		self.check_content(content)
 
-		async with connection().transaction(isolation='serializable'):
-			await self.check_permissions(member, Permissions.create)
-			if await connection().fetchrow(self.queries.get_alias(), member.guild.id, title):
-				raise errors.PageExistsError
-
-			try:
-				page_id = await connection().fetchval(self.queries.create_page(), member.guild.id, title)
-			except asyncpg.UniqueViolationError:
-				raise errors.PageExistsError
-
-			content_id = await connection().fetchval(self.queries.create_content(), content)
-			await connection().execute(self.queries.create_first_revision(), page_id, member.id, content_id, title)
-
+		self.check_status(await connection().fetchrow(
+			self.queries.create_page(),
+			await self.editor(member),
+			Permissions.create.value,
+			title,
+			content,
+			len(content),
+			len(content.splitlines()),
+		), title)
+
+	@ratelimited('write')
 	@optional_connection
 	async def alias_page(self, member, alias_title, target_title):
 		self.check_title(alias_title)
 
-		async with connection().transaction():
-			await self.check_permissions(member, Permissions.create)
-			await self.check_permissions(member, Permissions.view, target_title)
-			await self.ensure_title_available(member, alias_title)
-
-			try:
-				await connection().execute(self.queries.alias_page(), member.guild.id, alias_title, target_title)
-			except asyncpg.NotNullViolationError:
-				# the CTE returned no rows
-				raise errors.PageNotFoundError(target_title)
-			except asyncpg.UniqueViolationError:
-				raise errors.PageExistsError
+		self.check_status(await connection().fetchrow(
+			self.queries.alias_page(),
+			await self.editor(member),
+			Permissions.create.value,
+			Permissions.view.value,
+			alias_title,
+			target_title,
+		), target_title)
 
+	@ratelimited('write')
 	@optional_connection
-	async def revise_page(self, member, title, new_content) -> typing.Optional[str]:
+	async def revise_page(self, member, title, new_content, *, base_revision_id=None):
+		"""Replace the content of a page. Return an AttrDict of the new revision_id, the page's title,
+		whether title is an alias, and whether the edit was merged with others.
+
+		The page is only revised if its latest revision is still the one that was just read, so concurrent edits
+		don't have to lock it while the diff is computed. An edit that loses the race tries again on top of the one
+		that won it, up to CONFLICT_ATTEMPTS times before EditContentionError is raised.
+		base_revision_id is the revision the editor started from: if it's given and the page has been edited since,
+		the edits are merged, and EditConflictError is raised if they change the same part of the page.
+		Without it, the edit replaces whatever the page says.
+		"""
 		self.check_title(title)
 		self.check_content(new_content)
-
-		async with connection().transaction(isolation='serializable'):
-			await self.check_permissions(member, Permissions.edit, title)
-
-			page = await connection().fetchrow(self.queries.get_page_basic(), member.guild.id, title)
+		editor = await self.editor(member)
+
+		base_content = None
+		merged = False
+		first_base_revision_id = base_revision_id
+		for _ in range(CONFLICT_ATTEMPTS):
+			page = await connection().fetchrow(
+				self.queries.get_page_for_edit(), member.guild.id, title, editor, Permissions.edit.value)
 			if page is None:
 				raise errors.PageNotFoundError(title)
+			if not page['allowed']:
+				raise errors.MissingPagePermissionsError(Permissions.edit)
+
+			content = new_content
+			if base_revision_id is not None and page['latest_revision_id'] != base_revision_id:
+				if base_content is None:
+					base_content = await self.base_revision_content(member.guild.id, page['page_id'], base_revision_id)
+				content = await self.bot.workers.run(
+					three_way_merge, base_content, page['content'], new_content,
+					size=len(base_content) + len(page['content']) + len(new_content))
+				if content is None:
+					raise errors.EditConflictError(base_revision_id, page['latest_revision_id'])
+				self.check_content(content)
+				merged = True
+
+			stats = await self.bot.workers.run(
+				change_stats, page['content'], content, size=len(page['content']) + len(content))
+			result = await connection().fetchrow(
+				self.queries.revise_page(), member.id, page['page_id'], content, *stats, page['latest_revision_id'])
+
+			if result['status'] == 'ok':
+				return AttrDict(
+					revision_id=result['new_revision_id'], title=page['title'], is_alias=page['is_alias'], merged=merged)
+
+			if base_revision_id is not None:
+				# the next attempt merges what we tried to write with the edit that beat it
+				base_revision_id, base_content, new_content = page['latest_revision_id'], page['content'], content
+
+		# a page edited this often can't be edited until the others stop, like a transaction that keeps conflicting
+		raise errors.EditContentionError(first_base_revision_id, page['latest_revision_id'])
 
-			content_id = await connection().fetchval(self.queries.create_content(), new_content)
-			await connection().execute(
-				self.queries.create_revision(),
-				page['page_id'],
-				member.id,
-				page['original_title'],
-				content_id,
-			)
-
-			if page['alias']:
-				return page['original_title']
+	@optional_connection
+	async def base_revision_content(self, guild_id, page_id, revision_id):
+		try:
+			revision = await self.get_revision(guild_id, revision_id)
+		except ValueError:
+			pass
+		else:
+			if revision.page_id == page_id:
+				return revision.content
+		raise commands.UserInputError(f'Revision {revision_id} is not a revision of that page.')
 
+	@ratelimited('write')
 	@optional_connection
 	async def rename_page(self, member, title, new_title):
 		self.check_title(new_title)
+		self.check_status(
+			await connection().fetchrow(self.queries.rename_page(), await self.editor(member), title, new_title),
+			title)
 
-		async with connection().transaction(isolation='serializable'):
-			await self.ensure_title_available(member, new_title)
-
-			try:
-				page_id = await connection().fetchval(self.queries.rename_page(), member.guild.id, title, new_title)
-			except asyncpg.UniqueViolationError:
-				raise errors.PageExistsError
-
-			if page_id is None:
-				raise errors.PageNotFoundError(title)
-
-			content_id = await connection().fetchval(self.queries.get_content_id(), page_id)
-			await connection().execute(self.queries.log_page_rename(), page_id, member.id, content_id, new_title)
-
+	@ratelimited('write')
 	@optional_connection
 	async def delete_page(self, member, title) -> bool:
 		"""delete a page or alias
 
 		return whether an alias was deleted
 		"""
-		async with connection().transaction():
-			# we use resolve_page here for separate permissions check depending on type
-			is_alias = (await self.resolve_page(member, title)).alias
-
-			if is_alias:
-				# why Permissions.edit and not Permissions.delete?
-				# deleting an alias is a prerequisite to recreating it with a different title
-				# and deleting an alias is nowhere near as destructive as deleting a page
-				await self.check_permissions(member, Permissions.edit)
-				command_tag = await connection().execute(self.queries.delete_alias(), member.guild.id, title)
-				if command_tag.split()[-1] == '0':
-					raise RuntimeError('page is supposed to be an alias but delete_alias did not delete it', title)
-				return True
-
-			await self.check_permissions(member, Permissions.delete, title)
-			command_tag = await connection().execute(self.queries.delete_page(), member.guild.id, title)
-			if command_tag.split()[-1] == '0':
-				raise RuntimeError('page is not supposed to be an alias but delete_page did not delete it', title)
-
-			return False
-
-		raise errors.PageNotFoundError(title)
+		result = self.check_status(await connection().fetchrow(
+			self.queries.delete_page(),
+			await self.editor(member),
+			Permissions.view.value,
+			Permissions.edit.value,
+			Permissions.delete.value,
+			title,
+		), title)
+		return result['was_alias']
+
+	async def editor(self, member):
+		"""return the page_editor (see functions.sql) that the page procedures check member's permissions with"""
+		role_ids = [role.id for role in member.roles if role != member.guild.default_role]
+		return member.guild.id, member.id, role_ids, await self.bot.is_privileged(member), Permissions.default.value
+
+	@staticmethod
+	def check_status(result, title):
+		"""raise the error that the status returned by one of the page procedures stands for, or return the result"""
+		status = result['status']
+		if status == 'page_not_found':
+			raise errors.PageNotFoundError(title)
+		if status == 'page_exists':
+			raise errors.PageExistsError
+		if status == 'missing_permissions':
+			raise errors.MissingPagePermissionsError(Permissions(result['missing_permissions']))
+		return result
 
+	@traced()
 	@optional_connection
 	async def check_permissions(self, member, required_permissions, title=None):
 		if title is None:
@@ -287,11 +397,6 @@ class WikiDatabase(commands.Cog):
 		if len(title) > cls.TITLE_LENGTH_LIMIT:
 			raise errors.PageTitleTooLongError(title, cls.TITLE_LENGTH_LIMIT)
 
-	@optional_connection
-	async def ensure_title_available(self, member, title):
-		if await connection().fetchrow(self.queries.get_page_basic(), member.guild.id, title):
-			raise errors.PageExistsError
-
 	## Permissions
 
 def setup(bot):
@@ -15,6 +15,7 @@
 
 -- :macro get_revision()
 -- params: revision_id
+-- columns: content, guild_id, page_id
 SELECT content, pages.guild_id, page_id
 FROM
 	revisions
@@ -25,6 +26,7 @@ WHERE revision_id = $1
 
 -- :macro bound_messages()
 -- params: page_id
+-- columns: channel_id, message_id
 SELECT channel_id, message_id
 FROM bound_messages
 WHERE page_id = $1
@@ -32,6 +34,8 @@ WHERE page_id = $1
 
 -- :macro guild_bindings()
 -- params: guild_id
+-- columns: title, page_id, channel_id, message_id
+-- read only
 SELECT title, page_id, channel_id, message_id
 FROM
 	bound_messages
@@ -50,6 +54,7 @@ ON CONFLICT (message_id) DO UPDATE
 
 -- :macro get_bound_page()
 -- params: message_id
+-- columns: title, page_id
 SELECT pages.title, page_id
 FROM
 	bound_messages
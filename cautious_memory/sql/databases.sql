@@ -0,0 +1,149 @@
+-- Copyright © 2020 lambda#0987
+--
+-- Cautious Memory is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as published
+-- by the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- Cautious Memory is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+-- these are run on the home database
+
+-- :macro add_database()
+-- params: name, max_databases
+INSERT INTO databases (name, id_residue)
+SELECT $1, min(residue)
+FROM generate_series(0, $2 - 1) AS residue
+WHERE residue NOT IN (SELECT id_residue FROM databases)
+ON CONFLICT (name) DO NOTHING
+-- :endmacro
+
+-- :macro get_databases()
+SELECT name, id_residue
+FROM databases
+-- :endmacro
+
+-- :macro get_directory()
+SELECT guild_id, database, frozen
+FROM guild_databases
+-- :endmacro
+
+-- :macro place_guild()
+-- params: guild_id, database
+-- the database is only used if the guild doesn't have one yet. returns the guild's database either way.
+WITH inserted AS (
+	INSERT INTO guild_databases (guild_id, database)
+	VALUES ($1, $2)
+	ON CONFLICT (guild_id) DO NOTHING
+	RETURNING database, frozen
+)
+SELECT database, frozen FROM inserted
+UNION ALL
+SELECT database, frozen FROM guild_databases WHERE guild_id = $1
+-- :endmacro
+
+-- :macro set_guild_frozen()
+-- params: guild_id, frozen
+UPDATE guild_databases
+SET frozen = $2
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro set_guild_database()
+-- params: guild_id, database
+UPDATE guild_databases
+SET database = $2, frozen = FALSE
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro database_guild_counts()
+SELECT database, count(*) AS guilds, count(*) FILTER (WHERE frozen) AS frozen
+FROM guild_databases
+GROUP BY database
+-- :endmacro
+
+-- these read everything belonging to one guild from its database, in the order it has to be inserted in on another.
+-- the guild's role permissions are found by role ID, since they don't record what guild the role is in.
+
+-- :macro guild_contents()
+-- params: guild_id
+SELECT content_id, content
+FROM contents
+WHERE content_id IN (SELECT content_id FROM revisions INNER JOIN pages USING (page_id) WHERE guild_id = $1)
+-- :endmacro
+
+-- :macro guild_pages()
+-- params: guild_id
+SELECT page_id, title, guild_id, latest_revision_id, created
+FROM pages
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_revisions()
+-- params: guild_id
+SELECT
+	revision_id, page_id, author_id, revisions.title, content_id, revised,
+	chars_added, chars_removed, lines_added, lines_removed
+FROM revisions INNER JOIN pages USING (page_id)
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_aliases()
+-- params: guild_id
+SELECT title, page_id, aliased, guild_id
+FROM aliases
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_page_usage_history()
+-- params: guild_id
+SELECT page_id, time
+FROM page_usage_history INNER JOIN pages USING (page_id)
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_page_permissions()
+-- params: guild_id
+SELECT page_id, entity, allow, deny
+FROM page_permissions INNER JOIN pages USING (page_id)
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_page_subscribers()
+-- params: guild_id
+SELECT page_id, user_id
+FROM page_subscribers INNER JOIN pages USING (page_id)
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_bound_messages()
+-- params: guild_id
+SELECT message_id, channel_id, page_id
+FROM bound_messages INNER JOIN pages USING (page_id)
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro guild_role_permissions()
+-- params: role_ids
+SELECT entity, permissions
+FROM role_permissions
+WHERE entity = ANY ($1)
+-- :endmacro
+
+-- :macro delete_guild()
+-- params: guild_id, role_ids
+-- revisions, aliases, usage history and page permissions go with the pages
+WITH
+	page_ids AS (SELECT page_id FROM pages WHERE guild_id = $1),
+	subscribers AS (DELETE FROM page_subscribers WHERE page_id IN (SELECT * FROM page_ids)),
+	bindings AS (DELETE FROM bound_messages WHERE page_id IN (SELECT * FROM page_ids)),
+	roles AS (DELETE FROM role_permissions WHERE entity = ANY ($2))
+DELETE FROM pages
+WHERE guild_id = $1
+-- :endmacro
@@ -78,3 +78,299 @@ CREATE FUNCTION permissions_for(
 			WHERE entity = p_member_id AND page_id = p_page_id), 0);
 
 		RETURN v_base; END; $$ LANGUAGE plpgsql;
+
+--- PAGE WRITES
+
+-- each of these does a whole change to the wiki in one call, and returns a status that cogs/wiki/db.py turns into
+-- an error. permissions are passed in by the caller, since cogs/permissions/db.py is where their values are defined.
+
+CREATE TYPE page_write_status AS ENUM (
+	'ok',
+	'page_not_found',
+	'page_exists',
+	-- the permissions that were missing are returned along with this one
+	'missing_permissions',
+	-- the page was revised by someone else since the revision the edit was based on
+	'edited_since'
+);
+
+-- who is making a change, and what they need to have their permissions worked out.
+-- role_ids leaves out the @everyone role. privileged members (administrators and bot owners) may do anything.
+CREATE TYPE page_editor AS (
+	guild_id BIGINT,
+	member_id BIGINT,
+	role_ids BIGINT[],
+	privileged BOOLEAN,
+	default_permissions INTEGER
+);
+
+-- whether p_editor has p_required in the guild, or on the page if p_page_id isn't NULL
+CREATE FUNCTION has_permissions(
+	p_editor page_editor,
+	p_page_id pages.page_id%TYPE,
+	p_required role_permissions.permissions%TYPE
+) RETURNS BOOLEAN AS $$
+	DECLARE
+		v_perms role_permissions.permissions%TYPE;
+	BEGIN
+		IF p_editor.privileged THEN
+			RETURN TRUE;
+		END IF;
+
+		IF p_page_id IS NULL THEN
+			v_perms := coalesce((
+				SELECT permissions
+				FROM role_permissions
+				WHERE entity = p_editor.guild_id), p_editor.default_permissions);
+			v_perms := v_perms | coalesce((
+				SELECT bit_or(permissions)
+				FROM role_permissions
+				WHERE entity = ANY (p_editor.role_ids)), 0);
+		ELSE
+			v_perms := permissions_for(
+				p_page_id, p_editor.member_id, p_editor.role_ids, p_editor.guild_id, p_editor.default_permissions);
+		END IF;
+
+		RETURN v_perms & p_required = p_required; END; $$ LANGUAGE plpgsql;
+
+-- Whether a page or alias has this title. Callers hold take_title's lock on it, since the unique indexes of pages
+-- and aliases don't stop a page and an alias from having the same title. Holding a lock on just this title
+-- is what lets these run without serializable isolation.
+CREATE FUNCTION take_title(p_guild_id BIGINT, p_title pages.title%TYPE) RETURNS BOOLEAN AS $$ BEGIN
+	PERFORM pg_advisory_xact_lock(hashtextextended(lower(p_title), p_guild_id));
+	RETURN NOT EXISTS (SELECT FROM pages WHERE guild_id = p_guild_id AND lower(title) = lower(p_title))
+		AND NOT EXISTS (SELECT FROM aliases WHERE guild_id = p_guild_id AND lower(title) = lower(p_title));
+END; $$ LANGUAGE plpgsql;
+
+CREATE FUNCTION create_page(
+	p_editor page_editor,
+	p_create_permissions role_permissions.permissions%TYPE,
+	p_title pages.title%TYPE,
+	p_content contents.content%TYPE,
+	p_chars_added revisions.chars_added%TYPE,
+	p_lines_added revisions.lines_added%TYPE,
+	OUT status page_write_status,
+	OUT missing_permissions role_permissions.permissions%TYPE
+) AS $$
+	DECLARE
+		v_page_id pages.page_id%TYPE;
+		v_content_id contents.content_id%TYPE;
+		v_revision_id revisions.revision_id%TYPE;
+	BEGIN
+		IF NOT has_permissions(p_editor, NULL, p_create_permissions) THEN
+			status := 'missing_permissions';
+			missing_permissions := p_create_permissions;
+			RETURN;
+		END IF;
+
+		IF NOT take_title(p_editor.guild_id, p_title) THEN
+			status := 'page_exists';
+			RETURN;
+		END IF;
+
+		INSERT INTO pages (guild_id, title)
+		VALUES (p_editor.guild_id, p_title)
+		RETURNING page_id INTO v_page_id;
+
+		INSERT INTO contents (content)
+		VALUES (p_content)
+		RETURNING content_id INTO v_content_id;
+
+		INSERT INTO revisions (
+			page_id, author_id, content_id, title, chars_added, chars_removed, lines_added, lines_removed)
+		VALUES (v_page_id, p_editor.member_id, v_content_id, p_title, p_chars_added, 0, p_lines_added, 0)
+		RETURNING revision_id INTO v_revision_id;
+
+		UPDATE pages
+		SET latest_revision_id = v_revision_id
+		WHERE page_id = v_page_id;
+
+		status := 'ok'; END; $$ LANGUAGE plpgsql;
+
+-- only revises the page if its latest revision is still p_base_revision_id, and returns 'edited_since' otherwise.
+-- the caller has checked that the editor may edit it (wiki.get_page_for_edit).
+CREATE FUNCTION revise_page(
+	p_author_id revisions.author_id%TYPE,
+	p_page_id pages.page_id%TYPE,
+	p_content contents.content%TYPE,
+	p_chars_added revisions.chars_added%TYPE,
+	p_chars_removed revisions.chars_removed%TYPE,
+	p_lines_added revisions.lines_added%TYPE,
+	p_lines_removed revisions.lines_removed%TYPE,
+	p_base_revision_id revisions.revision_id%TYPE,
+	OUT status page_write_status,
+	OUT new_revision_id revisions.revision_id%TYPE
+) AS $$
+	DECLARE
+		v_title pages.title%TYPE;
+		v_content_id contents.content_id%TYPE;
+	BEGIN
+		-- an edit that committed first makes this come up empty
+		SELECT title
+		FROM pages
+		WHERE page_id = p_page_id AND latest_revision_id = p_base_revision_id
+		FOR UPDATE
+		INTO v_title;
+
+		IF NOT FOUND THEN
+			status := 'edited_since';
+			RETURN;
+		END IF;
+
+		INSERT INTO contents (content)
+		VALUES (p_content)
+		RETURNING content_id INTO v_content_id;
+
+		INSERT INTO revisions (
+			page_id, author_id, title, content_id, chars_added, chars_removed, lines_added, lines_removed)
+		VALUES (
+			p_page_id, p_author_id, v_title, v_content_id, p_chars_added, p_chars_removed, p_lines_added, p_lines_removed)
+		RETURNING revision_id INTO new_revision_id;
+
+		UPDATE pages
+		SET latest_revision_id = new_revision_id
+		WHERE page_id = p_page_id;
+
+		status := 'ok'; END; $$ LANGUAGE plpgsql;
+
+-- the rename is logged as a revision with the same content, but the page's latest revision stays the same
+CREATE FUNCTION rename_page(
+	p_editor page_editor,
+	p_title pages.title%TYPE,
+	p_new_title pages.title%TYPE,
+	OUT status page_write_status
+) AS $$
+	DECLARE
+		v_page_id pages.page_id%TYPE;
+	BEGIN
+		IF NOT take_title(p_editor.guild_id, p_new_title) THEN
+			status := 'page_exists';
+			RETURN;
+		END IF;
+
+		UPDATE pages
+		SET title = p_new_title
+		WHERE guild_id = p_editor.guild_id AND lower(title) = lower(p_title)
+		RETURNING page_id INTO v_page_id;
+
+		IF NOT FOUND THEN
+			status := 'page_not_found';
+			RETURN;
+		END IF;
+
+		INSERT INTO revisions (
+			page_id, author_id, content_id, title, chars_added, chars_removed, lines_added, lines_removed)
+		SELECT v_page_id, p_editor.member_id, content_id, p_new_title, 0, 0, 0, 0
+		FROM pages INNER JOIN revisions ON pages.latest_revision_id = revisions.revision_id
+		WHERE pages.page_id = v_page_id;
+
+		status := 'ok'; END; $$ LANGUAGE plpgsql;
+
+-- 'page_not_found' refers to the target
+CREATE FUNCTION alias_page(
+	p_editor page_editor,
+	p_create_permissions role_permissions.permissions%TYPE,
+	p_view_permissions role_permissions.permissions%TYPE,
+	p_alias_title aliases.title%TYPE,
+	p_target_title pages.title%TYPE,
+	OUT status page_write_status,
+	OUT missing_permissions role_permissions.permissions%TYPE
+) AS $$
+	DECLARE
+		v_page_id pages.page_id%TYPE;
+	BEGIN
+		IF NOT has_permissions(p_editor, NULL, p_create_permissions) THEN
+			status := 'missing_permissions';
+			missing_permissions := p_create_permissions;
+			RETURN;
+		END IF;
+
+		-- aliases can't point to other aliases
+		SELECT page_id
+		FROM pages
+		WHERE guild_id = p_editor.guild_id AND lower(title) = lower(p_target_title)
+		INTO v_page_id;
+
+		IF NOT FOUND THEN
+			status := 'page_not_found';
+			RETURN;
+		END IF;
+
+		IF NOT has_permissions(p_editor, v_page_id, p_view_permissions) THEN
+			status := 'missing_permissions';
+			missing_permissions := p_view_permissions;
+			RETURN;
+		END IF;
+
+		IF NOT take_title(p_editor.guild_id, p_alias_title) THEN
+			status := 'page_exists';
+			RETURN;
+		END IF;
+
+		INSERT INTO aliases (page_id, guild_id, title)
+		VALUES (v_page_id, p_editor.guild_id, p_alias_title);
+
+		status := 'ok'; END; $$ LANGUAGE plpgsql;
+
+-- Delete a page and everything that belongs to it, or an alias. Deleting an alias takes p_edit_permissions in the guild
+-- rather than p_delete_permissions on the page, since it's needed to point the alias somewhere else,
+-- and is nowhere near as destructive as deleting a page.
+CREATE FUNCTION delete_page(
+	p_editor page_editor,
+	p_view_permissions role_permissions.permissions%TYPE,
+	p_edit_permissions role_permissions.permissions%TYPE,
+	p_delete_permissions role_permissions.permissions%TYPE,
+	p_title pages.title%TYPE,
+	OUT status page_write_status,
+	OUT missing_permissions role_permissions.permissions%TYPE,
+	OUT was_alias BOOLEAN
+) AS $$
+	DECLARE
+		v_page_id pages.page_id%TYPE;
+	BEGIN
+		SELECT page_id
+		FROM aliases
+		WHERE guild_id = p_editor.guild_id AND lower(title) = lower(p_title)
+		INTO v_page_id;
+		was_alias := FOUND;
+
+		IF NOT was_alias THEN
+			SELECT page_id
+			FROM pages
+			WHERE guild_id = p_editor.guild_id AND lower(title) = lower(p_title)
+			INTO v_page_id;
+
+			IF NOT FOUND THEN
+				status := 'page_not_found';
+				RETURN;
+			END IF;
+		END IF;
+
+		-- denying someone view permissions for a page denies it for its aliases too
+		IF NOT has_permissions(p_editor, v_page_id, p_view_permissions) THEN
+			status := 'missing_permissions';
+			missing_permissions := p_view_permissions;
+			RETURN;
+		END IF;
+
+		IF was_alias THEN
+			IF NOT has_permissions(p_editor, NULL, p_edit_permissions) THEN
+				status := 'missing_permissions';
+				missing_permissions := p_edit_permissions;
+				RETURN;
+			END IF;
+
+			DELETE FROM aliases
+			WHERE guild_id = p_editor.guild_id AND lower(title) = lower(p_title);
+		ELSE
+			IF NOT has_permissions(p_editor, v_page_id, p_delete_permissions) THEN
+				status := 'missing_permissions';
+				missing_permissions := p_delete_permissions;
+				RETURN;
+			END IF;
+
+			DELETE FROM pages
+			WHERE page_id = v_page_id;
+		END IF;
+
+		status := 'ok'; END; $$ LANGUAGE plpgsql;
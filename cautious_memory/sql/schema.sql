@@ -39,7 +39,12 @@ CREATE INDEX pages_title_trgm_idx ON pages USING GIN (title gin_trgm_ops);
 
 CREATE TABLE contents (
 	content_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
-	content VARCHAR(2000) NOT NULL
+	content VARCHAR(2000) NOT NULL,
+	-- computed once when the content is stored
+	size INTEGER GENERATED ALWAYS AS (octet_length(content)) STORED,
+	-- only used to tell contents apart, so it doesn't need to be collision resistant.
+	-- sha256 can't be used here because converting text to bytes isn't immutable.
+	hash BYTEA GENERATED ALWAYS AS (decode(md5(content), 'hex')) STORED
 );
 
 CREATE TABLE revisions (
@@ -48,9 +53,18 @@ CREATE TABLE revisions (
 	author_id BIGINT NOT NULL,
 	title VARCHAR(:title_length_limit) NOT NULL,
 	content_id INTEGER NOT NULL REFERENCES contents,
-	revised TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP
+	revised TIMESTAMP WITHOUT TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+	-- how much changed since the previous revision, so that listing history doesn't take diffing every revision.
+	-- these are NULL for revisions made before they were recorded, until python -m cautious_memory.backfill is run
+	chars_added INTEGER,
+	chars_removed INTEGER,
+	lines_added INTEGER,
+	lines_removed INTEGER
 );
 
+-- for listing a page's history a page at a time, and finding the revision before another
+CREATE INDEX revisions_page_id_revision_id_idx ON revisions (page_id, revision_id);
+
 ALTER TABLE pages
 ADD CONSTRAINT pages_latest_revision_id_fkey
 FOREIGN KEY (latest_revision_id)
@@ -110,8 +124,14 @@ CREATE TABLE bound_messages(
 
 CREATE INDEX bound_messages_page_id_idx ON bound_messages (page_id);
 
+-- the guild ID lets bot processes ignore edits to guilds on shards they don't run without querying anything
+-- moving a guild to another database copies and deletes its pages without notifying anyone (see utils/databases.py)
 CREATE FUNCTION notify_page_edit() RETURNS TRIGGER AS $$ BEGIN
-	PERFORM * FROM pg_notify('page_edit', new.revision_id::text);
+	IF current_setting('cautious_memory.moving_guild', true) IS DISTINCT FROM 'on' THEN
+		PERFORM * FROM pg_notify(
+			'page_edit',
+			(SELECT guild_id FROM pages WHERE page_id = new.page_id)::text || ',' || new.revision_id::text);
+	END IF;
 	RETURN new;
 END; $$ LANGUAGE plpgsql;
 
@@ -121,7 +141,9 @@ FOR EACH ROW
 EXECUTE PROCEDURE notify_page_edit();
 
 CREATE FUNCTION notify_page_delete() RETURNS TRIGGER AS $$ BEGIN
-	PERFORM * FROM pg_notify('page_delete', old.guild_id::text || ',' || old.page_id::text || ',' || old.title);
+	IF current_setting('cautious_memory.moving_guild', true) IS DISTINCT FROM 'on' THEN
+		PERFORM * FROM pg_notify('page_delete', old.guild_id::text || ',' || old.page_id::text || ',' || old.title);
+	END IF;
 	RETURN NULL;
 END; $$ LANGUAGE plpgsql;
 
@@ -158,7 +180,48 @@ CREATE TABLE api_tokens(
 	user_id BIGINT NOT NULL,
 	app_id BIGINT GENERATED BY DEFAULT AS IDENTITY,
 	app_name VARCHAR(200),
-	secret BYTEA NOT NULL,
+	-- HMAC-SHA256 of the token secret, keyed with the api.token_hash_key config value.
+	-- the secret itself is never stored.
+	secret_hash BYTEA NOT NULL,
 
 	PRIMARY KEY (user_id, app_id)
 );
+
+-- lets every bot process drop cached copies of a token as soon as it's deleted or regenerated
+CREATE FUNCTION notify_api_token_revoke() RETURNS TRIGGER AS $$ BEGIN
+	PERFORM * FROM pg_notify('api_token_revoke', old.user_id::text || ',' || old.app_id::text);
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_api_token_revoke
+AFTER UPDATE OR DELETE ON api_tokens
+FOR EACH ROW
+EXECUTE PROCEDURE notify_api_token_revoke();
+
+-- when guilds are spread across several databases, these say where each one's data is.
+-- they are only used in the home database, the one configured as database in config.json5.
+
+CREATE TABLE databases(
+	name TEXT PRIMARY KEY,
+	-- the identity columns of each database only generate IDs congruent to its residue, modulo the maximum number
+	-- of databases, so that IDs are unique across databases and guilds can be moved between them as they are
+	id_residue SMALLINT NOT NULL UNIQUE
+);
+
+CREATE TABLE guild_databases(
+	guild_id BIGINT PRIMARY KEY,
+	database TEXT NOT NULL REFERENCES databases,
+	-- set while the guild is being moved to another database. its pages can't be changed until it's done.
+	frozen BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE FUNCTION notify_guild_database_change() RETURNS TRIGGER AS $$ BEGIN
+	PERFORM * FROM pg_notify(
+		'guild_database_change', new.guild_id::text || ',' || new.frozen::text || ',' || new.database);
+	RETURN NULL;
+END; $$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_guild_database_change
+AFTER INSERT OR UPDATE ON guild_databases
+FOR EACH ROW
+EXECUTE PROCEDURE notify_guild_database_change();
@@ -30,6 +30,7 @@ WHERE (page_id, user_id) = ((SELECT page_id FROM pages WHERE lower(title) = lowe
 
 -- :macro watch_list()
 -- params: guild_id, user_id
+-- read only
 SELECT ps.page_id, title
 FROM
 	page_subscribers AS ps
@@ -53,23 +54,32 @@ WHERE page_id = $1
 
 -- :macro get_revision_and_previous()
 -- params: revision_id
--- TODO dedupe from wiki.get_page_revisions and wiki.get_individual_revisions
+-- columns: guild_id, page_id, revision_id, author_id, content, revised, current_title, title, prev_title, first
+-- attributes: author
+-- TODO dedupe from wiki.get_individual_revisions
 SELECT
-	guild_id, page_id, revision_id, author_id, content, revised, pages.title AS current_title,
-	pages.title,
-	lag(revisions.title) OVER w AS prev_title,
-	lag(revision_id) OVER w IS NULL AS first
+	guild_id, page_id, revisions.revision_id, author_id, content, revised, pages.title AS current_title,
+	revisions.title,
+	previous.title AS prev_title,
+	previous.revision_id IS NULL AS first
 FROM
-	pages
-	INNER JOIN revisions USING (page_id)
+	(
+		SELECT *
+		FROM revisions
+		WHERE
+			page_id = (SELECT page_id FROM revisions WHERE revision_id = $1)
+			AND revision_id <= $1
+		ORDER BY revision_id DESC
+		LIMIT 2
+	) AS revisions
+	INNER JOIN pages USING (page_id)
 	INNER JOIN contents USING (content_id)
-WHERE
-	page_id = (SELECT page_id FROM revisions WHERE revision_id = $1)
-	AND revision_id <= $1
-WINDOW w AS (
-	PARTITION BY page_id
-	ORDER BY revision_id
-	ROWS 1 PRECEDING)
-ORDER BY revision_id DESC
-LIMIT 2
+	LEFT JOIN LATERAL (
+		SELECT title, revision_id
+		FROM revisions AS r
+		WHERE r.page_id = revisions.page_id AND r.revision_id < revisions.revision_id
+		ORDER BY r.revision_id DESC
+		LIMIT 1
+	) AS previous ON TRUE
+ORDER BY revisions.revision_id DESC
 -- :endmacro
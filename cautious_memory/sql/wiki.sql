@@ -15,8 +15,10 @@
 
 -- :macro get_page()
 -- params: guild_id, title
+-- columns: page_id, created, content, title, latest_revision_id, alias, is_alias
+-- read only
 SELECT
-	pages.page_id, created, content, pages.title,
+	pages.page_id, created, content, pages.title, pages.latest_revision_id,
 	-- tfw condition repeated three times
 	CASE WHEN aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) THEN aliases.title ELSE NULL END AS alias,
 	aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) AS is_alias
@@ -33,9 +35,11 @@ WHERE
 
 -- :macro get_page_basic()
 -- params: guild_id, title
+-- columns: page_id, created, original_title, latest_revision_id, alias
+-- read only
 -- for when you don't need the revisions but still need to resolve aliases
 SELECT
-	pages.page_id, created, pages.title AS original_title,
+	pages.page_id, created, pages.title AS original_title, pages.latest_revision_id,
 	CASE WHEN aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) THEN aliases.title ELSE NULL END AS alias
 FROM
 	aliases
@@ -46,8 +50,38 @@ WHERE
 	(lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
 -- :endmacro
 
+-- :macro get_pages()
+-- params: guild_id, titles, member_id, role_ids, Permissions.default.value, Permissions.view.value, is_privileged
+-- columns: page_id, created, content, title, latest_revision_id, alias, is_alias
+-- read only
+-- role_ids must not include the guild ID
+-- pages which do not exist or which the member may not view are left out
+WITH requested AS (
+	SELECT DISTINCT lower(title) AS title
+	FROM unnest($2::TEXT[]) AS title),
+matches AS (
+	SELECT page_id, NULL AS alias
+	FROM requested INNER JOIN pages ON lower(pages.title) = requested.title
+	WHERE pages.guild_id = $1
+	UNION ALL
+	SELECT page_id, aliases.title AS alias
+	FROM requested INNER JOIN aliases ON lower(aliases.title) = requested.title
+	WHERE aliases.guild_id = $1)
+SELECT
+	pages.page_id, created, content, pages.title, pages.latest_revision_id,
+	alias, alias IS NOT NULL AS is_alias
+FROM
+	matches
+	INNER JOIN pages USING (page_id)
+	INNER JOIN revisions ON pages.latest_revision_id = revisions.revision_id
+	INNER JOIN contents USING (content_id)
+WHERE $7 OR permissions_for(pages.page_id, $3, $4, $1, $5) & $6 != 0
+-- :endmacro
+
 -- :macro get_page_no_alias()
 -- params: guild_id, title
+-- columns: target, alias
+-- read only
 SELECT title AS target, NULL AS alias
 FROM pages
 WHERE
@@ -57,47 +91,46 @@ WHERE
 
 -- :macro get_alias()
 -- params: guild_id, title
+-- columns: target, alias
+-- read only
 SELECT pages.title AS target, aliases.title AS alias
 FROM aliases INNER JOIN pages USING (page_id)
 WHERE aliases.guild_id = $1 AND lower(aliases.title) = lower($2)
 -- :endmacro
 
--- :macro delete_page()
--- params: guild_id, title
-DELETE FROM pages
-WHERE guild_id = $1 AND lower(title) = lower($2)
--- :endmacro
-
--- :macro delete_alias()
--- params: guild_id, title
-WITH aliases_cte AS (
-	SELECT aliases.title, page_id
-	FROM aliases INNER JOIN pages USING (page_id)
-	WHERE aliases.guild_id = $1 AND lower(aliases.title) = lower($2))
-DELETE FROM aliases
-WHERE EXISTS (
-	SELECT 1 FROM aliases_cte
-	WHERE (aliases.title, aliases.page_id) = (aliases_cte.title, aliases_cte.page_id))
--- :endmacro
-
--- :macro get_page_revisions()
--- params: guild_id, title
+-- :macro get_page_history()
+-- params: guild_id, title, before_revision_id, offset, limit
+-- columns: page_id, revision_id, author_id, revised, current_title, title, chars_added, chars_removed, lines_added, lines_removed, first
+-- attributes: author
+-- read only
+-- the metadata of a page's revisions, newest first, a page of results at a time.
+-- before_revision_id is the last revision ID of the previous page of results, or NULL to start from the newest.
 SELECT
-	page_id, revision_id, author_id, content, revised, pages.title AS current_title, revisions.title,
-	lag(revision_id) OVER (PARTITION BY page_id ORDER BY revision_id) IS NULL AS first
+	page_id, revision_id, author_id, revised, pages.title AS current_title, revisions.title,
+	chars_added, chars_removed, lines_added, lines_removed,
+	NOT EXISTS (
+		SELECT FROM revisions AS r
+		WHERE r.page_id = revisions.page_id AND r.revision_id < revisions.revision_id
+	) AS first
 FROM
 	pages
 	INNER JOIN revisions USING (page_id)
-	INNER JOIN contents USING (content_id)
 WHERE
 	guild_id = $1
 	AND lower(pages.title) = lower($2)
+	-- coalesce instead of "$3 IS NULL OR" so that this is always a range scan of revisions_page_id_revision_id_idx
+	AND revision_id < coalesce($3, 2147483647)
 ORDER BY revision_id DESC
+OFFSET $4
+LIMIT $5
 -- :endmacro
 
--- :macro get_all_pages()
--- params: guild_id
+-- :macro get_all_pages(batched=False)
+-- params: guild_id, and if batched: after_title, limit
+-- columns: guild_id, title
+-- read only
 -- TODO dedupe
+-- batched gives the batch after after_title, which is the last title of the previous batch, or '' for the first one
 SELECT * FROM (
 	SELECT guild_id, title
 	FROM pages
@@ -105,13 +138,23 @@ SELECT * FROM (
 	SELECT guild_id, title
 	FROM aliases) AS why_do_subqueries_in_FROM_need_an_alias_smh_my_head
 WHERE guild_id = $1
-ORDER BY lower(title) ASC
+-- :if batched
+	AND (lower(title), title) > (lower($2), $2)
+-- :endif
+ORDER BY lower(title) ASC, title ASC
+-- :if batched
+LIMIT $3
+-- :endif
 -- :endmacro
 
 -- :macro get_recent_revisions()
 -- params: guild_id, cutoff
+-- columns: current_title, revision_id, page_id, author_id, revised, title, chars_added, chars_removed, lines_added, lines_removed, first
+-- attributes: author
+-- read only
 SELECT
 	pages.title AS current_title, revision_id, page_id, author_id, revised, revisions.title,
+	chars_added, chars_removed, lines_added, lines_removed,
 	lag(revision_id) OVER (PARTITION BY page_id ORDER BY revision_id) IS NULL AS first
 FROM revisions INNER JOIN pages USING (page_id)
 WHERE guild_id = $1 AND revised > $2
@@ -120,6 +163,8 @@ ORDER BY revised DESC
 
 -- :macro search_pages()
 -- params: guild_id, query
+-- columns: title
+-- read only
 -- TODO dedupe
 SELECT title
 FROM (
@@ -137,108 +182,87 @@ LIMIT 100
 
 -- :macro get_individual_revisions()
 -- params: guild_id, revision_ids
-WITH all_revisions AS (
-	-- TODO dedupe from get_page_revisions (use a stored proc?)
-	SELECT
-		page_id, revision_id, author_id, content, revised, pages.title AS current_title,
-		revisions.title AS title,
-		lag(revisions.title) OVER w AS prev_title,
-		lag(revision_id) OVER w IS NULL AS first
-	FROM
-		pages
-		INNER JOIN revisions USING (page_id)
-		INNER JOIN contents USING (content_id)
-	WHERE guild_id = $1
-	WINDOW w AS (
-		PARTITION BY page_id
-		ORDER BY revision_id
-		ROWS 1 PRECEDING))
--- using an outer query here prevents prematurely filtering the window funcs above to the selected revision IDs
-SELECT *
-FROM all_revisions
-WHERE revision_id = ANY ($2)
-ORDER BY revision_id ASC  -- usually this is used for diffs so we want oldest-newest
+-- columns: page_id, revision_id, author_id, content, revised, current_title, title, prev_title, first
+-- attributes: author
+-- read only
+SELECT
+	page_id, revisions.revision_id, author_id, content, revised, pages.title AS current_title,
+	revisions.title AS title,
+	previous.title AS prev_title,
+	previous.revision_id IS NULL AS first
+FROM
+	revisions
+	INNER JOIN pages USING (page_id)
+	INNER JOIN contents USING (content_id)
+	-- TODO dedupe from watch_lists.get_revision_and_previous
+	LEFT JOIN LATERAL (
+		SELECT title, revision_id
+		FROM revisions AS r
+		WHERE r.page_id = revisions.page_id AND r.revision_id < revisions.revision_id
+		ORDER BY r.revision_id DESC
+		LIMIT 1
+	) AS previous ON TRUE
+WHERE guild_id = $1 AND revisions.revision_id = ANY ($2)
+ORDER BY revisions.revision_id ASC  -- usually this is used for diffs so we want oldest-newest
 -- :endmacro
 
--- :macro create_page()
--- params: guild_id, title
-INSERT INTO pages (guild_id, title)
-VALUES ($1, $2)
-RETURNING page_id
--- :endmacro
+-- these call the procedures in functions.sql. see them for what each param means.
 
--- :macro get_page_id()
--- params: guild_id, title
-SELECT page_id
-FROM pages
-WHERE
-	guild_id = $1
-	AND lower(title) = lower($2)
+-- :macro create_page()
+-- params: editor, Permissions.create.value, title, content, chars_added, lines_added
+-- writes
+SELECT * FROM create_page($1, $2, $3, $4, $5, $6)
 -- :endmacro
 
--- :macro get_content_id()
--- params: page_id
-SELECT content_id
+-- :macro get_page_for_edit()
+-- params: guild_id, title, editor, Permissions.edit.value
+-- not read only, since revise_page needs the latest revision
+SELECT
+	pages.page_id, content, pages.title, pages.latest_revision_id,
+	aliases.title IS NOT NULL AND lower(aliases.title) = lower($2) AS is_alias,
+	has_permissions($3, pages.page_id, $4) AS allowed
 FROM
-	pages
+	aliases
+	RIGHT JOIN pages USING (page_id)
 	INNER JOIN revisions ON pages.latest_revision_id = revisions.revision_id
-WHERE pages.page_id = $1
--- :endmacro
-
--- :macro rename_page()
--- params: guild_id, old_title, new_title
-UPDATE pages
-SET title = $3
+	INNER JOIN contents USING (content_id)
 WHERE
-	lower(title) = lower($2)
-	AND guild_id = $1
-RETURNING page_id
+	pages.guild_id = $1
+	AND
+	(lower(aliases.title) = lower($2) OR lower(pages.title) = lower($2))
 -- :endmacro
 
--- :macro alias_page()
--- params: guild_id, alias_title, target_title
-WITH page AS (
-	SELECT page_id, guild_id
-	FROM pages
-	WHERE guild_id = $1 AND lower(title) = LOWER($3))
-INSERT INTO aliases (page_id, guild_id, title)
-VALUES ((SELECT page_id FROM page), (SELECT guild_id FROM page), $2)
+-- :macro revise_page()
+-- params: author_id, page_id, content, chars_added, chars_removed, lines_added, lines_removed, base_revision_id
+-- writes
+SELECT * FROM revise_page($1, $2, $3, $4, $5, $6, $7, $8)
 -- :endmacro
 
--- :macro log_page_rename()
--- params: page_id, author_id, content_id, new_title
-INSERT INTO revisions (page_id, author_id, content_id, title)
-VALUES ($1, $2, $3, $4)
+-- :macro rename_page()
+-- params: editor, old_title, new_title
+-- writes
+SELECT * FROM rename_page($1, $2, $3)
 -- :endmacro
 
--- :macro create_revision()
--- params: page_id, author_id, title, content_id
-WITH revision AS (
-	INSERT INTO revisions (page_id, author_id, title, content_id)
-	VALUES ($1, $2, $3, $4)
-	RETURNING revision_id)
-UPDATE pages
-SET latest_revision_id = (SELECT * FROM revision)
-WHERE page_id = $1
+-- :macro alias_page()
+-- params: editor, Permissions.create.value, Permissions.view.value, alias_title, target_title
+-- writes
+SELECT * FROM alias_page($1, $2, $3, $4, $5)
 -- :endmacro
 
--- :macro create_content()
--- params: content
-INSERT INTO contents (content)
-VALUES ($1)
-RETURNING content_id
+-- :macro delete_page()
+-- params: editor, Permissions.view.value, Permissions.edit.value, Permissions.delete.value, title
+-- writes
+SELECT * FROM delete_page($1, $2, $3, $4, $5)
 -- :endmacro
 
--- :macro create_first_revision()
--- for creating new pages
--- params: page_id, author_id, content_id, title
-WITH revision AS (
-	INSERT INTO revisions (page_id, author_id, content_id, title)
-	VALUES ($1, $2, $3, $4)
-	RETURNING revision_id)
-UPDATE pages
-SET latest_revision_id = (SELECT * FROM revision)
-WHERE page_id = $1
+-- :macro get_page_id()
+-- params: guild_id, title
+SELECT page_id
+FROM pages
+WHERE
+	guild_id = $1
+	AND lower(title) = lower($2)
 -- :endmacro
 
 -- :macro log_page_use()
@@ -257,6 +281,7 @@ VALUES ((SELECT * FROM page))
 
 -- :macro page_uses()
 -- params: guild_id, title, cutoff_date
+-- read only
 WITH page AS (
 	SELECT page_id
 	FROM aliases RIGHT JOIN pages USING (page_id)
@@ -270,6 +295,7 @@ WHERE page_id = (SELECT * FROM page) AND time > $3
 
 -- :macro page_revisions_count()
 -- params: guild_id, title
+-- read only
 WITH page AS (
 	SELECT page_id
 	FROM aliases RIGHT JOIN pages USING (page_id)
@@ -283,6 +309,7 @@ WHERE page_id = (SELECT * FROM page)
 
 -- :macro page_count()
 -- params: guild_id
+-- read only
 SELECT count(*)
 FROM pages
 WHERE guild_id = $1
@@ -290,6 +317,7 @@ WHERE guild_id = $1
 
 -- :macro revisions_count()
 -- params: guild_id
+-- read only
 SELECT count(*)
 FROM revisions INNER JOIN pages USING (page_id)
 WHERE guild_id = $1
@@ -297,6 +325,7 @@ WHERE guild_id = $1
 
 -- :macro total_page_uses()
 -- params: guild_id, cutoff_date
+-- read only
 SELECT count(*)
 FROM pages LEFT JOIN page_usage_history USING (page_id)
 WHERE guild_id = $1 AND time > $2
@@ -304,6 +333,8 @@ WHERE guild_id = $1 AND time > $2
 
 -- :macro top_pages()
 -- params: guild_id, cutoff_date
+-- columns: title, count
+-- read only
 SELECT title, count(time) AS count
 FROM pages LEFT JOIN page_usage_history USING (page_id)
 WHERE guild_id = $1 AND time > $2
@@ -314,6 +345,8 @@ LIMIT 3
 
 -- :macro top_editors()
 -- params: guild_id, cutoff_date
+-- columns: id, count
+-- read only
 -- TODO dedupe from top_pages
 SELECT author_id AS id, count(revision_id) AS count
 FROM revisions INNER JOIN pages USING (page_id)
@@ -325,6 +358,8 @@ LIMIT 3
 
 -- :macro top_page_editors()
 -- params: guild_id, title, cutoff_date
+-- columns: id, count, rank
+-- read only
 WITH page_id AS (
 	SELECT page_id
 	FROM pages LEFT JOIN aliases USING (page_id)
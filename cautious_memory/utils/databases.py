@@ -0,0 +1,304 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Spreads guilds across several databases, for when one isn't enough.
+
+Everything except API tokens belongs to one guild, so each guild's pages can live in a database of their own.
+The bot's pool is then a DatabaseRouter, which hands out connections to the database of the guild in the current
+context (set for each command, API request and page notification with guild_scope), or to the home database
+outside of one.
+The home database is the one configured as "database". Guilds are placed on it too, and it also holds the directory
+of which guild is on which database, and everything that doesn't belong to a guild.
+
+A guild is placed on a database by rendezvous hashing the first time it's seen, and the placement is recorded
+in the directory, so adding a database later doesn't move anyone. Guilds are moved with DatabaseRouter.move_guild.
+
+IDs are unique across databases: each database's identity columns only generate IDs congruent to its residue
+modulo MAX_DATABASES. A move copies rows as they are, so page and revision IDs users have seen stay valid.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import logging
+
+from . import errors
+from .workload import workload
+
+logger = logging.getLogger(__name__)
+
+HOME = 'home'
+MAX_DATABASES = 16
+# seconds between freezing a guild and copying it, so that every process hears about the freeze first,
+# and writes that started before it finish. Also between switching it to the new database
+# and deleting it from the old one, so that every process hears about the switch before its pages disappear.
+MOVE_GRACE = 5
+
+# every identity column, which generate IDs in their database's residue class
+IDENTITY_COLUMNS = [('pages', 'page_id'), ('revisions', 'revision_id'), ('contents', 'content_id')]
+# the tables a guild's rows are copied into when it's moved, in order, and the macros that read them
+GUILD_TABLES = [
+	('contents', 'guild_contents'),
+	('pages', 'guild_pages'),
+	('revisions', 'guild_revisions'),
+	('aliases', 'guild_aliases'),
+	('page_usage_history', 'guild_page_usage_history'),
+	('page_permissions', 'guild_page_permissions'),
+	('page_subscribers', 'guild_page_subscribers'),
+	('bound_messages', 'guild_bound_messages'),
+]
+# keeps processes from interleaving the same database's sequences at once
+PREPARE_LOCK_KEY = 0x434d5348  # 'CMSH'
+
+# the guild whose database queries run on. None means the home database.
+current_guild_id = contextvars.ContextVar('current_guild_id', default=None)
+# guilds that are being moved. Their pages can be read, but not changed.
+frozen_guilds = set()
+
+@contextlib.contextmanager
+def guild_scope(guild_id):
+	"""run the queries made in this block on guild_id's database"""
+	token = current_guild_id.set(guild_id)
+	try:
+		yield
+	finally:
+		current_guild_id.reset(token)
+
+def check_writable():
+	"""raise GuildMovingError if the guild in the current context is being moved"""
+	guild_id = current_guild_id.get()
+	if guild_id is not None and guild_id in frozen_guilds:
+		raise errors.GuildMovingError
+
+def rendezvous(guild_id, databases):
+	"""return the database that guild_id hashes to. Adding a database only moves the guilds that hash to the new one."""
+	return max(
+		databases, key=lambda database: hashlib.blake2b(f'{database}/{guild_id}'.encode(), digest_size=8).digest())
+
+class DatabaseRouter:
+	"""Looks like a Pool, but acquires connections from the current guild's database.
+
+	pools is {database name: Pool}, including HOME. queries are the databases.sql macros.
+	"""
+
+	def __init__(self, pools, queries):
+		self.pools = pools
+		self.home = pools[HOME]
+		self.queries = queries
+		# guild ID: database name
+		self.directory = {}
+		# connection: the pool it was acquired from
+		self._acquired_from = {}
+
+	async def start(self):
+		await self._prepare_databases()
+		for row in await self.home.fetch(self.queries.get_directory()):
+			self._placed(row['guild_id'], row['database'], row['frozen'])
+
+	async def close(self):
+		await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+
+	def _placed(self, guild_id, database, frozen):
+		self.directory[guild_id] = database
+		if frozen:
+			frozen_guilds.add(guild_id)
+		else:
+			frozen_guilds.discard(guild_id)
+
+	def directory_changed(self, payload):
+		"""handle a guild_database_change notification"""
+		guild_id, frozen, database = payload.split(',', 2)
+		self._placed(int(guild_id), database, frozen == 'true')
+
+	async def database_of(self, guild_id):
+		"""return the name of guild_id's database, placing the guild on one if it doesn't have one yet"""
+		try:
+			return self.directory[guild_id]
+		except KeyError:
+			pass
+
+		row = await self.home.fetchrow(self.queries.place_guild(), guild_id, rendezvous(guild_id, self.pools))
+		self._placed(guild_id, row['database'], row['frozen'])
+		return row['database']
+
+	async def pool_for(self, guild_id):
+		if guild_id is None:
+			return self.home
+		database = await self.database_of(guild_id)
+		try:
+			return self.pools[database]
+		except KeyError:
+			raise RuntimeError(f'guild {guild_id} is on database {database!r}, which is not configured') from None
+
+	### Pool interface
+
+	def acquire(self, *, timeout=None):
+		return _RoutedAcquireContext(self, timeout)
+
+	async def _acquire(self, timeout):
+		pool = await self.pool_for(current_guild_id.get())
+		connection = await pool.acquire(timeout=timeout)
+		self._acquired_from[connection] = pool
+		return connection
+
+	async def release(self, connection, *, timeout=None):
+		await self._acquired_from.pop(connection).release(connection, timeout=timeout)
+
+	async def execute(self, query, *args, timeout=None):
+		return await (await self.pool_for(current_guild_id.get())).execute(query, *args, timeout=timeout)
+
+	async def executemany(self, command, args, *, timeout=None):
+		return await (await self.pool_for(current_guild_id.get())).executemany(command, args, timeout=timeout)
+
+	async def fetch(self, query, *args, timeout=None):
+		return await (await self.pool_for(current_guild_id.get())).fetch(query, *args, timeout=timeout)
+
+	async def fetchrow(self, query, *args, timeout=None):
+		return await (await self.pool_for(current_guild_id.get())).fetchrow(query, *args, timeout=timeout)
+
+	async def fetchval(self, query, *args, column=0, timeout=None):
+		return await (await self.pool_for(current_guild_id.get())).fetchval(
+			query, *args, column=column, timeout=timeout)
+
+	### Setup
+
+	async def _prepare_databases(self):
+		"""give each database an ID residue, and make the identity columns of those that don't use theirs yet do so"""
+		async with self.home.acquire() as conn, conn.transaction():
+			await conn.execute('SELECT pg_advisory_xact_lock($1)', PREPARE_LOCK_KEY)
+			for name in self.pools:
+				await conn.execute(self.queries.add_database(), name, MAX_DATABASES)
+			residues = {row['name']: row['id_residue'] for row in await conn.fetch(self.queries.get_databases())}
+			for table, column in IDENTITY_COLUMNS:
+				await self._interleave(table, column, residues)
+
+	async def _interleave(self, table, column, residues):
+		sequence_query = f"""
+			SELECT seqincrement, greatest(pg_sequence_last_value(seqrelid), (SELECT max({column}) FROM {table}), 0)
+			FROM pg_sequence
+			WHERE seqrelid = pg_get_serial_sequence('{table}', '{column}')::regclass
+		"""
+		sequences = {}
+		for name, pool in self.pools.items():
+			async with pool.acquire() as conn:
+				sequences[name] = await conn.fetchrow(sequence_query)
+
+		for name, (increment, _) in sequences.items():
+			if increment == MAX_DATABASES:
+				continue
+
+			async with self.pools[name].acquire() as conn, conn.transaction():
+				# nothing may be inserted between finding the highest ID and restarting the sequence above it
+				await conn.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE')
+				_, own_highest = await conn.fetchrow(sequence_query)
+				highest = max(own_highest, *(highest for _, highest in sequences.values()))
+				start = highest + 1
+				start += (residues[name] - start) % MAX_DATABASES
+				await conn.execute(
+					f'ALTER TABLE {table} ALTER COLUMN {column} SET INCREMENT BY {MAX_DATABASES} RESTART WITH {start}')
+				logger.info(
+					'database %s: %s.%s now starts at %d, counting by %d', name, table, column, start, MAX_DATABASES)
+
+	### Moving guilds
+
+	@workload('background')
+	async def move_guild(self, guild_id, target, *, role_ids=(), grace=MOVE_GRACE):
+		"""Move a guild's pages to another database while the bot is running. Return how many rows were copied.
+
+		role_ids are the IDs of the guild's roles, whose permissions are moved too, since role permissions
+		don't record which guild they're in. The guild's pages can be read throughout, but not changed
+		until they have been copied, which takes about grace seconds plus the time taken to copy them.
+		They are deleted from the source database grace seconds after that.
+		"""
+		if target not in self.pools:
+			raise ValueError(f'There is no database called {target}.')
+
+		# the directory is changed from outside of any guild, in case the guild being moved is the current one
+		with guild_scope(None):
+			source = await self.database_of(guild_id)
+			if source == target:
+				raise ValueError(f'That guild is already on {target}.')
+			if source not in self.pools:
+				raise ValueError(f'That guild is on {source}, which is not configured.')
+
+			await self.home.execute(self.queries.set_guild_frozen(), guild_id, True)
+			frozen_guilds.add(guild_id)
+			try:
+				await asyncio.sleep(grace)
+				copied = await self._copy_guild(guild_id, source, target, [guild_id, *role_ids])
+			except BaseException:
+				await self.home.execute(self.queries.set_guild_frozen(), guild_id, False)
+				raise
+
+			# processes that haven't heard about the switch yet still read the guild from the source
+			await asyncio.sleep(grace)
+			async with self.pools[source].acquire() as conn, conn.transaction():
+				# the page triggers stay quiet, since the pages aren't really being deleted
+				await conn.execute("SET LOCAL cautious_memory.moving_guild = 'on'")
+				await conn.execute(self.queries.delete_guild(), guild_id, [guild_id, *role_ids])
+
+		logger.info('moved guild %d from %s to %s (%d rows)', guild_id, source, target, copied)
+		return copied
+
+	async def _copy_guild(self, guild_id, source, target, role_ids):
+		"""copy the guild's rows to the target, and switch the guild to it. return how many rows were copied"""
+		# Nothing writes to the frozen guild by now, so a snapshot has all of its rows.
+		# This doesn't lock anything, so the other guilds on the source can still be edited.
+		async with self.pools[source].acquire() as conn, conn.transaction(isolation='repeatable_read', readonly=True):
+			tables = [
+				(table, await conn.fetch(getattr(self.queries, macro)(), guild_id)) for table, macro in GUILD_TABLES]
+			tables.append(('role_permissions', await conn.fetch(self.queries.guild_role_permissions(), role_ids)))
+
+		async with self.pools[target].acquire() as conn, conn.transaction():
+			await conn.execute("SET LOCAL cautious_memory.moving_guild = 'on'")
+			# left over from an earlier attempt that failed after copying
+			await conn.execute(self.queries.delete_guild(), guild_id, role_ids)
+			for table, rows in tables:
+				if rows:
+					await conn.copy_records_to_table(table, records=rows, columns=list(rows[0].keys()))
+
+		# from here on, the guild is read from and written to the target
+		await self.home.execute(self.queries.set_guild_database(), guild_id, target)
+		# without waiting for the notification, which would otherwise be a moment in which this process
+		# reads the guild's pages from the source after they have been deleted there
+		self._placed(guild_id, target, False)
+		return sum(len(rows) for _, rows in tables)
+
+	async def guild_counts(self):
+		"""return {database name: (guilds, frozen guilds)}"""
+		counts = dict.fromkeys(self.pools, (0, 0))
+		for row in await self.home.fetch(self.queries.database_guild_counts()):
+			counts[row['database']] = (row['guilds'], row['frozen'])
+		return counts
+
+class _RoutedAcquireContext:
+	__slots__ = ('pool', 'timeout', 'connection')
+
+	def __init__(self, pool, timeout):
+		self.pool = pool
+		self.timeout = timeout
+		self.connection = None
+
+	def __await__(self):
+		return self.pool._acquire(self.timeout).__await__()
+
+	async def __aenter__(self):
+		self.connection = await self.pool._acquire(self.timeout)
+		return self.connection
+
+	async def __aexit__(self, *excinfo):
+		connection, self.connection = self.connection, None
+		await self.pool.release(connection)
@@ -0,0 +1,341 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A line and word level diff for page revisions.
+
+Pages are often a single long paragraph, so a line based diff shows a one word change as the whole page being
+removed and added again. Here lines are compared first, and then the words of each block of changed lines,
+so that only the words that changed are marked, like git diff --word-diff:
+
+	  an unchanged line
+	! some [-removed-]{+added+} words
+	- a removed line
+	+ an added line
+
+Unchanged text is shortened to a little context around the changes, to fit in as few messages as possible.
+
+Two edits of the same revision are combined with three_way_merge, word by word for the same reason.
+"""
+
+import re
+
+from . import escape_code_blocks
+
+# words, runs of whitespace other than newlines, newlines, and single punctuation characters
+TOKEN_RE = re.compile(r'\n|[^\S\n]+|\w+|[^\w\s]')
+# unchanged lines to show on each side of a change
+CONTEXT_LINES = 1
+# unchanged characters to show on each side of a change within a line
+CONTEXT_CHARS = 40
+# longer unchanged lines are cut off
+MAX_CONTEXT_LINE_LENGTH = 80
+# past this many edits, give up and show the sequences as replaced outright. This keeps the worst case,
+# two completely different pages, at a few tens of milliseconds.
+MAX_EDIT_DISTANCE = 500
+
+EQUAL, DELETE, INSERT = ' ', '-', '+'
+
+def myers(a, b, *, max_edit_distance=MAX_EDIT_DISTANCE):
+	"""Return the shortest edit script turning sequence a into sequence b, as a list of (op, items) runs,
+	where op is EQUAL, DELETE or INSERT. Deletions come before insertions where the two are adjacent.
+	"""
+	prefix = 0
+	while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+		prefix += 1
+	suffix = 0
+	while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+		suffix += 1
+
+	runs = [(EQUAL, a[:prefix])]
+	runs.extend(_shortest_edit(a[prefix:len(a) - suffix], b[prefix:len(b) - suffix], max_edit_distance))
+	runs.append((EQUAL, a[len(a) - suffix:]))
+	return _coalesce(runs)
+
+def _shortest_edit(a, b, max_edit_distance):
+	# the greedy O((N+M)D) algorithm from Myers' "An O(ND) Difference Algorithm and Its Variations",
+	# keeping the furthest reaching x of each diagonal k after every round so that the path can be traced back
+	n, m = len(a), len(b)
+	if not n or not m:
+		return [(DELETE, a), (INSERT, b)]
+
+	v = {1: 0}
+	trace = []
+	for d in range(min(n + m, max_edit_distance) + 1):
+		trace.append(v.copy())
+		for k in range(-d, d + 1, 2):
+			if k == -d or k != d and v[k - 1] < v[k + 1]:
+				x = v[k + 1]
+			else:
+				x = v[k - 1] + 1
+			y = x - k
+			while x < n and y < m and a[x] == b[y]:
+				x += 1
+				y += 1
+			v[k] = x
+			if x >= n and y >= m:
+				return _backtrack(a, b, trace)
+
+	return [(DELETE, a), (INSERT, b)]
+
+def _backtrack(a, b, trace):
+	x, y = len(a), len(b)
+	ops = []
+	for d in reversed(range(len(trace))):
+		v = trace[d]
+		k = x - y
+		prev_k = k + 1 if k == -d or k != d and v[k - 1] < v[k + 1] else k - 1
+		prev_x = v[prev_k]
+		prev_y = prev_x - prev_k
+		while x > prev_x and y > prev_y:
+			x -= 1
+			y -= 1
+			ops.append((EQUAL, a[x]))
+		if d:
+			ops.append((DELETE, a[prev_x]) if x > prev_x else (INSERT, b[prev_y]))
+		x, y = prev_x, prev_y
+	ops.reverse()
+	return [(op, [item]) for op, item in ops]
+
+def _coalesce(runs):
+	"""merge adjacent runs of the same op, and put deletions before insertions within each changed region"""
+	result = []
+	deleted, inserted = [], []
+	for op, items in runs:
+		if op == DELETE:
+			deleted.extend(items)
+		elif op == INSERT:
+			inserted.extend(items)
+		elif items:
+			_flush(result, deleted, inserted)
+			deleted, inserted = [], []
+			if result and result[-1][0] == EQUAL:
+				result[-1][1].extend(items)
+			else:
+				result.append((EQUAL, list(items)))
+	_flush(result, deleted, inserted)
+	return result
+
+def _flush(result, deleted, inserted):
+	if deleted:
+		result.append((DELETE, deleted))
+	if inserted:
+		result.append((INSERT, inserted))
+
+def _absorb_whitespace(runs):
+	"""Turn whitespace between two changes into a change, so that "a b" → "c d" is shown as one replacement
+	instead of two replacements separated by a space.
+	"""
+	for i in range(1, len(runs) - 1):
+		op, items = runs[i]
+		if op == EQUAL and runs[i - 1][0] != EQUAL and runs[i + 1][0] != EQUAL and all(
+			not item.strip() and item != '\n' for item in items
+		):
+			runs[i] = (DELETE, items)
+			runs.insert(i + 1, (INSERT, list(items)))
+	return _coalesce(runs)
+
+def diff_segments(old, new):
+	"""return the differences between old and new as a list of (op, text) segments"""
+	old_lines = old.splitlines(keepends=True)
+	new_lines = new.splitlines(keepends=True)
+	segments = []
+	runs = myers(old_lines, new_lines)
+	i = 0
+	while i < len(runs):
+		op, lines = runs[i]
+		if op == DELETE and i + 1 < len(runs) and runs[i + 1][0] == INSERT:
+			# compare the words of lines that were replaced
+			words = myers(TOKEN_RE.findall(''.join(lines)), TOKEN_RE.findall(''.join(runs[i + 1][1])))
+			segments.extend((op, ''.join(words)) for op, words in _absorb_whitespace(words))
+			i += 2
+		else:
+			segments.append((op, ''.join(lines)))
+			i += 1
+	return segments
+
+def change_stats(old, new):
+	"""return (characters added, characters removed, lines added, lines removed) going from old to new"""
+	chars_added = chars_removed = 0
+	for op, text in diff_segments(old, new):
+		if op == INSERT:
+			chars_added += len(text)
+		elif op == DELETE:
+			chars_removed += len(text)
+
+	lines_added = lines_removed = 0
+	for op, lines in myers(old.splitlines(), new.splitlines()):
+		if op == INSERT:
+			lines_added += len(lines)
+		elif op == DELETE:
+			lines_removed += len(lines)
+
+	return chars_added, chars_removed, lines_added, lines_removed
+
+def _changes(a, b):
+	"""return the changes turning a into b as a list of (start, end, replacement) tuples, where a[start:end]
+	is replaced by the list replacement
+	"""
+	changes = []
+	position = 0
+	changing = False
+	for op, items in myers(a, b):
+		if op == EQUAL:
+			position += len(items)
+			changing = False
+			continue
+		if not changing:
+			changes.append((position, position, []))
+			changing = True
+		start, end, replacement = changes[-1]
+		if op == DELETE:
+			position += len(items)
+			changes[-1] = (start, position, replacement)
+		else:
+			replacement.extend(items)
+	return changes
+
+def three_way_merge(base, theirs, mine):
+	"""Combine two edits of base, theirs and mine, like diff3. Return the merged text, or None if they conflict:
+	if they change the same words, or words next to each other, in different ways.
+	"""
+	if theirs == mine or mine == base:
+		return theirs
+	if theirs == base:
+		return mine
+
+	base_tokens = TOKEN_RE.findall(base)
+	changes = sorted(
+		_changes(base_tokens, TOKEN_RE.findall(theirs)) + _changes(base_tokens, TOKEN_RE.findall(mine)),
+		key=lambda change: change[:2])
+
+	merged = []
+	position = 0
+	i = 0
+	while i < len(changes):
+		start, end, replacement = changes[i]
+		i += 1
+		# the changes of one side never touch each other, so this one is from the other side
+		while i < len(changes) and changes[i][0] <= end:
+			if changes[i] != (start, end, replacement):
+				return None
+			# both made the same change
+			i += 1
+		merged.extend(base_tokens[position:start])
+		merged.extend(replacement)
+		position = end
+	merged.extend(base_tokens[position:])
+	return ''.join(merged)
+
+class _Line:
+	__slots__ = ('parts', 'old_number', 'new_number', 'end_op')
+
+	def __init__(self, old_number, new_number):
+		self.parts = []
+		self.old_number = old_number
+		self.new_number = new_number
+		# the op of the newline that ended this line
+		self.end_op = EQUAL
+
+	@property
+	def op(self):
+		ops = {op for op, text in self.parts} | {self.end_op}
+		return ops.pop() if len(ops) == 1 else '!'
+
+	def render(self):
+		op = self.op
+		if op == EQUAL:
+			text = ''.join(text for op, text in self.parts)
+			if len(text) > MAX_CONTEXT_LINE_LENGTH:
+				text = text[:MAX_CONTEXT_LINE_LENGTH] + '…'
+		elif op != '!':
+			text = ''.join(text for op, text in self.parts)
+		else:
+			parts = self.parts
+			if self.end_op != EQUAL:
+				# the line was joined with the next one, or split in two
+				parts = parts + [(self.end_op, '↵')]
+			rendered = []
+			for i, (part_op, part) in enumerate(parts):
+				if part_op == DELETE:
+					rendered.append(f'[-{part}-]')
+				elif part_op == INSERT:
+					rendered.append(f'{{+{part}+}}')
+				else:
+					rendered.append(_shorten(part, first=i == 0, last=i == len(parts) - 1))
+			text = ''.join(rendered)
+		return escape_code_blocks(f'{op} {text}'.rstrip())
+
+def _shorten(text, *, first, last):
+	keep_start = 0 if first else CONTEXT_CHARS
+	keep_end = 0 if last else CONTEXT_CHARS
+	if len(text) <= keep_start + keep_end + 1:
+		return text
+	start = text[:keep_start]
+	end = text[len(text) - keep_end:]
+	# cut at word boundaries where there are any
+	if ' ' in start.strip():
+		start = start[:start.rstrip().rindex(' ') + 1]
+	if ' ' in end.strip():
+		end = end[end.lstrip().index(' ') + len(end) - len(end.lstrip()):]
+	return start + '…' + end
+
+def _lines(segments):
+	old_number = new_number = 1
+	line = _Line(old_number, new_number)
+	lines = [line]
+	for op, text in segments:
+		*complete, rest = text.split('\n')
+		for part in complete:
+			if part:
+				line.parts.append((op, part))
+			line.end_op = op
+			if op != INSERT:
+				old_number += 1
+			if op != DELETE:
+				new_number += 1
+			line = _Line(old_number, new_number)
+			lines.append(line)
+		if rest:
+			line.parts.append((op, rest))
+	if not line.parts:
+		# the text ended in a newline
+		lines.pop()
+	return lines
+
+def _normalize(text):
+	# a missing newline at the end of a page is not visible on Discord
+	text = text.rstrip('\n')
+	return text + '\n' if text else text
+
+def word_diff(old, new):
+	"""return a compact line and word level diff of old and new, or None if they are the same"""
+	old, new = _normalize(old), _normalize(new)
+	if old == new:
+		return None
+
+	lines = _lines(diff_segments(old, new))
+	changed = [i for i, line in enumerate(lines) if line.op != EQUAL]
+	shown = set()
+	for i in changed:
+		shown.update(range(max(0, i - CONTEXT_LINES), min(len(lines), i + CONTEXT_LINES + 1)))
+
+	rendered = []
+	for i in sorted(shown):
+		if i and i - 1 not in shown:
+			# some unchanged lines were left out
+			line = lines[i]
+			rendered.append(f'@@ -{line.old_number} +{line.new_number} @@')
+		rendered.append(lines[i].render())
+	return '\n'.join(rendered)
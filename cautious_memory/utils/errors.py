@@ -60,3 +60,38 @@ class PageContentTooLongError(PageError):
 	def __init__(self, content, limit):
 		super().__init__(
 			f'That page would be {len(content)} characters long, but the limit is {limit} characters.')
+
+class EditConflictError(PageError):
+	"""Raised when an edit and one made since the revision it was based on change the same part of a page."""
+	def __init__(self, base_revision_id, latest_revision_id):
+		self.base_revision_id = base_revision_id
+		self.latest_revision_id = latest_revision_id
+		super().__init__(
+			f'The page has been edited since revision {base_revision_id}, and those changes overlap with yours. '
+			f'Its latest revision is {latest_revision_id}.')
+
+class EditContentionError(EditConflictError):
+	"""Raised when an edit loses the race with other edits to the same page every time it is tried."""
+	def __init__(self, base_revision_id, latest_revision_id):
+		self.base_revision_id = base_revision_id
+		self.latest_revision_id = latest_revision_id
+		# skip EditConflictError's message, since these edits don't necessarily overlap
+		PageError.__init__(
+			self,
+			f'The page is being edited too often for your edit to go in. Its latest revision is {latest_revision_id}. '
+			'Please try again.')
+
+class RateLimitedError(CautiousMemoryError, UserInputError):
+	"""Raised when a user, guild, or API application is performing some action too often."""
+	SCOPE_SUBJECTS = {'user': 'You are', 'guild': 'This server is', 'app': 'This API application is'}
+
+	def __init__(self, scope, retry_after):
+		self.scope = scope
+		self.retry_after = retry_after
+		super().__init__(f'{self.SCOPE_SUBJECTS[scope]} doing that too often. Try again in {retry_after:.1f}s.')
+
+class GuildMovingError(CautiousMemoryError, UserInputError):
+	"""Raised when changing a guild's pages while they're being moved to another database."""
+
+	def __init__(self):
+		super().__init__("This server's pages are being moved to another database. Try again in a minute.")
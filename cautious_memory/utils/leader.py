@@ -0,0 +1,199 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Leader election for background duties, so that when several processes run the same shards
+(for instance, a standby kept up in case the main one dies), each duty is done by exactly one of them.
+
+Each duty is a session level advisory lock held on a connection used for nothing else. Postgres releases the lock
+as soon as that connection is closed, so when the holder exits or crashes another process takes over within one
+renewal interval. A holder that can no longer reach the database stops doing the duty once its lease runs out,
+which is before Postgres' keepalives notice the connection is gone and let anyone else take it.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import logging
+import os
+import socket
+import time
+import zlib
+
+import asyncpg
+
+from .metrics import exposition
+
+logger = logging.getLogger(__name__)
+
+# the first key of every advisory lock taken here, so that they don't collide with any others on the same database
+LOCK_NAMESPACE = 0x434d  # 'CM'
+
+def duty_key(scope, name):
+	# advisory lock keys are int4, and pg_locks shows the second one as an unsigned oid, so keep it positive
+	return zlib.crc32(f'{scope}/{name}'.encode()) & 0x7fffffff
+
+class Duty:
+	__slots__ = ('name', 'key', 'held', 'since', 'renewed')
+
+	def __init__(self, name, key):
+		self.name = name
+		self.key = key
+		self.held = False
+		# when we became the leader, for the status command
+		self.since = None
+		# time.monotonic() of the last renewal that confirmed we still hold the lock
+		self.renewed = None
+
+class LeaderElection:
+	"""Elects one leader for each registered duty among all processes that share a database and a scope.
+
+	Every renew_interval seconds, the locks we hold are checked and the ones we don't are tried.
+	is_leader() is only true for lease seconds after the last successful check.
+	"""
+
+	def __init__(self, connect_kwargs, *, scope='', renew_interval=5, lease=15):
+		if lease <= renew_interval:
+			raise ValueError('the lease must be longer than the renewal interval')
+		self.connect_kwargs = connect_kwargs
+		self.scope = scope
+		self.renew_interval = renew_interval
+		self.lease = lease
+		# shown as the owner of our locks in the status command
+		self.identity = f'cautious-memory {socket.gethostname()}:{os.getpid()} {scope}'.strip()[:63]
+		self.duties = {}
+		self.conn = None
+		self.task = None
+		self.wakeup = asyncio.Event()
+		self.elections_total = 0
+
+	def register(self, name):
+		"""start competing for a duty. Takes effect at the next renewal, which is scheduled right away."""
+		if name not in self.duties:
+			self.duties[name] = Duty(name, duty_key(self.scope, name))
+			self.wakeup.set()
+
+	async def unregister(self, name):
+		"""stop doing a duty, letting another process take it over"""
+		duty = self.duties.pop(name, None)
+		if duty is not None and duty.held and self.conn is not None:
+			duty.held = False
+			try:
+				await self.conn.execute('SELECT pg_advisory_unlock($1, $2)', LOCK_NAMESPACE, duty.key)
+			except (asyncpg.PostgresError, OSError):
+				pass  # the lock goes with the connection anyway
+
+	def is_leader(self, name):
+		duty = self.duties.get(name)
+		return duty is not None and duty.held and time.monotonic() - duty.renewed < self.lease
+
+	async def start(self):
+		self.task = asyncio.create_task(self._run(), name='leader election')
+
+	async def stop(self):
+		if self.task is not None:
+			self.task.cancel()
+			with contextlib.suppress(asyncio.CancelledError):
+				await self.task
+		if self.conn is not None:
+			# closing the connection releases every lock at once, so the others take over right away
+			await self.conn.close()
+			self.conn = None
+
+	async def _connect(self):
+		timeout = str(self.lease)
+		connect_kwargs = dict(self.connect_kwargs)
+		server_settings = connect_kwargs.pop('server_settings', {})
+		self.conn = await asyncpg.connect(**connect_kwargs, timeout=self.renew_interval, server_settings={
+			**server_settings,
+			'application_name': self.identity,
+			# if we vanish without closing the connection, the server drops it, releasing our locks,
+			# a few seconds after we would have stopped considering ourselves the leader
+			'tcp_keepalives_idle': timeout,
+			'tcp_keepalives_interval': '1',
+			'tcp_keepalives_count': '3',
+		})
+
+	async def _run(self):
+		while True:
+			try:
+				if self.conn is not None and self.conn.is_closed():
+					logger.warning('leader election: the database connection was closed, giving up all duties')
+					self.conn = None
+				if self.conn is None:
+					self._release_all()
+					await self._connect()
+				await asyncio.wait_for(self._renew(), self.renew_interval)
+			except asyncio.CancelledError:
+				raise
+			except Exception as exc:
+				logger.warning('leader election: lost the database connection (%r), giving up all duties', exc)
+				self._release_all()
+				if self.conn is not None:
+					self.conn.terminate()
+					self.conn = None
+
+			self.wakeup.clear()
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), self.renew_interval)
+			except asyncio.TimeoutError:
+				pass
+
+	async def _renew(self):
+		# checked in one round trip: which of our duties' locks this connection holds now
+		held = {key for key, in await self.conn.fetch("""
+			SELECT objid::int
+			FROM pg_locks
+			WHERE locktype = 'advisory' AND pid = pg_backend_pid() AND classid = $1 AND objsubid = 2 AND granted
+		""", LOCK_NAMESPACE)}
+
+		now = time.monotonic()
+		for duty in list(self.duties.values()):
+			if duty.key in held:
+				duty.renewed = now
+				continue
+
+			if duty.held:
+				logger.warning('leader election: lost the lock for %s', duty.name)
+				duty.held = False
+			if await self.conn.fetchval('SELECT pg_try_advisory_lock($1, $2)', LOCK_NAMESPACE, duty.key):
+				logger.info('leader election: now the leader for %s', duty.name)
+				duty.held = True
+				duty.since = datetime.datetime.utcnow()
+				duty.renewed = time.monotonic()
+				self.elections_total += 1
+
+	def _release_all(self):
+		for duty in self.duties.values():
+			duty.held = False
+
+	async def owners(self, connection):
+		"""return {duty name: (application name, pid, backend start)} of every duty with a leader"""
+		keys = {duty.key: duty.name for duty in self.duties.values()}
+		rows = await connection.fetch("""
+			SELECT objid::int AS key, application_name, pid, backend_start
+			FROM pg_locks INNER JOIN pg_stat_activity USING (pid)
+			WHERE locktype = 'advisory' AND classid = $1 AND objsubid = 2 AND granted AND objid::int = any($2::int[])
+		""", LOCK_NAMESPACE, list(keys))
+		return {keys[row['key']]: (row['application_name'], row['pid'], row['backend_start']) for row in rows}
+
+	def prometheus(self):
+		return ''.join([
+			exposition(
+				'cm_leader', 'gauge', 'Whether this process is the leader for each background duty.',
+				[('cm_leader', {'duty': name}, int(self.is_leader(name))) for name in self.duties]),
+			exposition(
+				'cm_leader_elections_total', 'counter', 'Times this process became the leader for a duty.',
+				[('cm_leader_elections_total', {}, self.elections_total)]),
+		])
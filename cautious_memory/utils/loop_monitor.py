@@ -0,0 +1,125 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import datetime
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from .metrics import Histogram, exposition
+
+logger = logging.getLogger(__name__)
+
+class Block:
+	"""A time the event loop was blocked for longer than the threshold."""
+	__slots__ = ('id', 'at', 'task', 'stack', 'duration')
+
+	def __init__(self, id, task, stack):
+		self.id = id
+		self.at = datetime.datetime.utcnow()
+		self.task = task
+		self.stack = stack
+		# how late the heartbeat was in the end. None while the loop is still blocked.
+		self.duration = None
+
+class LoopLagMonitor:
+	"""Measures event loop lag: how much later than scheduled a heartbeat task wakes up every interval seconds.
+
+	A watchdog thread notices when the heartbeat is more than threshold seconds late, and records the stack of the
+	loop thread at that moment, which is usually the code that is blocking it.
+	"""
+
+	def __init__(self, *, interval=0.1, threshold=0.25, capacity=20):
+		self.interval = interval
+		self.threshold = threshold
+		self.lag = Histogram()
+		self.max_lag = 0
+		self.blocks = collections.deque(maxlen=capacity)
+		self.blocks_total = 0
+		self.ids = itertools.count(1)
+		self.last_beat = None
+		# the beat after which the watchdog last recorded a block, so that each stall is only recorded once
+		self.captured_beat = None
+		self.current_block = None
+		self.task = None
+		self.stopped = threading.Event()
+
+	def start(self, loop):
+		"""start monitoring. This must be called from the thread running loop."""
+		self.loop = loop
+		self.loop_thread_id = threading.get_ident()
+		self.last_beat = time.perf_counter()
+		self.task = loop.create_task(self._heartbeat())
+		threading.Thread(target=self._watch, name='loop lag watchdog', daemon=True).start()
+
+	def stop(self):
+		self.stopped.set()
+		if self.task is not None:
+			self.task.cancel()
+
+	async def _heartbeat(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			now = time.perf_counter()
+			lag = max(0, now - self.last_beat - self.interval)
+			self.last_beat = now
+			self.lag.observe(lag)
+			self.max_lag = max(self.max_lag, lag)
+
+			block, self.current_block = self.current_block, None
+			if block is not None:
+				block.duration = lag
+				logger.warning('the event loop was blocked for %.1fms in %s (block %s)', lag * 1000, block.task, block.id)
+
+	def _watch(self):
+		while not self.stopped.wait(self.interval / 2):
+			last_beat = self.last_beat
+			if time.perf_counter() - last_beat - self.interval < self.threshold or last_beat == self.captured_beat:
+				continue
+
+			self.captured_beat = last_beat
+			frame = sys._current_frames().get(self.loop_thread_id)
+			if frame is None:
+				continue
+			task = asyncio.current_task(self.loop)
+			stack = ''.join(traceback.format_stack(frame))
+			if self.last_beat != last_beat:
+				# the loop got unblocked while we were looking, so the stack is of something else
+				continue
+
+			block = Block(next(self.ids), task.get_name() if task is not None else 'a callback outside of any task', stack)
+			self.blocks.append(block)
+			self.blocks_total += 1
+			self.current_block = block
+
+	def get(self, id):
+		for block in self.blocks:
+			if block.id == id:
+				return block
+
+	def prometheus(self):
+		return ''.join([
+			exposition(
+				'cm_event_loop_lag_seconds', 'histogram', 'How late the event loop heartbeat ran.',
+				self.lag.samples('cm_event_loop_lag_seconds')),
+			exposition(
+				'cm_event_loop_blocks_total', 'counter', 'Times the event loop was blocked for longer than the threshold.',
+				[('cm_event_loop_blocks_total', {}, self.blocks_total)]),
+		])
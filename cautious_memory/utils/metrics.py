@@ -0,0 +1,89 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import math
+
+class Histogram:
+	# in seconds
+	DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+	__slots__ = ('buckets', 'counts', 'sum', 'count')
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = buckets
+		# the last count is for the implicit +Inf bucket
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	@property
+	def mean(self):
+		return self.sum / self.count if self.count else 0
+
+	def quantile(self, q):
+		"""estimate the q-quantile, by linear interpolation within the bucket it falls in"""
+		if not self.count:
+			return 0
+
+		rank = q * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			if seen + count >= rank and count:
+				lower = self.buckets[i - 1] if i else 0
+				if i == len(self.buckets):
+					# we don't know how far the +Inf bucket goes
+					return lower
+				return lower + (self.buckets[i] - lower) * (rank - seen) / count
+			seen += count
+		return self.buckets[-1]
+
+	def samples(self, name, labels=None):
+		"""yield the Prometheus samples for this histogram"""
+		labels = labels or {}
+		cumulative = 0
+		for bound, count in zip(self.buckets + (math.inf,), self.counts):
+			cumulative += count
+			yield f'{name}_bucket', {**labels, 'le': format_value(bound)}, cumulative
+		yield f'{name}_sum', labels, self.sum
+		yield f'{name}_count', labels, self.count
+
+def format_value(value):
+	if value == math.inf:
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def escape_label(value):
+	return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+def exposition(name, type, help, samples):
+	"""render one metric family in the Prometheus text format.
+
+	samples is an iterable of (sample name, labels, value) tuples.
+	"""
+	lines = [f'# HELP {name} {help}', f'# TYPE {name} {type}']
+	for sample_name, labels, value in samples:
+		lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+	return '\n'.join(lines) + '\n'
@@ -303,6 +303,47 @@ class Pages:
 
 			await self.match()
 
+class KeysetPages(Pages):
+	"""Like Pages, but the entries are fetched a page at a time, for lists too long to fetch all at once.
+
+	Parameters
+	------------
+	fetch: Callable[[Any, int, int], Awaitable[List[Tuple[Any, str]]]]
+		Called as fetch(after, offset, limit). Returns up to limit (key, entry) pairs,
+		skipping the first offset entries after the entry whose key is after (or from the start, if after is None).
+		Going to the next or previous page only needs the key of the last entry of the page before it,
+		so offset is 0 unless the user jumps past pages that weren't shown yet.
+	count: int
+		How many entries there are in total.
+	"""
+	def __init__(self, ctx, *, fetch, count, **kwargs):
+		# until a page is shown, only the number of entries is used
+		super().__init__(ctx, entries=range(count), **kwargs)
+		self.fetch = fetch
+		# page number → entries on that page
+		self.loaded = {}
+		# page number → key of the last entry on that page
+		self.last_keys = {}
+
+	async def load_page(self, page):
+		if page in self.loaded:
+			return
+
+		previous = max((loaded for loaded in self.last_keys if loaded < page), default=None)
+		after = self.last_keys.get(previous)
+		offset = (page - (previous or 0) - 1) * self.per_page
+		rows = await self.fetch(after, offset, self.per_page)
+		self.loaded[page] = [entry for key, entry in rows]
+		if rows:
+			self.last_keys[page] = rows[-1][0]
+
+	def get_page(self, page):
+		return self.loaded[page]
+
+	async def show_page(self, page, *, first=False):
+		await self.load_page(page)
+		return await super().show_page(page, first=first)
+
 class FieldPages(Pages):
 	"""
 	Similar to Pages except entries should be a list of
@@ -0,0 +1,180 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A sampling profiler for the thread running the event loop.
+
+A separate thread looks at the loop thread's stack every millisecond, so the profiled code is not slowed down
+except by the GIL being taken briefly. A coroutine's callers are on the stack while it runs, and each stack is rooted
+at the name of the task that was running, so samples from different commands and listeners can be told apart.
+"""
+
+import asyncio
+import collections
+import sys
+import threading
+import time
+
+# so that a forgotten profile can't keep sampling forever
+MAX_DURATION = 300
+MAX_DEPTH = 128
+
+def _frame_key(frame):
+	code = frame.f_code
+	module = frame.f_globals.get('__name__', '?')
+	return module, getattr(code, 'co_qualname', code.co_name), code.co_filename, code.co_firstlineno
+
+class Profile:
+	"""The stacks seen by a profiler, and how many microseconds each one accounted for."""
+
+	def __init__(self, mode, interval):
+		self.mode = mode
+		self.interval = interval
+		# stack (tuple of frame keys, outermost first) → microseconds
+		self.stacks = collections.Counter()
+		self.samples = 0
+		self.duration = 0
+
+	def add(self, stack, weight):
+		self.stacks[stack] += weight
+		self.samples += 1
+
+	@staticmethod
+	def frame_name(key):
+		module, qualname, filename, line = key
+		return f'{module}.{qualname}' if module != '?' else qualname
+
+	def collapsed(self):
+		"""return the profile in the collapsed stack format read by flamegraph.pl, inferno and speedscope"""
+		lines = []
+		for stack, weight in self.stacks.most_common():
+			if weight:
+				lines.append(';'.join(map(self.frame_name, stack)) + f' {weight}')
+		return '\n'.join(lines) + '\n'
+
+	def speedscope(self, name='cautious memory'):
+		"""return the profile as a dict in speedscope's file format (https://www.speedscope.app)"""
+		frames = []
+		frame_ids = {}
+		samples = []
+		weights = []
+		for stack, weight in self.stacks.items():
+			if not weight:
+				continue
+			sample = []
+			for key in stack:
+				try:
+					sample.append(frame_ids[key])
+				except KeyError:
+					frame_ids[key] = len(frames)
+					sample.append(len(frames))
+					module, qualname, filename, line = key
+					frame = {'name': self.frame_name(key)}
+					if filename:
+						frame.update(file=filename, line=line)
+					frames.append(frame)
+			samples.append(sample)
+			weights.append(weight)
+
+		return {
+			'$schema': 'https://www.speedscope.app/file-format-schema.json',
+			'name': name,
+			'exporter': 'cautious-memory',
+			'activeProfileIndex': 0,
+			'shared': {'frames': frames},
+			'profiles': [{
+				'type': 'sampled',
+				'name': f'{name} ({self.mode} time)',
+				'unit': 'microseconds',
+				'startValue': 0,
+				'endValue': sum(weights),
+				'samples': samples,
+				'weights': weights,
+			}],
+		}
+
+class SamplingProfiler:
+	"""Samples the stack of the thread running loop until stopped.
+
+	In wall mode every sample is weighted by the real time since the previous one, so time spent idle or waiting
+	shows up too. In cpu mode it is weighted by the CPU time the thread used since the previous sample,
+	so a sample taken while the loop is waiting for I/O counts for nothing.
+	The CPU used just before a sample is attributed to that sample's stack, which is only accurate when the
+	interval is short compared to the code being measured.
+	"""
+
+	MODES = ('wall', 'cpu')
+
+	def __init__(self, loop, *, mode='wall', interval=0.001):
+		if mode not in self.MODES:
+			raise ValueError(f'Mode must be one of: {", ".join(self.MODES)}.')
+		if mode == 'cpu' and not hasattr(time, 'pthread_getcpuclockid'):
+			raise ValueError('CPU time profiling is not supported on this platform.')
+		self.loop = loop
+		self.mode = mode
+		self.interval = interval
+		self.profile = Profile(mode, interval)
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def start(self):
+		"""start sampling. This must be called from the thread running the loop."""
+		self.target_id = threading.get_ident()
+		self.cpu_clock = time.pthread_getcpuclockid(self.target_id) if self.mode == 'cpu' else None
+		# the sampling thread needs the GIL to look at the stack. By default the loop thread only has to give it up
+		# every 5ms, so code that runs for less than that between awaits would hardly ever be seen.
+		self.old_switch_interval = sys.getswitchinterval()
+		sys.setswitchinterval(min(self.old_switch_interval, self.interval / 10))
+		self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""stop sampling and return the Profile"""
+		self.stopped.set()
+		self.thread.join()
+		sys.setswitchinterval(self.old_switch_interval)
+		return self.profile
+
+	def _clock(self):
+		if self.cpu_clock is None:
+			return time.perf_counter()
+		return time.clock_gettime(self.cpu_clock)
+
+	def _run(self):
+		start = last = self._clock()
+		wall_start = time.perf_counter()
+		while not self.stopped.wait(self.interval):
+			if time.perf_counter() - wall_start > MAX_DURATION:
+				break
+
+			frame = sys._current_frames().get(self.target_id)
+			now = self._clock()
+			weight = round((now - last) * 1_000_000)
+			last = now
+			if frame is None or not weight:
+				continue
+			self.profile.add(self._stack(frame), weight)
+		self.profile.duration = self._clock() - start
+
+	def _stack(self, frame):
+		stack = []
+		while frame is not None and len(stack) < MAX_DEPTH:
+			stack.append(_frame_key(frame))
+			frame = frame.f_back
+
+		task = asyncio.current_task(self.loop)
+		# frames outside of any task are event loop machinery, selectors and callbacks
+		root = f'task {task.get_name()}' if task is not None else 'event loop'
+		stack.append(('?', root, '', 0))
+		return tuple(reversed(stack))
@@ -0,0 +1,141 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import contextvars
+import functools
+import inspect
+import time
+
+from . import errors
+
+# the ID of the API application making the current request, if any.
+# set by the API server so that database methods can charge the app's buckets too.
+current_app_id = contextvars.ContextVar('current_app_id', default=None)
+
+class TokenBucket:
+	__slots__ = ('capacity', 'refill_rate', 'tokens', 'last_update')
+
+	def __init__(self, capacity, per):
+		self.capacity = capacity
+		self.refill_rate = capacity / per
+		self.tokens = capacity
+		self.last_update = time.monotonic()
+
+	def refill(self, now):
+		self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.refill_rate)
+		self.last_update = now
+
+	def retry_after(self):
+		"""return how many seconds until a token is available, or 0 if one is available now"""
+		return max(0, (1 - self.tokens) / self.refill_rate)
+
+	@property
+	def full(self):
+		return self.tokens >= self.capacity
+
+class RateLimiter:
+	"""Token buckets for each user, guild, and API app, separately for each kind of operation."""
+
+	# (capacity, per seconds) for each kind and scope
+	DEFAULT_LIMITS = {
+		'write': {'user': (5, 10), 'guild': (30, 10), 'app': (10, 10)},
+		'read': {'user': (10, 30), 'guild': (60, 30), 'app': (30, 30)},
+	}
+	# how many checks to make between sweeps of buckets that have refilled completely
+	PRUNE_INTERVAL = 1000
+
+	def __init__(self, config):
+		self.limits = {}
+		for kind, default_limits in self.DEFAULT_LIMITS.items():
+			limits = {**default_limits, **config.get(kind, {})}
+			self.limits[kind] = {scope: limit for scope, limit in limits.items() if limit is not None}
+
+		# maps (kind, scope, ID) to TokenBucket
+		self.buckets = {}
+		# maps (kind, scope) to how many requests were rejected due to that bucket
+		self.rejections = collections.Counter()
+		self.checks = 0
+
+	def check(self, kind, *, user_id=None, guild_id=None, app_id=None):
+		"""take a token from each applicable bucket, or raise RateLimitedError if any of them are empty.
+
+		No tokens are taken if any bucket is empty.
+		"""
+		now = time.monotonic()
+		self.checks += 1
+		if self.checks % self.PRUNE_INTERVAL == 0:
+			self.prune(now)
+
+		buckets = []
+		for scope, id in ('user', user_id), ('guild', guild_id), ('app', app_id):
+			if id is None or scope not in self.limits[kind]:
+				continue
+
+			key = kind, scope, id
+			try:
+				bucket = self.buckets[key]
+			except KeyError:
+				bucket = self.buckets[key] = TokenBucket(*self.limits[kind][scope])
+			else:
+				bucket.refill(now)
+
+			retry_after = bucket.retry_after()
+			if retry_after:
+				self.rejections[kind, scope] += 1
+				raise errors.RateLimitedError(scope, retry_after)
+
+			buckets.append(bucket)
+
+		for bucket in buckets:
+			bucket.tokens -= 1
+
+	def prune(self, now):
+		for key, bucket in list(self.buckets.items()):
+			bucket.refill(now)
+			if bucket.full:
+				# a full bucket behaves the same as a new one
+				del self.buckets[key]
+
+def charge(bot, kind, subject):
+	"""charge the rate limit buckets for the given kind of operation, done by subject, a member or a guild ID"""
+	if isinstance(subject, int):
+		user_id, guild_id = None, subject
+	else:
+		user_id, guild_id = subject.id, subject.guild.id
+	bot.ratelimiter.check(kind, user_id=user_id, guild_id=guild_id, app_id=current_app_id.get())
+
+def ratelimited(kind):
+	"""Decorator for cog methods which charges the rate limit buckets for the given kind of operation.
+
+	The first argument after self must be a member or a guild ID.
+	Like optional_connection, this supports both coroutine functions and async generator functions.
+	"""
+	def decorator(func):
+		if inspect.isasyncgenfunction(func):
+			@functools.wraps(func)
+			async def inner(self, subject, *args, **kwargs):
+				charge(self.bot, kind, subject)
+				async for x in func(self, subject, *args, **kwargs):
+					yield x
+		else:
+			@functools.wraps(func)
+			async def inner(self, subject, *args, **kwargs):
+				charge(self.bot, kind, subject)
+				return await func(self, subject, *args, **kwargs)
+
+		return inner
+
+	return decorator
@@ -0,0 +1,78 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Slotted classes for the rows that the database cogs hand out.
+
+asyncpg Records can't have attributes set on them (the cogs fill in the author of a revision, for instance),
+but copying each row into an object with a __dict__ costs a few hundred bytes a row, which adds up in long listings.
+Instead, a macro declares the columns it selects on a "-- columns:" line, and the attributes that are set
+after the query on an "-- attributes:" line. Each macro gets a class with a slot for each of them,
+made once, and its rows are converted with Query.record and Query.records.
+"""
+
+import keyword
+
+# (query name, columns, attributes): record type
+_types = {}
+
+class Record:
+	"""Base class of the record types. The attributes that aren't columns start out as None."""
+
+	__slots__ = ()
+	query_name = None
+	columns = ()
+	attributes = ()
+	# whether a row has been checked against the declared columns
+	verified = False
+
+	@classmethod
+	def verify(cls, row):
+		"""make sure that the columns of row are the ones declared, in the same order"""
+		columns = tuple(row.keys())
+		if columns != cls.columns:
+			raise RuntimeError(f'{cls.query_name} selects {columns}, but its columns line says {cls.columns}')
+		cls.verified = True
+
+	def __repr__(self):
+		fields = ' '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+		return f'<{type(self).__name__} {fields}>'
+
+def record_type(query_name, columns, attributes=()):
+	"""return the record type of rows of columns, with room for attributes too"""
+	key = query_name, columns, attributes
+	try:
+		return _types[key]
+	except KeyError:
+		pass
+
+	for name in columns + attributes:
+		if not name.isidentifier() or keyword.iskeyword(name):
+			raise ValueError(f'{query_name}: {name!r} can not be an attribute name')
+
+	# like namedtuple, __init__ is generated, so that each row is unpacked in one go
+	lines = ['def __init__(self, row):', f'\t{"".join(f"self.{name}, " for name in columns)}= row']
+	lines.extend(f'\tself.{name} = None' for name in attributes)
+	namespace = {}
+	exec('\n'.join(lines), namespace)
+
+	class_name = ''.join(part.title() for part in query_name.replace('.', '_').split('_')) + 'Record'
+	cls = _types[key] = type(class_name, (Record,), {
+		'__slots__': columns + attributes,
+		'__init__': namespace['__init__'],
+		'query_name': query_name,
+		'columns': columns,
+		'attributes': attributes,
+	})
+	return cls
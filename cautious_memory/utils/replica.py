@@ -0,0 +1,201 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Sends read only queries to a streaming replica, so that showing pages, searching and stats don't load the primary.
+
+A macro is read only if it has a "-- read only" line. Such a query runs on the replica unless
+it's part of a transaction, which needs a consistent view of the primary,
+or the current session (a command invocation or an API request) has written something,
+or the user behind the session wrote something that the replica hasn't replayed yet.
+
+For the last, when a session that wrote ends, the primary's WAL position is kept as that user's token.
+The replica's replay position is polled, and until it has passed the token, the user's reads go to the primary,
+so someone who just edited a page never sees the old version.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+
+import asyncpg
+
+from .metrics import exposition
+
+logger = logging.getLogger(__name__)
+
+# these mean the replica is down or restarting, or it canceled the query to apply changes from the primary.
+# the query is run again on the primary.
+REPLICA_ERRORS = (
+	OSError, asyncio.TimeoutError, asyncpg.InterfaceError, asyncpg.PostgresConnectionError,
+	asyncpg.CannotConnectNowError, asyncpg.SerializationError,
+)
+
+class Session:
+	__slots__ = ('user_id', 'wrote')
+
+	def __init__(self, user_id):
+		# None until the user is known, e.g. before an API request is authorized
+		self.user_id = user_id
+		self.wrote = False
+
+_session = contextvars.ContextVar('replica_session', default=None)
+
+# returned by ReplicaRouter.run when the query should be run on the primary instead
+ON_PRIMARY = object()
+
+class ReplicaRouter:
+	"""Decides which read only queries run on the replica. Until configure() is called, none do."""
+
+	def __init__(self):
+		self.primary = None
+		self.replica = None
+		# the latest WAL position the replica is known to have replayed, or None if it can't be used right now
+		self.replay_lsn = None
+		# user ID: WAL position of their last write
+		self.tokens = {}
+		self.task = None
+		self.replica_reads = 0
+		# reads of read only queries done on the primary, by why
+		self.primary_reads = {'fresh': 0, 'unavailable': 0}
+		self.fallbacks = 0
+
+	def configure(self, primary, replica, *, poll_interval=0.1):
+		self.primary = primary
+		self.replica = replica
+		self.poll_interval = poll_interval
+		self.task = asyncio.create_task(self._poll(), name='replica replay position')
+
+	async def close(self):
+		if self.task is not None:
+			self.task.cancel()
+		if self.replica is not None:
+			await self.replica.close()
+
+	@contextlib.asynccontextmanager
+	async def session(self, user_id=None):
+		"""Group the queries of one command or request, on behalf of user_id, which may be set later.
+		If any of them wrote, the user's later reads go to the primary until the replica has caught up.
+		"""
+		session = Session(user_id)
+		token = _session.set(session)
+		try:
+			yield session
+		finally:
+			_session.reset(token)
+			if session.wrote and session.user_id is not None and self.replica is not None:
+				# the session's transactions have all committed by now, so this is at or past each of them
+				lsn = await self.primary.fetchval('SELECT pg_current_wal_lsn()')
+				self.tokens[session.user_id] = max(lsn, self.tokens.get(session.user_id, 0))
+
+	def wrote(self):
+		session = _session.get()
+		if session is not None:
+			session.wrote = True
+
+	def _use_replica(self):
+		if self.replica is None:
+			return False
+		if self.replay_lsn is None:
+			self.primary_reads['unavailable'] += 1
+			return False
+
+		session = _session.get()
+		if session is not None and (
+			session.wrote or self.tokens.get(session.user_id, 0) > self.replay_lsn
+		):
+			self.primary_reads['fresh'] += 1
+			return False
+
+		return True
+
+	async def run(self, method_name, query, args, kwargs):
+		"""run a read only query on the replica if it may be, otherwise return ON_PRIMARY"""
+		if not self._use_replica():
+			return ON_PRIMARY
+
+		try:
+			result = await getattr(self.replica, method_name)(query, *args, **kwargs)
+		except REPLICA_ERRORS as exc:
+			self._replica_failed(query, exc)
+			return ON_PRIMARY
+
+		self.replica_reads += 1
+		return result
+
+	@contextlib.asynccontextmanager
+	async def cursor_connection(self, query, connection):
+		"""Yield a replica connection to open a cursor over query on, if it may be run on the replica,
+		otherwise connection. Once rows have been yielded the query can't be run again, so unlike run(),
+		this only falls back to the primary if a replica connection can't be acquired.
+		"""
+		replica_connection = None
+		if query.read_only and connection._may_use_replica() and self._use_replica():
+			try:
+				replica_connection = await self.replica.acquire()
+			except REPLICA_ERRORS as exc:
+				self._replica_failed(query, exc)
+
+		if replica_connection is None:
+			yield connection
+			return
+
+		self.replica_reads += 1
+		try:
+			yield replica_connection
+		finally:
+			await self.replica.release(replica_connection)
+
+	def _replica_failed(self, query, exc):
+		logger.warning('%s failed on the replica (%r), running it on the primary', query.name, exc)
+		self.fallbacks += 1
+		if not isinstance(exc, asyncpg.SerializationError):
+			# stop using it until the next successful poll
+			self.replay_lsn = None
+
+	async def _poll(self):
+		while True:
+			try:
+				self.replay_lsn = await self.replica.fetchval('SELECT pg_last_wal_replay_lsn()', timeout=1)
+			except asyncio.CancelledError:
+				raise
+			except Exception as exc:
+				if self.replay_lsn is not None:
+					logger.warning('the replica is unavailable (%r), reading from the primary', exc)
+				self.replay_lsn = None
+			else:
+				if self.replay_lsn is None:
+					logger.error('the replica database is not a replica (it is not in recovery), so it will not be used')
+					return
+				self.tokens = {user_id: lsn for user_id, lsn in self.tokens.items() if lsn > self.replay_lsn}
+			await asyncio.sleep(self.poll_interval)
+
+	def prometheus(self):
+		return ''.join([
+			exposition(
+				'cm_replica_reads_total', 'counter', 'Read only queries run on the replica.',
+				[('cm_replica_reads_total', {}, self.replica_reads)]),
+			exposition(
+				'cm_replica_primary_reads_total', 'counter',
+				'Read only queries run on the primary, because the user had written something the replica had not'
+				' replayed yet (fresh) or the replica was down (unavailable).',
+				[('cm_replica_primary_reads_total', {'reason': reason}, count) for reason, count in self.primary_reads.items()]),
+			exposition(
+				'cm_replica_fallbacks_total', 'counter', 'Queries that failed on the replica and were run again on the primary.',
+				[('cm_replica_fallbacks_total', {}, self.fallbacks)]),
+			exposition(
+				'cm_replica_pending_tokens', 'gauge', 'Users whose reads go to the primary until the replica catches up.',
+				[('cm_replica_pending_tokens', {}, len(self.tokens))]),
+		])
@@ -0,0 +1,120 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import datetime
+import itertools
+import logging
+import random
+
+import asyncpg
+
+from .workload import current_workload
+
+logger = logging.getLogger(__name__)
+
+def redact(value):
+	"""return a representation of a query parameter that keeps IDs and numbers but not page content or titles"""
+	if value is None or isinstance(value, (bool, int, float, datetime.datetime, datetime.date, datetime.timedelta)):
+		return repr(value)
+	if isinstance(value, str):
+		return f'<{len(value)} characters>'
+	if isinstance(value, (list, tuple)):
+		return '[' + ', '.join(map(redact, value)) + ']'
+	return f'<{type(value).__name__}>'
+
+class SlowQuery:
+	__slots__ = ('id', 'name', 'params', 'duration', 'at', 'plan', '_sql', '_args')
+
+	def __init__(self, id, name, sql, args, duration):
+		self.id = id
+		self.name = name
+		self.params = list(map(redact, args))
+		self.duration = duration
+		self.at = datetime.datetime.utcnow()
+		# None if the query was not sampled for EXPLAIN, or the EXPLAIN has not finished yet
+		self.plan = None
+		# only kept until the query has been explained, so that page content isn't kept in memory
+		self._sql = sql
+		self._args = args
+
+class SlowQueryLog:
+	"""Keeps the most recent queries that took longer than threshold seconds.
+
+	A sample of them is run again under EXPLAIN (ANALYZE, BUFFERS), in a transaction that is rolled back,
+	so that their plans can be seen without access to the database.
+	It does nothing until configure is called.
+	"""
+
+	def __init__(self):
+		self.threshold = None
+		self.queries = collections.deque(maxlen=100)
+		self.ids = itertools.count(1)
+		self.pool = None
+		self.explaining = None
+
+	def configure(self, pool, *, threshold=0.5, capacity=100, explain_sample_rate=0.1, explain_timeout=10):
+		self.pool = pool
+		self.threshold = threshold
+		self.queries = collections.deque(self.queries, maxlen=capacity)
+		self.explain_sample_rate = explain_sample_rate
+		self.explain_timeout = explain_timeout
+
+	def record(self, name, sql, args, duration):
+		if self.threshold is None or duration < self.threshold:
+			return
+
+		query = SlowQuery(next(self.ids), name, sql, args, duration)
+		self.queries.append(query)
+		logger.warning('slow query %s took %.1fms (id %s)', name, duration * 1000, query.id)
+
+		# only one EXPLAIN runs at a time, so that a burst of slow queries can't take up the pool
+		if self.explaining is None and random.random() < self.explain_sample_rate:
+			self.explaining = asyncio.get_event_loop().create_task(self.explain(query))
+			self.explaining.add_done_callback(self._explain_done)
+		else:
+			query._sql = query._args = None
+
+	def _explain_done(self, task):
+		self.explaining = None
+
+	async def explain(self, query):
+		# this is a task of its own, so this doesn't change the workload of whoever ran the query
+		current_workload.set('analytics')
+		sql, args = query._sql, query._args
+		query._sql = query._args = None
+		try:
+			async with self.pool.acquire(timeout=self.explain_timeout) as conn:
+				tr = conn.transaction()
+				await tr.start()
+				try:
+					await conn.execute(f'SET LOCAL statement_timeout = {int(self.explain_timeout * 1000)}')
+					rows = await conn.fetch('EXPLAIN (ANALYZE, BUFFERS) ' + sql, *args)
+				finally:
+					# EXPLAIN ANALYZE really runs the query, so undo anything it wrote
+					await tr.rollback()
+		except (asyncpg.PostgresError, asyncpg.InterfaceError, asyncio.TimeoutError) as exc:
+			query.plan = f'EXPLAIN failed: {type(exc).__name__}: {exc}'
+		else:
+			query.plan = '\n'.join(row[0] for row in rows)
+
+	def get(self, id):
+		for query in self.queries:
+			if query.id == id:
+				return query
+
+	def __iter__(self):
+		return iter(self.queries)
@@ -0,0 +1,651 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import itertools
+import logging
+import random
+import re
+import sys
+import time
+import weakref
+
+import asyncpg
+from bot_bin.sql import connection as current_connection
+
+from . import records, tracing
+from .databases import check_writable
+from .metrics import Histogram, exposition
+from .replica import ON_PRIMARY, ReplicaRouter
+from .slow_queries import SlowQueryLog
+
+logger = logging.getLogger(__name__)
+
+READ_ONLY_RE = re.compile(r'^\s*-- read only$', re.MULTILINE)
+WRITES_RE = re.compile(r'^\s*-- writes$', re.MULTILINE)
+COLUMNS_RE = re.compile(r'^\s*-- columns: (.+)$', re.MULTILINE)
+ATTRIBUTES_RE = re.compile(r'^\s*-- attributes: (.+)$', re.MULTILINE)
+COMMENT_RE = re.compile(r'--.*')
+WRITE_RE = re.compile(r'\b(?:INSERT|UPDATE|DELETE)\b')
+
+class Query(str):
+	"""The SQL rendered from one of the macros in the sql/ directory. The name is "file.macro".
+
+	asyncpg only accepts exact strs, so Connection passes it the plain sql attribute.
+	Macros with a "-- read only" line may be run on the replica, and those that insert, update or delete
+	send the rest of the session to the primary (see utils.replica). So do those with a "-- writes" line,
+	for macros that call a function that writes. Macros whose rows are handed out declare their columns
+	for Query.record (see utils.records).
+	"""
+
+	def __new__(cls, sql, name):
+		self = super().__new__(cls, sql)
+		self.sql = sql
+		self.name = name
+		self.read_only = READ_ONLY_RE.search(sql) is not None
+		self.writes = WRITES_RE.search(sql) is not None or WRITE_RE.search(COMMENT_RE.sub('', sql)) is not None
+		columns = COLUMNS_RE.search(sql)
+		attributes = ATTRIBUTES_RE.search(sql)
+		self.record_type = None if columns is None else records.record_type(
+			name, _names(columns[1]), _names(attributes[1]) if attributes else ())
+		return self
+
+	def record(self, row):
+		"""return row as an instance of this query's record type"""
+		return self._record_type(row)(row)
+
+	def records(self, rows):
+		"""return a list of rows as instances of this query's record type"""
+		if not rows:
+			return []
+		record_type = self._record_type(rows[0])
+		return [record_type(row) for row in rows]
+
+	def _record_type(self, row):
+		if self.record_type is None:
+			raise TypeError(f'{self.name} has no columns line')
+		if not self.record_type.verified:
+			self.record_type.verify(row)
+		return self.record_type
+
+def _names(line):
+	return tuple(name.strip() for name in line.split(','))
+
+def _unwrap(query):
+	return query.sql if isinstance(query, Query) else query
+
+class Queries:
+	"""Wraps a jinja2 template module so that each macro returns a Query named after it.
+
+	Rendering a macro with the same arguments always gives the same result, so each is only rendered once.
+	"""
+
+	def __init__(self, template_name, module):
+		self._prefix = template_name.rpartition('.')[0]
+		self._module = module
+
+	def __getattr__(self, macro_name):
+		macro = getattr(self._module, macro_name)
+		name = f'{self._prefix}.{macro_name}'
+		cache = {}
+
+		def render(*args, **kwargs):
+			key = (args, tuple(sorted(kwargs.items())))
+			try:
+				return cache[key]
+			except KeyError:
+				query = cache[key] = Query(macro(*args, **kwargs), name)
+				return query
+
+		render.__name__ = macro_name
+		# cache it so that __getattr__ isn't called again
+		setattr(self, macro_name, render)
+		return render
+
+class QueryStats:
+	__slots__ = ('calls', 'errors', 'conflicts', 'rows', 'latency')
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		# errors that were because of a concurrent transaction (see retry_on_conflict)
+		self.conflicts = 0
+		self.rows = 0
+		self.latency = Histogram()
+
+class QueryStatsRegistry:
+	"""Call counts, errors, rows returned or affected, and latency for each query macro."""
+
+	def __init__(self):
+		self.stats = {}
+
+	def __getitem__(self, name):
+		try:
+			return self.stats[name]
+		except KeyError:
+			stats = self.stats[name] = QueryStats()
+			return stats
+
+	def __iter__(self):
+		return iter(self.stats.items())
+
+	def clear(self):
+		self.stats.clear()
+
+	def prometheus(self):
+		stats = sorted(self.stats.items())
+		return ''.join([
+			exposition(
+				'cm_query_calls_total', 'counter', 'Queries executed, by macro name.',
+				(('cm_query_calls_total', {'query': name}, s.calls) for name, s in stats)),
+			exposition(
+				'cm_query_errors_total', 'counter', 'Queries that raised an exception, by macro name.',
+				(('cm_query_errors_total', {'query': name}, s.errors) for name, s in stats)),
+			exposition(
+				'cm_query_conflicts_total', 'counter',
+				'Queries that failed because of a concurrent transaction (serialization failures and deadlocks), by macro name.',
+				(('cm_query_conflicts_total', {'query': name}, s.conflicts) for name, s in stats)),
+			exposition(
+				'cm_query_rows_total', 'counter', 'Rows returned or affected by queries, by macro name.',
+				(('cm_query_rows_total', {'query': name}, s.rows) for name, s in stats)),
+			exposition(
+				'cm_query_duration_seconds', 'histogram', 'Query latency, by macro name.',
+				(sample for name, s in stats for sample in s.latency.samples('cm_query_duration_seconds', {'query': name}))),
+		])
+
+query_stats = QueryStatsRegistry()
+
+# errors meaning that a transaction conflicted with a concurrent one, and will probably succeed if it's run again
+CONFLICT_ERRORS = (asyncpg.SerializationError, asyncpg.DeadlockDetectedError)
+# how many times a transaction is tried before a conflict is given up on
+CONFLICT_ATTEMPTS = 5
+
+class RetryStats:
+	__slots__ = ('retries', 'exhausted')
+
+	def __init__(self):
+		self.retries = 0
+		# times it conflicted on every attempt, and the error was raised
+		self.exhausted = 0
+
+class RetryStatsRegistry:
+	"""Retries of each function decorated with retry_on_conflict."""
+
+	def __init__(self):
+		self.stats = {}
+
+	def __getitem__(self, name):
+		try:
+			return self.stats[name]
+		except KeyError:
+			stats = self.stats[name] = RetryStats()
+			return stats
+
+	def __iter__(self):
+		return iter(self.stats.items())
+
+	def prometheus(self):
+		stats = sorted(self.stats.items())
+		return ''.join([
+			exposition(
+				'cm_transaction_retries_total', 'counter',
+				'Transactions run again because they conflicted with a concurrent one, by function.',
+				(('cm_transaction_retries_total', {'function': name}, s.retries) for name, s in stats)),
+			exposition(
+				'cm_transaction_retries_exhausted_total', 'counter',
+				'Transactions that conflicted on every attempt, by function.',
+				(('cm_transaction_retries_exhausted_total', {'function': name}, s.exhausted) for name, s in stats)),
+		])
+
+retry_stats = RetryStatsRegistry()
+
+def _in_transaction():
+	try:
+		return current_connection().is_in_transaction()
+	except (LookupError, asyncpg.InterfaceError):
+		# no connection has been acquired in this context, or it has been released already
+		return False
+
+def retry_on_conflict(*, attempts=CONFLICT_ATTEMPTS, base_delay=0.05, max_delay=2):
+	"""Decorator for coroutine functions that run a transaction, usually optional_connection methods (place it above
+	optional_connection), which runs them again when the transaction conflicts with a concurrent one.
+	That is for repeatable read or serializable transactions, and for ones of several statements that lock rows
+	in an order another transaction might not. A single read committed statement that locks what it needs
+	in the same order as everything else, like the wiki's page functions, doesn't need it.
+
+	Before retry n, it waits a random time of up to base_delay * 2**n seconds, or max_delay,
+	so that the transactions that conflicted are unlikely to do so again. After attempts tries, the error is raised.
+	When called inside a transaction that's already open, the function is not retried, since that transaction
+	can't go on after the error. Whoever opened it should be decorated instead.
+	"""
+	def decorator(func):
+		assert inspect.iscoroutinefunction(func)
+		name = func.__qualname__
+
+		@functools.wraps(func)
+		async def inner(*args, **kwargs):
+			if _in_transaction():
+				return await func(*args, **kwargs)
+
+			for attempt in itertools.count(1):
+				try:
+					return await func(*args, **kwargs)
+				except CONFLICT_ERRORS as exc:
+					stats = retry_stats[name]
+					if attempt == attempts:
+						stats.exhausted += 1
+						raise
+					stats.retries += 1
+					delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+					logger.debug('%s conflicted (%r), retrying in %.0fms', name, exc, delay * 1000)
+					await asyncio.sleep(delay)
+
+		return inner
+
+	return decorator
+
+slow_query_log = SlowQueryLog()
+
+replica_router = ReplicaRouter()
+
+def _routed(method_name):
+	"""Decorator for the query methods of Pool and Connection that runs read only queries on the replica
+	when the replica router allows it, and tells it about writes, which aren't allowed while the guild is being moved.
+	"""
+	def decorator(method):
+		@functools.wraps(method)
+		async def routed(self, query, *args, **kwargs):
+			if isinstance(query, Query):
+				if query.read_only and self._may_use_replica():
+					result = await replica_router.run(method_name, query, args, kwargs)
+					if result is not ON_PRIMARY:
+						return result
+				elif query.writes:
+					check_writable()
+					replica_router.wrote()
+			return await method(self, query, *args, **kwargs)
+
+		return routed
+	return decorator
+
+class _Measurement:
+	"""Context manager that records one execution of a query, and a span for it if a trace is being recorded.
+	Slow queries are also added to the slow query log.
+	"""
+	__slots__ = ('query', 'args', 'name', 'stats', 'rows', 'start', 'span')
+
+	def __init__(self, query, args):
+		self.query = query
+		self.args = args
+		# ad hoc queries, transaction control, etc. aren't recorded
+		self.name = query.name if isinstance(query, Query) else None
+		self.stats = query_stats[self.name] if self.name is not None else None
+		self.rows = 0
+
+	def __enter__(self):
+		# a leaf span, because a cursor may be finalized in a different context than it was opened in
+		self.span = tracing.leaf(f'sql {self.name}') if self.name is not None else None
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if self.stats is None:
+			return
+		if self.span is not None:
+			self.span.finish(exc_type)
+		duration = time.perf_counter() - self.start
+		self.stats.latency.observe(duration)
+		self.stats.calls += 1
+		self.stats.rows += self.rows
+		# cancellation and closing a cursor early don't count as errors
+		if exc_type is not None and issubclass(exc_type, Exception):
+			self.stats.errors += 1
+			if issubclass(exc_type, CONFLICT_ERRORS):
+				self.stats.conflicts += 1
+		if exc_type is None or issubclass(exc_type, Exception):
+			slow_query_log.record(self.name, self.query.sql, self.args, duration)
+
+def _status_rows(status):
+	"""return the row count of a command status such as "INSERT 0 1", or 0 if there isn't one"""
+	last = status.rpartition(' ')[2]
+	return int(last) if last.isdigit() else 0
+
+class PoolStats:
+	__slots__ = ('acquires', 'acquire_wait', 'hold', 'max_hold', 'http_requests')
+
+	def __init__(self):
+		self.acquires = 0
+		self.acquire_wait = Histogram()
+		self.hold = Histogram()
+		self.max_hold = 0
+		# Discord API requests made while a connection acquired here was held
+		self.http_requests = 0
+
+class PoolStatsRegistry:
+	"""Acquire wait and hold time for each call site that acquires a connection from the pool."""
+
+	def __init__(self):
+		self.stats = {}
+		# (call site, request) pairs that have already been logged
+		self.warned = set()
+
+	def __getitem__(self, call_site):
+		try:
+			return self.stats[call_site]
+		except KeyError:
+			stats = self.stats[call_site] = PoolStats()
+			return stats
+
+	def __iter__(self):
+		return iter(self.stats.items())
+
+	def clear(self):
+		self.stats.clear()
+		self.warned.clear()
+
+	def prometheus(self):
+		stats = sorted(self.stats.items())
+		return ''.join([
+			exposition(
+				'cm_pool_acquire_wait_seconds', 'histogram', 'Time spent waiting for a pooled connection, by call site.',
+				(
+					sample
+					for call_site, s in stats
+					for sample in s.acquire_wait.samples('cm_pool_acquire_wait_seconds', {'call_site': call_site}))),
+			exposition(
+				'cm_pool_hold_seconds', 'histogram', 'Time a pooled connection was held for, by call site.',
+				(
+					sample
+					for call_site, s in stats
+					for sample in s.hold.samples('cm_pool_hold_seconds', {'call_site': call_site}))),
+			exposition(
+				'cm_pool_http_while_held_total', 'counter',
+				'Discord API requests made while holding a pooled connection, by the call site that acquired it.',
+				(('cm_pool_http_while_held_total', {'call_site': call_site}, s.http_requests) for call_site, s in stats)),
+		])
+
+pool_stats = PoolStatsRegistry()
+
+class PoolSaturationRegistry:
+	"""How full each open pool is, labeled by the database and the workload it is for."""
+
+	def __init__(self):
+		self.pools = weakref.WeakSet()
+
+	def add(self, pool):
+		self.pools.add(pool)
+
+	def __iter__(self):
+		return iter(sorted(self.pools, key=lambda pool: (pool.name, pool.workload)))
+
+	def prometheus(self):
+		pools = [(pool, {'database': pool.name, 'workload': pool.workload}) for pool in self]
+		return ''.join([
+			exposition(
+				'cm_pool_connections', 'gauge', 'Open connections in each pool, by whether they are in use.',
+				(
+					sample
+					for pool, labels in pools
+					for sample in [
+						('cm_pool_connections', {**labels, 'state': 'in_use'}, pool.in_use()),
+						('cm_pool_connections', {**labels, 'state': 'idle'}, pool.get_idle_size())])),
+			exposition(
+				'cm_pool_max_connections', 'gauge', 'The most connections each pool may open.',
+				(('cm_pool_max_connections', labels, pool.get_max_size()) for pool, labels in pools)),
+			exposition(
+				'cm_pool_waiting', 'gauge', 'Tasks waiting for a connection from each pool.',
+				(('cm_pool_waiting', labels, pool.waiting) for pool, labels in pools)),
+			exposition(
+				'cm_pool_acquire_timeouts_total', 'counter', 'Times no connection became free within the acquire timeout.',
+				(('cm_pool_acquire_timeouts_total', labels, pool.acquire_timeouts) for pool, labels in pools)),
+		])
+
+pool_saturation = PoolSaturationRegistry()
+
+class _Hold:
+	__slots__ = ('call_site', 'stats', 'acquired_at', 'released')
+
+	def __init__(self, call_site, stats, acquired_at):
+		self.call_site = call_site
+		self.stats = stats
+		self.acquired_at = acquired_at
+		self.released = False
+
+# the connections acquired in the current context. Tasks inherit this, so the notifications that a listener gathers
+# still count as holding the listener's connection.
+_holds = contextvars.ContextVar('holds', default=())
+
+def held_connections():
+	"""return the connections acquired in the current context that have not been released yet"""
+	return [hold for hold in _holds.get() if not hold.released]
+
+def check_held_connections(request):
+	"""Count, and log once per call site, a network request made while connections are held in the current context."""
+	for hold in held_connections():
+		hold.stats.http_requests += 1
+		if (hold.call_site, request) in pool_stats.warned:
+			continue
+		pool_stats.warned.add((hold.call_site, request))
+		logger.warning(
+			'%s has held a connection for %.1fms and is now waiting on %s. '
+			'Release it before making network requests so that other commands can use it.',
+			hold.call_site, (time.perf_counter() - hold.acquired_at) * 1000, request)
+
+# frames from these modules are skipped when finding out who acquired a connection
+_WRAPPER_MODULES = {
+	__name__, 'cautious_memory.utils.ratelimit', 'cautious_memory.utils.tracing', 'cautious_memory.utils.databases',
+	'cautious_memory.utils.workload', 'bot_bin.sql', 'contextlib'}
+
+def _call_site():
+	"""return a name for the code that is acquiring a connection, such as "cogs.wiki.commands:67 page" """
+	frame = sys._getframe(1)
+	while frame.f_back is not None and frame.f_globals.get('__name__') in _WRAPPER_MODULES:
+		frame = frame.f_back
+	module = frame.f_globals.get('__name__', '?')
+	if module.startswith('cautious_memory.'):
+		module = module[len('cautious_memory.'):]
+	return f'{module}:{frame.f_lineno} {frame.f_code.co_name}'
+
+class Pool:
+	"""Wraps an asyncpg Pool so that waiting to acquire a connection shows up in traces,
+	and acquire wait and hold time are recorded for each call site.
+
+	Anything not overridden here is passed through to the wrapped pool.
+	name and workload label its saturation metrics. acquire_timeout is used when acquire() isn't given one.
+	"""
+
+	def __init__(self, pool, *, name='home', workload='interactive', acquire_timeout=None, routes_reads=True):
+		self._pool = pool
+		self._holds = {}
+		self.name = name
+		self.workload = workload
+		self.acquire_timeout = acquire_timeout
+		self.routes_reads = routes_reads
+		# tasks waiting in acquire() right now
+		self.waiting = 0
+		self.acquire_timeouts = 0
+		pool_saturation.add(self)
+
+	def __getattr__(self, name):
+		return getattr(self._pool, name)
+
+	def acquire(self, *, timeout=None):
+		return _PoolAcquireContext(self, timeout, _call_site())
+
+	def holds(self, connection):
+		return connection in self._holds
+
+	def in_use(self):
+		return len(self._holds)
+
+	async def _acquire(self, timeout, call_site):
+		stats = pool_stats[call_site]
+		start = time.perf_counter()
+		self.waiting += 1
+		try:
+			with tracing.span('pool acquire'):
+				connection = await self._pool.acquire(timeout=self.acquire_timeout if timeout is None else timeout)
+		except asyncio.TimeoutError:
+			self.acquire_timeouts += 1
+			raise
+		finally:
+			self.waiting -= 1
+		now = time.perf_counter()
+		stats.acquires += 1
+		stats.acquire_wait.observe(now - start)
+
+		hold = self._holds[connection] = _Hold(call_site, stats, now)
+		_holds.set((*held_connections(), hold))
+		return connection
+
+	async def release(self, connection, *, timeout=None):
+		hold = self._holds.pop(connection, None)
+		if hold is not None:
+			hold.released = True
+			held_for = time.perf_counter() - hold.acquired_at
+			hold.stats.hold.observe(held_for)
+			hold.stats.max_hold = max(hold.stats.max_hold, held_for)
+		await self._pool.release(connection, timeout=timeout)
+
+	# these are reimplemented so that they go through our acquire().
+	# they're routed before a connection is acquired, so they skip the connection's own routing.
+
+	def _may_use_replica(self):
+		return self.routes_reads
+
+	@_routed('execute')
+	async def execute(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn._measured_execute(query, *args, timeout=timeout)
+
+	async def executemany(self, command, args, *, timeout=None):
+		async with self.acquire() as conn:
+			return await conn.executemany(command, args, timeout=timeout)
+
+	@_routed('fetch')
+	async def fetch(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn._measured_fetch(query, *args, timeout=timeout)
+
+	@_routed('fetchrow')
+	async def fetchrow(self, query, *args, timeout=None):
+		async with self.acquire() as conn:
+			return await conn._measured_fetchrow(query, *args, timeout=timeout)
+
+	@_routed('fetchval')
+	async def fetchval(self, query, *args, column=0, timeout=None):
+		async with self.acquire() as conn:
+			return await conn._measured_fetchval(query, *args, column=column, timeout=timeout)
+
+class _PoolAcquireContext:
+	"""Like asyncpg's PoolAcquireContext, this may be awaited or used as an async context manager."""
+	__slots__ = ('pool', 'timeout', 'call_site', 'connection')
+
+	def __init__(self, pool, timeout, call_site):
+		self.pool = pool
+		self.timeout = timeout
+		self.call_site = call_site
+		self.connection = None
+
+	def __await__(self):
+		return self.pool._acquire(self.timeout, self.call_site).__await__()
+
+	async def __aenter__(self):
+		self.connection = await self.pool._acquire(self.timeout, self.call_site)
+		return self.connection
+
+	async def __aexit__(self, *excinfo):
+		connection, self.connection = self.connection, None
+		await self.pool.release(connection)
+
+async def create_pool(*, name='home', workload='interactive', acquire_timeout=None, routes_reads=True, **kwargs):
+	"""routes_reads is whether read only queries may be run on the replica instead, which is false for the replica
+	itself and for databases other than the home database, which it isn't a replica of
+	"""
+	connection_class = Connection if routes_reads else UnroutedConnection
+	return Pool(
+		await asyncpg.create_pool(**kwargs, connection_class=connection_class),
+		name=name, workload=workload, acquire_timeout=acquire_timeout, routes_reads=routes_reads)
+
+class Connection(asyncpg.Connection):
+	"""A Connection that records statistics for each Query it runs, and runs read only ones on the replica
+	outside of transactions.
+	"""
+
+	routes_reads = True
+
+	def _may_use_replica(self):
+		# a transaction may have written something already, or need a consistent view of the primary
+		return self.routes_reads and not self.is_in_transaction()
+
+	async def _measured_execute(self, query, *args, **kwargs):
+		with _Measurement(query, args) as measurement:
+			status = await super().execute(_unwrap(query), *args, **kwargs)
+			measurement.rows = _status_rows(status)
+		return status
+
+	async def _measured_fetch(self, query, *args, **kwargs):
+		with _Measurement(query, args) as measurement:
+			rows = await super().fetch(_unwrap(query), *args, **kwargs)
+			measurement.rows = len(rows)
+		return rows
+
+	async def _measured_fetchrow(self, query, *args, **kwargs):
+		with _Measurement(query, args) as measurement:
+			row = await super().fetchrow(_unwrap(query), *args, **kwargs)
+			measurement.rows = row is not None
+		return row
+
+	async def _measured_fetchval(self, query, *args, **kwargs):
+		with _Measurement(query, args) as measurement:
+			value = await super().fetchval(_unwrap(query), *args, **kwargs)
+			measurement.rows = value is not None
+		return value
+
+	execute = _routed('execute')(_measured_execute)
+	fetch = _routed('fetch')(_measured_fetch)
+	fetchrow = _routed('fetchrow')(_measured_fetchrow)
+	fetchval = _routed('fetchval')(_measured_fetchval)
+
+	def cursor(self, query, *args, **kwargs):
+		factory = super().cursor(_unwrap(query), *args, **kwargs)
+		if not isinstance(query, Query):
+			return factory
+		return _MeasuredCursorFactory(factory, query, args)
+
+class UnroutedConnection(Connection):
+	routes_reads = False
+
+class _MeasuredCursorFactory:
+	"""Wraps a CursorFactory. When iterated, the latency recorded is the time taken to exhaust the cursor,
+	which includes the time the caller spent handling each row.
+	"""
+
+	def __init__(self, factory, query, args):
+		self.factory = factory
+		self.query = query
+		self.args = args
+
+	def __await__(self):
+		return self.factory.__await__()
+
+	async def __aiter__(self):
+		with _Measurement(self.query, self.args) as measurement:
+			async for row in self.factory:
+				measurement.rows += 1
+				yield row
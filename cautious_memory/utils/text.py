@@ -0,0 +1,50 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""CPU heavy text processing. These are run by utils.workers.WorkerPool, possibly in another process,
+so they only take and return plain strings.
+"""
+
+import re
+
+import discord
+
+from . import code_block, escape_code_blocks
+
+EMOJI_ESCAPE_RE = re.compile(r'<a?(:\w+:)\d+>', re.ASCII)
+EMOJI_REMOVE_ESCAPED_UNDERSCORES_RE = re.compile(r':(?:\w|\\_)+:', re.ASCII)
+
+def escape_emojis(content):
+	# replace emojis with their names for mobile users, since on android at least, copying a message
+	# with emojis in it copies just the name, not the name and colons
+	# we also don't want the user to see the raw <:name:1234> form because they can't send that directly
+	return EMOJI_ESCAPE_RE.sub(r'\1', content)
+
+def escape_raw(content):
+	"""return (content with emojis escaped, that with markdown escaped as well).
+	The second is None if the first is already too long for a message.
+	"""
+	escaped = escape_emojis(content)
+	if len(escaped) > 2000:
+		return escaped, None
+	# escape_markdown messes up emojis for mobile users
+	escaped2 = EMOJI_REMOVE_ESCAPED_UNDERSCORES_RE.sub(
+		lambda m: m[0].replace(r'\_', '_'), discord.utils.escape_markdown(escaped))
+	return escaped, escaped2
+
+def code_block_raw(content):
+	"""return (content with emojis escaped, that in a code block)"""
+	escaped = escape_emojis(content)
+	return escaped, code_block(escape_code_blocks(escaped))
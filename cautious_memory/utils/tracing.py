@@ -0,0 +1,183 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import contextvars
+import datetime
+import functools
+import inspect
+import itertools
+import time
+
+# the innermost span of the trace being recorded for the current task, if any.
+# tasks created while a span is current inherit it, so concurrent work shows up as sibling spans.
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+	__slots__ = ('name', 'start', 'end', 'children', 'error')
+
+	def __init__(self, name):
+		self.name = name
+		self.start = time.perf_counter()
+		self.end = None
+		self.children = []
+		self.error = None
+
+	def finish(self, exc_type=None):
+		self.end = time.perf_counter()
+		if exc_type is not None:
+			self.error = f'raised {exc_type.__name__}'
+
+	@property
+	def duration(self):
+		return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+	def to_dict(self, origin):
+		"""return a JSON-serializable dict. Times are in milliseconds relative to origin."""
+		return {
+			'name': self.name,
+			'start_ms': round((self.start - origin) * 1000, 3),
+			'duration_ms': round(self.duration * 1000, 3),
+			'finished': self.end is not None,
+			'error': self.error,
+			'children': [child.to_dict(origin) for child in self.children],
+		}
+
+	def format_tree(self, origin, prefix='', child_prefix=''):
+		unfinished = '' if self.end is not None else ' (unfinished)'
+		error = f' ({self.error})' if self.error else ''
+		lines = [
+			f'{prefix}{self.name} {self.duration * 1000:.1f}ms'
+			f' @ +{(self.start - origin) * 1000:.1f}ms{unfinished}{error}']
+		for i, child in enumerate(self.children):
+			last = i == len(self.children) - 1
+			lines.extend(child.format_tree(
+				origin,
+				child_prefix + ('└─ ' if last else '├─ '),
+				child_prefix + ('   ' if last else '│  ')))
+		return lines
+
+class Trace:
+	_ids = itertools.count(1)
+
+	def __init__(self, name):
+		self.id = next(self._ids)
+		self.started_at = datetime.datetime.utcnow()
+		self.root = Span(name)
+
+	@property
+	def name(self):
+		return self.root.name
+
+	@property
+	def duration(self):
+		return self.root.duration
+
+	@property
+	def finished(self):
+		return self.root.end is not None
+
+	def format_tree(self):
+		return '\n'.join(self.root.format_tree(self.root.start))
+
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'started_at': self.started_at.isoformat(),
+			'root': self.root.to_dict(self.root.start),
+		}
+
+class _SpanContext:
+	__slots__ = ('name', 'span', 'token')
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		parent = current_span.get()
+		if parent is None:
+			self.span = None
+			return None
+
+		self.span = Span(self.name)
+		parent.children.append(self.span)
+		self.token = current_span.set(self.span)
+		return self.span
+
+	def __exit__(self, exc_type, exc, tb):
+		if self.span is not None:
+			self.span.finish(exc_type)
+			current_span.reset(self.token)
+
+def span(name):
+	"""context manager that records a span under the current span. Does nothing if no trace is being recorded."""
+	return _SpanContext(name)
+
+def leaf(name):
+	"""start a span that will have no children, and return it, or None if no trace is being recorded.
+
+	Unlike span(), this does not touch the current span, so it's safe to finish in a different context.
+	The caller must call finish() on it.
+	"""
+	parent = current_span.get()
+	if parent is None:
+		return None
+	span = Span(name)
+	parent.children.append(span)
+	return span
+
+def traced(name=None):
+	"""decorate a coroutine function so that each call is recorded as a span"""
+	def decorator(func):
+		span_name = name or func.__qualname__
+		assert inspect.iscoroutinefunction(func)
+
+		@functools.wraps(func)
+		async def inner(*args, **kwargs):
+			with span(span_name):
+				return await func(*args, **kwargs)
+
+		return inner
+
+	return decorator
+
+class TraceRecorder:
+	"""Records a trace for each command invocation, keeping the slow ones in a ring buffer."""
+
+	def __init__(self, *, slow_threshold=0.25, capacity=50):
+		self.slow_threshold = slow_threshold
+		self.traces = collections.deque(maxlen=capacity)
+
+	def start(self, name):
+		"""start a trace and make it current. return (trace, token) for finish()."""
+		trace = Trace(name)
+		return trace, current_span.set(trace.root)
+
+	def finish(self, trace, token, *, failed=False):
+		trace.root.finish()
+		if failed:
+			trace.root.error = 'command failed'
+		current_span.reset(token)
+		if trace.duration >= self.slow_threshold:
+			self.traces.append(trace)
+
+	def slowest(self):
+		return sorted(self.traces, key=lambda trace: trace.duration, reverse=True)
+
+	def get(self, trace_id):
+		for trace in self.traces:
+			if trace.id == trace_id:
+				return trace
+		return None
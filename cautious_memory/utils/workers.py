@@ -0,0 +1,58 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+
+from . import tracing
+
+# Sending a page to a worker and back takes about half a millisecond. Diffs and merges take about that long
+# on a few hundred characters of typical edits, but they are quadratic when the texts have little in common:
+# tens of milliseconds for two 1000 character pages, and over 100 for a merge of pages at the length limit.
+INLINE_THRESHOLD = 600
+# Escaping is linear, and takes less than the round trip even for the longest pages.
+INLINE_THRESHOLDS = {'escape_emojis': 10_000, 'escape_raw': 10_000, 'code_block_raw': 10_000}
+
+class WorkerPool:
+	"""Runs CPU heavy functions in worker processes so that they don't block the event loop.
+
+	Sending the arguments to another process costs more than small inputs take to process,
+	so work smaller than the function's inline threshold (measured by the caller in characters) is done inline.
+	inline_thresholds maps function names to their thresholds, and inline_threshold is for the other functions.
+	With processes set to 0, everything is done inline.
+	"""
+
+	def __init__(self, *, processes=2, inline_threshold=INLINE_THRESHOLD, inline_thresholds=None):
+		self.inline_threshold = inline_threshold
+		self.inline_thresholds = {**INLINE_THRESHOLDS, **(inline_thresholds or {})}
+		self.executor = None
+		if processes:
+			# the bot has threads of its own and an event loop, which forking would copy into the workers
+			self.executor = concurrent.futures.ProcessPoolExecutor(
+				max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+	async def run(self, func, *args, size):
+		"""return func(*args), which must be picklable, computed in a worker process if size is large enough"""
+		if self.executor is None or size < self.inline_thresholds.get(func.__name__, self.inline_threshold):
+			return func(*args)
+
+		with tracing.span(f'worker {func.__name__}'):
+			return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=False)
@@ -0,0 +1,131 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Separate connection pools for separate classes of work, so that a burst of one can't starve the others.
+
+Queries are interactive (commands and API requests waiting on them) unless the method making them is declared
+to be part of another workload with the workload decorator: background (work triggered by page notifications,
+such as watch list messages and binding sync, and moving guilds), analytics (stats and other aggregates),
+or bulk (reads of every page or recent change in a guild, such as the listings of the pages command and the API).
+Commands and API requests declare themselves interactive where they're handled, so that they don't inherit
+the workload of whatever context they were started from.
+When the pools section of the config is set, each workload gets a pool of its own, with its own size
+and acquire timeout, and the pool in use is chosen by the workload of the current context.
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+
+WORKLOADS = ('interactive', 'background', 'analytics', 'bulk')
+
+current_workload = contextvars.ContextVar('current_workload', default='interactive')
+
+@contextlib.contextmanager
+def workload_scope(name):
+	"""acquire the connections needed in this block from the given workload's pool"""
+	if name not in WORKLOADS:
+		raise ValueError(f'unknown workload {name!r}')
+	token = current_workload.set(name)
+	try:
+		yield
+	finally:
+		current_workload.reset(token)
+
+def workload(name):
+	"""Decorator for coroutine functions and async generator functions, usually database cog methods,
+	that declares which workload their queries belong to. Place it above optional_connection,
+	so that the connection comes from that pool.
+	"""
+	if name not in WORKLOADS:
+		raise ValueError(f'unknown workload {name!r}')
+
+	def decorator(func):
+		if inspect.isasyncgenfunction(func):
+			@functools.wraps(func)
+			async def inner(*args, **kwargs):
+				gen = func(*args, **kwargs)
+				try:
+					while True:
+						# only while the generator runs, so that the caller's queries between rows keep their workload
+						with workload_scope(name):
+							try:
+								row = await gen.__anext__()
+							except StopAsyncIteration:
+								return
+						yield row
+				finally:
+					with workload_scope(name):
+						await gen.aclose()
+
+			return inner
+
+		assert inspect.iscoroutinefunction(func)
+
+		@functools.wraps(func)
+		async def inner(*args, **kwargs):
+			with workload_scope(name):
+				return await func(*args, **kwargs)
+
+		return inner
+
+	return decorator
+
+class WorkloadPool:
+	"""Looks like a Pool, but acquires connections from the pool of the current workload.
+
+	pools is {workload: Pool}. Workloads without a pool of their own share the interactive one.
+	"""
+
+	def __init__(self, pools):
+		self.pools = pools
+		self.interactive = pools['interactive']
+
+	def __getattr__(self, name):
+		return getattr(self.interactive, name)
+
+	def pool(self):
+		return self.pools.get(current_workload.get(), self.interactive)
+
+	def acquire(self, *, timeout=None):
+		return self.pool().acquire(timeout=timeout)
+
+	async def release(self, connection, *, timeout=None):
+		# it may be released in another workload than it was acquired in
+		for pool in self.pools.values():
+			if pool.holds(connection):
+				await pool.release(connection, timeout=timeout)
+				return
+		await self.pool().release(connection, timeout=timeout)
+
+	async def close(self):
+		for pool in self.pools.values():
+			await pool.close()
+
+	async def execute(self, query, *args, timeout=None):
+		return await self.pool().execute(query, *args, timeout=timeout)
+
+	async def executemany(self, command, args, *, timeout=None):
+		return await self.pool().executemany(command, args, timeout=timeout)
+
+	async def fetch(self, query, *args, timeout=None):
+		return await self.pool().fetch(query, *args, timeout=timeout)
+
+	async def fetchrow(self, query, *args, timeout=None):
+		return await self.pool().fetchrow(query, *args, timeout=timeout)
+
+	async def fetchval(self, query, *args, column=0, timeout=None):
+		return await self.pool().fetchval(query, *args, column=column, timeout=timeout)
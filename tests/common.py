@@ -0,0 +1,69 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Helpers for tests that need a database.
+
+They are skipped unless the URL of a throwaway database, with schema.sql and functions.sql applied,
+is set in the CM_TEST_DSN environment variable. Every row in it is deleted before each test.
+The tests of spreading guilds across databases also need a second one like it, in CM_TEST_SECOND_DSN,
+and the transaction pooler tests need the first one through PgBouncer, in CM_TEST_PGBOUNCER_DSN.
+"""
+
+import contextlib
+import os
+
+import asyncpg
+import pytest
+
+from benchmarks.common import bot_config
+from cautious_memory import CautiousMemory
+from cautious_memory.utils.databases import IDENTITY_COLUMNS
+
+def database_url(variable):
+	"""return the database URL in an environment variable, or skip the test if it isn't set"""
+	url = os.environ.get(variable)
+	if not url:
+		pytest.skip(f'{variable} is not set')
+	return url
+
+async def reset_database(dsn):
+	"""delete every row, and undo what spreading guilds across databases does to the identity columns"""
+	conn = await asyncpg.connect(dsn)
+	try:
+		for table, column in IDENTITY_COLUMNS:
+			await conn.execute(f'ALTER TABLE {table} ALTER COLUMN {column} SET INCREMENT BY 1')
+		tables = await conn.fetch('SELECT tablename FROM pg_tables WHERE schemaname = current_schema()')
+		await conn.execute(f'TRUNCATE {", ".join(row["tablename"] for row in tables)} RESTART IDENTITY')
+	finally:
+		await conn.close()
+
+@contextlib.asynccontextmanager
+async def make_bot(database, *, extensions=(), **config):
+	"""Yield a bot that is connected to the database but not to Discord, with the wiki cogs
+	and any other extensions loaded. database is the database section of the config, and config the rest of it.
+	"""
+	bot = CautiousMemory(config={**bot_config(None), 'database': database, **config})
+	# otherwise is_owner would make an HTTP request for the application info
+	bot.owner_ids = {0}
+	await bot.init_db()
+	try:
+		for extension in 'permissions', 'wiki', 'watch_lists', 'binding':
+			for kind in 'db', 'commands':
+				bot.load_extension(f'cautious_memory.cogs.{extension}.{kind}')
+		for extension in extensions:
+			bot.load_extension(extension)
+		yield bot
+	finally:
+		await bot.close()
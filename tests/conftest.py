@@ -0,0 +1,49 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import inspect
+
+import pytest
+
+from .common import database_url, reset_database
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+	"""run coroutine test functions, each in an event loop of its own"""
+	if not inspect.iscoroutinefunction(pyfuncitem.obj):
+		return None
+	args = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+	asyncio.run(pyfuncitem.obj(**args))
+	return True
+
+@pytest.fixture
+def dsn():
+	"""the URL of the test database, emptied"""
+	dsn = database_url('CM_TEST_DSN')
+	asyncio.run(reset_database(dsn))
+	return dsn
+
+@pytest.fixture
+def second_dsn():
+	"""the URL of the second test database, emptied"""
+	dsn = database_url('CM_TEST_SECOND_DSN')
+	asyncio.run(reset_database(dsn))
+	return dsn
+
+@pytest.fixture
+def pgbouncer_dsn():
+	"""the URL of the test database through PgBouncer in transaction mode"""
+	return database_url('CM_TEST_PGBOUNCER_DSN')
@@ -0,0 +1,198 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The HTTP API, served against the test database without any connection to Discord."""
+
+import contextlib
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from cautious_memory.cogs.api_server import StubMemberResolver
+from cautious_memory.cogs.permissions.db import Permissions
+
+from .common import make_bot
+
+GUILD_ID = 1
+ADMIN_ID = 10
+MEMBER_ID = 11
+# this member has a role that may not view the page
+DENIED_MEMBER_ID = 12
+DENIED_ROLE_ID = 20
+
+API_CONFIG = {'docs_url': '', 'token_hash_key': 'test key', 'server': {'host': '127.0.0.1', 'port': 0}}
+
+class API:
+	def __init__(self, bot, client, resolve_member):
+		self.bot = bot
+		self.client = client
+		self.resolve_member = resolve_member
+
+	async def token(self, user_id):
+		return {'Authorization': (await self.bot.cogs['API'].new_token(user_id, 'tests')).decode()}
+
+	async def create_page(self, title, content):
+		"""create a page that DENIED_ROLE_ID may not view, and return its page ID"""
+		admin = await self.resolve_member(GUILD_ID, ADMIN_ID)
+		await self.bot.cogs['WikiDatabase'].create_page(admin, title, content)
+		page_id = await self.bot.pool.fetchval('SELECT page_id FROM pages WHERE title = $1', title)
+		await self.bot.pool.execute(
+			'INSERT INTO page_permissions (page_id, entity, deny) VALUES ($1, $2, $3)',
+			page_id, DENIED_ROLE_ID, Permissions.view.value)
+		return page_id
+
+@contextlib.asynccontextmanager
+async def serve_api(dsn, **config):
+	async with make_bot(
+		{'dsn': dsn},
+		api=API_CONFIG,
+		extensions=['cautious_memory.cogs.api', 'cautious_memory.cogs.api_server'],
+		**config,
+	) as bot:
+		server = bot.cogs['APIServer']
+		resolve_member = StubMemberResolver({DENIED_MEMBER_ID: [DENIED_ROLE_ID]}, administrators=[ADMIN_ID])
+		client = TestClient(TestServer(server.make_app(resolve_member=resolve_member)))
+		await client.start_server()
+		try:
+			yield API(bot, client, resolve_member)
+		finally:
+			await client.close()
+			if server.runner is not None:
+				await server.runner.cleanup()
+
+async def test_read_and_edit_a_page(dsn):
+	async with serve_api(dsn) as api:
+		await api.create_page('Foo', 'first')
+		headers = await api.token(MEMBER_ID)
+
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers=headers)
+		assert response.status == 200
+		assert (await response.json())['content'] == 'first'
+		tag = response.headers['ETag']
+
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers={**headers, 'If-None-Match': tag})
+		assert response.status == 304
+
+		response = await api.client.put(
+			f'/guilds/{GUILD_ID}/pages/foo', json={'content': 'second'}, headers={**headers, 'If-Match': tag})
+		assert response.status == 200
+		assert response.headers['ETag'] != tag
+
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers=headers)
+		assert (await response.json())['content'] == 'second'
+
+async def test_list_pages_in_batches(dsn, monkeypatch):
+	async with serve_api(dsn) as api:
+		titles = ['A', 'b', 'C', 'd', 'E']
+		for title in titles:
+			await api.create_page(title, 'content')
+		api.bot.cogs['WikiDatabase'].KEYSET_BATCH_SIZE = 2
+
+		in_use = []
+		write = web.StreamResponse.write
+
+		async def write_and_count(self, data):
+			in_use.append(api.bot.pool.in_use())
+			return await write(self, data)
+
+		monkeypatch.setattr(web.StreamResponse, 'write', write_and_count)
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages', headers=await api.token(MEMBER_ID))
+		assert [page['title'] for page in await response.json()] == titles
+		# the batches of 2, 2, and 1, and the end, each written without holding a connection
+		assert in_use == [0, 0, 0, 0]
+
+async def test_page_listing_uses_the_bulk_pool(dsn):
+	async with serve_api(dsn, pools={'bulk': {'min_size': 0, 'max_size': 1}}) as api:
+		await api.create_page('Foo', 'first')
+		headers = await api.token(MEMBER_ID)
+		acquired = []
+		for workload, pool in api.bot.pool.pools.items():
+			async def acquire(timeout, call_site, *, workload=workload, _acquire=pool._acquire):
+				acquired.append(workload)
+				return await _acquire(timeout, call_site)
+			pool._acquire = acquire
+
+		assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers=headers)).status == 200
+		assert set(acquired) == {'interactive'}
+		acquired.clear()
+		assert (await api.client.get(f'/guilds/{GUILD_ID}/pages', headers=headers)).status == 200
+		assert set(acquired) == {'bulk'}
+
+async def test_token_is_required(dsn):
+	async with serve_api(dsn) as api:
+		await api.create_page('Foo', 'first')
+		assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo')).status == 401
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers={'Authorization': 'not a token'})
+		assert response.status == 401
+
+async def test_role_permissions(dsn):
+	async with serve_api(dsn) as api:
+		await api.create_page('Foo', 'first')
+		response = await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers=await api.token(DENIED_MEMBER_ID))
+		assert response.status == 403
+
+async def test_revision_not_modified_only_when_visible(dsn):
+	async with serve_api(dsn) as api:
+		await api.create_page('Foo', 'first')
+		revision_id = await api.bot.pool.fetchval('SELECT max(revision_id) FROM revisions')
+
+		async def get(user_id, revision_id):
+			headers = {**await api.token(user_id), 'If-None-Match': '*'}
+			return (await api.client.get(f'/guilds/{GUILD_ID}/revisions/{revision_id}', headers=headers)).status
+
+		assert await get(MEMBER_ID, revision_id) == 304
+		assert await get(MEMBER_ID, revision_id + 1) == 404
+		assert await get(DENIED_MEMBER_ID, revision_id) == 403
+
+async def test_revision_is_the_same_after_rename(dsn):
+	async with serve_api(dsn) as api:
+		await api.create_page('Foo', 'first')
+		revision_id = await api.bot.pool.fetchval('SELECT max(revision_id) FROM revisions')
+		headers = await api.token(MEMBER_ID)
+		url = f'/guilds/{GUILD_ID}/revisions/{revision_id}'
+		response = await api.client.get(url, headers=headers)
+		tag, revision = response.headers['ETag'], await response.json()
+
+		admin = await api.resolve_member(GUILD_ID, ADMIN_ID)
+		await api.bot.cogs['WikiDatabase'].rename_page(admin, 'Foo', 'Bar')
+		# so a cached copy is still right
+		response = await api.client.get(url, headers=headers)
+		assert response.headers['ETag'] == tag
+		assert await response.json() == revision
+
+def read_limits(**limits):
+	no_limits = {'user': None, 'guild': None, 'app': None}
+	return {'read': {**no_limits, **limits}, 'write': no_limits}
+
+async def test_only_expensive_reads_are_rate_limited(dsn):
+	async with serve_api(dsn, ratelimits=read_limits(user=(2, 3600))) as api:
+		await api.create_page('Foo', 'first')
+		headers = await api.token(MEMBER_ID)
+
+		for _ in range(3):
+			assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo', headers=headers)).status == 200
+		for status in 200, 200, 429:
+			assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo/revisions', headers=headers)).status == status
+
+async def test_apps_are_rate_limited(dsn):
+	async with serve_api(dsn, ratelimits=read_limits(app=(1, 3600))) as api:
+		await api.create_page('Foo', 'first')
+		headers = await api.token(MEMBER_ID)
+
+		for status in 200, 429:
+			assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo/revisions', headers=headers)).status == status
+		# a token for another app gets a bucket of its own
+		headers = await api.token(MEMBER_ID)
+		assert (await api.client.get(f'/guilds/{GUILD_ID}/pages/foo/revisions', headers=headers)).status == 200
@@ -0,0 +1,83 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+import types
+
+import pytest
+
+from cautious_memory.cogs.api import API
+
+USER_ID, APP_ID = 1, 2
+
+class StubPool:
+	"""Answers the secret hash query, running during_fetch while the query is in flight."""
+
+	def __init__(self, secret_hash):
+		self.secret_hash = secret_hash
+		self.during_fetch = None
+		self.fetches = 0
+
+	async def fetchval(self, query, *args):
+		self.fetches += 1
+		if self.during_fetch is not None:
+			await self.during_fetch()
+		return self.secret_hash
+
+def make_api(api_config=None):
+	bot = types.SimpleNamespace(
+		config={'api': {'token_hash_key': 'test key'} if api_config is None else api_config},
+		queries=lambda template_name: types.SimpleNamespace(get_secret_hash=lambda: 'get_secret_hash'),
+		home_pool=StubPool(b'hash'))
+	return API(bot)
+
+async def test_secret_hash_is_cached():
+	api = make_api()
+	assert await api.get_secret_hash(USER_ID, APP_ID) == b'hash'
+	assert await api.get_secret_hash(USER_ID, APP_ID) == b'hash'
+	assert api.bot.home_pool.fetches == 1
+
+async def test_revoke_during_lookup_is_not_cached():
+	api = make_api()
+	api.bot.home_pool.during_fetch = lambda: api.on_cm_api_token_revoke(USER_ID, APP_ID)
+	await api.get_secret_hash(USER_ID, APP_ID)
+	assert (USER_ID, APP_ID) not in api.token_cache
+
+	api.bot.home_pool.during_fetch = None
+	await api.get_secret_hash(USER_ID, APP_ID)
+	assert api.bot.home_pool.fetches == 2
+	assert (USER_ID, APP_ID) in api.token_cache
+
+@pytest.mark.parametrize('api_config', [{}, {'token_hash_key': ''}])
+def test_token_hash_key_is_required(api_config):
+	with pytest.raises(ValueError, match='token_hash_key'):
+		make_api(api_config)
+
+async def test_show_does_not_regenerate():
+	api = make_api()
+	assert api.api_token.get_command('show') is api.token_show
+	assert api.api_token.get_command('get') is api.token_show
+
+	async def regenerate_token(user_id, app_id):
+		raise AssertionError('the token was regenerated')
+
+	api.regenerate_token = regenerate_token
+	sent = []
+
+	async def send(content):
+		sent.append(content)
+
+	ctx = types.SimpleNamespace(prefix='cm/', send=send)
+	await api.token_show.callback(api, ctx)
+	assert sent and 'cm/api-token regenerate' in sent[0]
@@ -0,0 +1,150 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Guilds spread across the two test databases (see utils.databases)."""
+
+import asyncio
+
+import asyncpg
+
+from benchmarks.common import FakeGuild, FakeMember
+from cautious_memory.utils import databases, errors
+from cautious_memory.utils.databases import HOME, MAX_DATABASES, guild_scope, rendezvous
+
+from .common import make_bot
+
+SECOND = 'second'
+GUILD_IDS = range(1, 21)
+
+def two_database_bot(dsn, second_dsn):
+	databases.frozen_guilds.clear()
+	return make_bot({'dsn': dsn}, databases={SECOND: {'dsn': second_dsn}})
+
+async def create_page(bot, guild_id, title='Foo', content='first'):
+	member = FakeMember(1, FakeGuild(guild_id), admin=True)
+	with guild_scope(guild_id):
+		await bot.cogs['WikiDatabase'].create_page(member, title, content)
+	return member
+
+async def fetch(dsn, query, *args):
+	conn = await asyncpg.connect(dsn)
+	try:
+		return await conn.fetch(query, *args)
+	finally:
+		await conn.close()
+
+async def test_placement(dsn, second_dsn):
+	dsns = {HOME: dsn, SECOND: second_dsn}
+	async with two_database_bot(dsn, second_dsn) as bot:
+		for guild_id in GUILD_IDS:
+			await create_page(bot, guild_id)
+		directory = dict(bot.pool.directory)
+
+	assert directory == {guild_id: rendezvous(guild_id, dsns) for guild_id in GUILD_IDS}
+	assert set(directory.values()) == set(dsns)
+	for database, database_dsn in dsns.items():
+		rows = await fetch(database_dsn, 'SELECT guild_id FROM pages')
+		assert sorted(row['guild_id'] for row in rows) == [
+			guild_id for guild_id in GUILD_IDS if directory[guild_id] == database]
+
+	# the placements are kept in the home database, so other processes see the same ones
+	async with two_database_bot(dsn, second_dsn) as bot:
+		assert bot.pool.directory == directory
+
+async def test_id_residues(dsn, second_dsn):
+	async with two_database_bot(dsn, second_dsn) as bot:
+		for guild_id in GUILD_IDS:
+			await create_page(bot, guild_id)
+
+	residues = {row['name']: row['id_residue'] for row in await fetch(dsn, 'SELECT name, id_residue FROM databases')}
+	assert residues.keys() == {HOME, SECOND}
+	assert residues[HOME] != residues[SECOND]
+
+	for database, database_dsn in (HOME, dsn), (SECOND, second_dsn):
+		rows = await fetch(
+			database_dsn, 'SELECT page_id, revision_id, content_id FROM pages INNER JOIN revisions USING (page_id)')
+		assert rows
+		for row in rows:
+			assert {id % MAX_DATABASES for id in row.values()} == {residues[database]}
+
+async def test_move_during_writes(dsn, second_dsn):
+	guild_id = next(guild_id for guild_id in GUILD_IDS if rendezvous(guild_id, [HOME, SECOND]) == HOME)
+	async with two_database_bot(dsn, second_dsn) as bot:
+		db = bot.cogs['WikiDatabase']
+		member = await create_page(bot, guild_id)
+		page_id, first_revision_id = await bot.pool.home.fetchrow(
+			'SELECT page_id, latest_revision_id FROM pages WHERE guild_id = $1', guild_id)
+
+		moving = True
+		written = []
+		rejected = 0
+
+		async def write():
+			nonlocal rejected
+			with guild_scope(guild_id):
+				while moving:
+					try:
+						written.append((await db.revise_page(member, 'Foo', f'edit {len(written)}')).revision_id)
+					except errors.GuildMovingError:
+						rejected += 1
+						# reads still work while the guild is frozen
+						await db.get_page(member, 'Foo')
+					await asyncio.sleep(0.02)
+
+		writer = asyncio.create_task(write())
+		try:
+			await asyncio.sleep(0.1)
+			await bot.pool.move_guild(guild_id, SECOND, grace=0.5)
+		finally:
+			moving = False
+			await writer
+
+		assert written and rejected
+		assert bot.pool.directory[guild_id] == SECOND
+		assert guild_id not in databases.frozen_guilds
+		assert not await fetch(dsn, 'SELECT FROM pages WHERE guild_id = $1', guild_id)
+
+		# every edit that went through was moved with the same IDs, or made on the new database once it was done
+		revision_ids = {row['revision_id'] for row in await fetch(
+			second_dsn, 'SELECT revision_id FROM revisions WHERE page_id = $1', page_id)}
+		assert revision_ids == {first_revision_id, *written}
+
+		with guild_scope(guild_id):
+			revision = await db.revise_page(member, 'Foo', 'after the move')
+			assert (await db.get_page(member, 'Foo')).content == 'after the move'
+		residue = (await fetch(dsn, 'SELECT id_residue FROM databases WHERE name = $1', SECOND))[0]['id_residue']
+		assert revision.revision_id % MAX_DATABASES == residue
+
+async def test_other_guilds_are_writable_during_a_move(dsn, second_dsn, monkeypatch):
+	moved_id, other_id = [guild_id for guild_id in GUILD_IDS if rendezvous(guild_id, [HOME, SECOND]) == HOME][:2]
+	async with two_database_bot(dsn, second_dsn) as bot:
+		await create_page(bot, moved_id)
+		other = await create_page(bot, other_id)
+		edited_during_copy = []
+		copy_records_to_table = asyncpg.Connection.copy_records_to_table
+
+		async def copy_after_editing(self, *args, **kwargs):
+			if not edited_during_copy:
+				with guild_scope(other_id):
+					await asyncio.wait_for(bot.cogs['WikiDatabase'].revise_page(other, 'Foo', 'during the copy'), 2)
+				edited_during_copy.append(True)
+			return await copy_records_to_table(self, *args, **kwargs)
+
+		monkeypatch.setattr(asyncpg.Connection, 'copy_records_to_table', copy_after_editing)
+		await bot.pool.move_guild(moved_id, SECOND, grace=0)
+
+		assert edited_during_copy
+		with guild_scope(other_id):
+			assert (await bot.cogs['WikiDatabase'].get_page(other, 'Foo')).content == 'during the copy'
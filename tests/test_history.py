@@ -0,0 +1,58 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The history command, run without a connection to Discord."""
+
+import pytest
+
+from benchmarks.common import FakeGuild, FakeMember, StubChannel
+from benchmarks.load import StubContext
+from cautious_memory.utils import errors
+from cautious_memory.utils.paginator import KeysetPages
+
+from .common import make_bot
+
+NO_LIMITS = {'user': None, 'guild': None, 'app': None}
+
+@pytest.fixture
+def shown_pages(monkeypatch):
+	"""make paginators flip through every page as soon as they begin, and return the entries of each page shown"""
+	shown = []
+
+	async def begin(self):
+		for page in range(1, self.maximum_pages + 1):
+			await self.load_page(page)
+			shown.append(self.get_page(page))
+
+	monkeypatch.setattr(KeysetPages, 'begin', begin)
+	return shown
+
+async def test_paging_through_history_is_rate_limited_once(dsn, shown_pages):
+	ratelimits = {'read': {**NO_LIMITS, 'user': (2, 3600)}, 'write': NO_LIMITS}
+	async with make_bot({'dsn': dsn}, ratelimits=ratelimits) as bot:
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		db = bot.cogs['WikiDatabase']
+		await db.create_page(member, 'Foo', 'edit 0')
+		for i in range(1, 20):
+			await db.revise_page(member, 'Foo', f'edit {i}')
+
+		command = bot.get_command('history')
+		ctx = StubContext(bot, command, member, StubChannel(2, member.guild))
+		await ctx.invoke(command, title='Foo')
+		assert [len(entries) for entries in shown_pages] == [7, 7, 6]
+
+		await ctx.invoke(command, title='Foo')
+		with pytest.raises(errors.RateLimitedError):
+			await ctx.invoke(command, title='Foo')
@@ -0,0 +1,98 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Transactions that conflict with a concurrent one (see sql.retry_on_conflict),
+and wiki edits that lose the race to a concurrent edit on another connection.
+"""
+
+import contextlib
+
+import asyncpg
+import pytest
+
+from benchmarks.common import FakeGuild, FakeMember
+from cautious_memory.utils import errors, sql
+from cautious_memory.utils.diff import change_stats
+
+from .common import make_bot
+
+GUILD_ID = 1
+
+@contextlib.asynccontextmanager
+async def connect(dsn):
+	conn = await asyncpg.connect(dsn)
+	try:
+		yield conn
+	finally:
+		await conn.close()
+
+def conflicting(conflicts):
+	"""return a coroutine function that raises a serialization failure the first conflicts times it's called"""
+	calls = 0
+
+	async def transaction():
+		nonlocal calls
+		calls += 1
+		if calls <= conflicts:
+			raise asyncpg.SerializationError('could not serialize access due to concurrent update')
+		return calls
+
+	transaction.__qualname__ = f'conflicting_{conflicts}'
+	return transaction
+
+async def test_retried_after_conflicts():
+	stats = sql.retry_stats['conflicting_2']
+	retries, exhausted = stats.retries, stats.exhausted
+	transaction = sql.retry_on_conflict(attempts=3, base_delay=0.001)(conflicting(2))
+
+	assert await transaction() == 3
+	assert (stats.retries - retries, stats.exhausted - exhausted) == (2, 0)
+
+async def test_conflict_raised_after_every_attempt():
+	stats = sql.retry_stats['conflicting_3']
+	retries, exhausted = stats.retries, stats.exhausted
+	transaction = sql.retry_on_conflict(attempts=3, base_delay=0.001)(conflicting(3))
+
+	with pytest.raises(asyncpg.SerializationError):
+		await transaction()
+	assert (stats.retries - retries, stats.exhausted - exhausted) == (2, 1)
+
+async def test_revise_gives_up_after_losing_every_race(dsn):
+	async with make_bot({'dsn': dsn}) as bot, connect(dsn) as conn:
+		db = bot.cogs['WikiDatabase']
+		member = FakeMember(1, FakeGuild(GUILD_ID), admin=True)
+		await db.create_page(member, 'Foo', 'first')
+		page_id = await bot.pool.fetchval('SELECT page_id FROM pages')
+
+		run = bot.workers.run
+		competing_edits = 0
+
+		async def run_after_competing_edit(func, *args, **kwargs):
+			# while revise_page works out its edit, another one goes in on top of the revision it read
+			nonlocal competing_edits
+			if func is change_stats:
+				competing_edits += 1
+				latest_revision_id = await conn.fetchval('SELECT latest_revision_id FROM pages')
+				await conn.execute(
+					'SELECT * FROM revise_page($1, $2, $3, 0, 0, 0, 0, $4)',
+					2, page_id, f'competing edit {competing_edits}', latest_revision_id)
+			return await run(func, *args, **kwargs)
+
+		bot.workers.run = run_after_competing_edit
+		with pytest.raises(errors.EditContentionError):
+			await db.revise_page(member, 'Foo', 'mine')
+
+		assert competing_edits == sql.CONFLICT_ATTEMPTS
+		assert (await db.get_page(member, 'Foo')).content == f'competing edit {competing_edits}'
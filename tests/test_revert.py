@@ -0,0 +1,53 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The revert command, run without a connection to Discord."""
+
+from benchmarks.common import FakeGuild, FakeMember, StubChannel
+from benchmarks.load import StubContext
+from cautious_memory.utils.diff import change_stats
+
+from .common import make_bot
+
+async def test_revert_keeps_an_edit_made_meanwhile(dsn):
+	async with make_bot({'dsn': dsn}) as bot:
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		db = bot.cogs['WikiDatabase']
+		await db.create_page(member, 'Foo', 'first line\nsecond line\nthird line')
+		first_revision_id = await bot.pool.fetchval('SELECT latest_revision_id FROM pages')
+		await db.revise_page(member, 'Foo', 'first line\nvandalized\nthird line')
+
+		run = bot.workers.run
+		competing_edits = 0
+
+		async def run_after_competing_edit(func, *args, **kwargs):
+			# someone fixes another line while the revert is being written
+			nonlocal competing_edits
+			if func is change_stats and not competing_edits:
+				competing_edits += 1
+				async with bot.pool.acquire() as conn:
+					page_id, latest_revision_id = await conn.fetchrow('SELECT page_id, latest_revision_id FROM pages')
+					await conn.execute(
+						'SELECT * FROM revise_page($1, $2, $3, 0, 0, 0, 0, $4)',
+						2, page_id, 'first line\nvandalized\nlast line', latest_revision_id)
+			return await run(func, *args, **kwargs)
+
+		bot.workers.run = run_after_competing_edit
+		command = bot.get_command('revert')
+		ctx = StubContext(bot, command, member, StubChannel(2, member.guild))
+		await ctx.invoke(command, 'Foo', first_revision_id)
+
+		assert competing_edits == 1
+		assert (await db.get_page(member, 'Foo')).content == 'first line\nsecond line\nlast line'
@@ -0,0 +1,41 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The stats command, run without a connection to Discord."""
+
+from benchmarks.common import FakeGuild, FakeMember, StubChannel
+from benchmarks.load import StubContext
+
+from .common import make_bot
+
+async def test_page_stats_hold_one_connection_at_a_time(dsn):
+	async with make_bot({'dsn': dsn}, pools={'analytics': {'min_size': 0, 'max_size': 1}}) as bot:
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		await bot.cogs['WikiDatabase'].create_page(member, 'Foo', 'first')
+
+		interactive, analytics = bot.pool.pools['interactive'], bot.pool.pools['analytics']
+		held_during_stats = []
+		acquire = analytics._acquire
+
+		async def acquire_for_stats(timeout, call_site):
+			held_during_stats.append(interactive.in_use())
+			return await acquire(timeout, call_site)
+
+		analytics._acquire = acquire_for_stats
+		command = bot.get_command('stats')
+		ctx = StubContext(bot, command, member, StubChannel(2, member.guild))
+		await ctx.invoke(command, title='Foo')
+		# top editors, revision count and page uses
+		assert held_during_stats == [0, 0, 0]
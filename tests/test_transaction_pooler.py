@@ -0,0 +1,98 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Running behind a transaction mode pooler (the transaction_pooler database option).
+
+Skipped unless CM_TEST_PGBOUNCER_DSN is set to the URL of CM_TEST_DSN's database through PgBouncer
+with pool_mode = transaction. The bot connects through PgBouncer, and directly to CM_TEST_DSN where it has to.
+"""
+
+import asyncio
+
+import asyncpg
+import pytest
+
+from benchmarks.common import FakeGuild, FakeMember
+from cautious_memory.utils import sql
+
+from .common import make_bot
+
+# the connections made with the direct config can be told apart by this
+DIRECT_APPLICATION_NAME = 'cm tests direct'
+
+def pooled_bot(dsn, pgbouncer_dsn):
+	return make_bot({
+		'dsn': pgbouncer_dsn,
+		'transaction_pooler': True,
+		'direct': {'dsn': dsn, 'server_settings': {'application_name': DIRECT_APPLICATION_NAME}},
+	})
+
+@pytest.fixture
+def no_cursors(monkeypatch):
+	"""make opening a cursor fail, since a cursor's transaction would hold a server connection"""
+	def cursor_connection(query, connection):
+		raise AssertionError(f'opened a cursor for {query.name}')
+
+	monkeypatch.setattr(sql.replica_router, 'cursor_connection', cursor_connection)
+
+async def test_get_all_pages_in_batches(dsn, pgbouncer_dsn, no_cursors):
+	async with pooled_bot(dsn, pgbouncer_dsn) as bot:
+		db = bot.cogs['WikiDatabase']
+		db.KEYSET_BATCH_SIZE = 3
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		for title in 'b', 'A', 'c', 'D', 'e', 'F', 'g':
+			await db.create_page(member, title, 'content')
+		await db.alias_page(member, 'a2', 'A')
+
+		stats = sql.query_stats['wiki.get_all_pages']
+		calls = stats.calls
+		assert [page.title async for page in db.get_all_pages(member)] == ['A', 'a2', 'b', 'c', 'D', 'e', 'F', 'g']
+		assert stats.calls - calls == 3
+
+async def test_history_without_a_cursor(dsn, pgbouncer_dsn, no_cursors):
+	async with pooled_bot(dsn, pgbouncer_dsn) as bot:
+		db = bot.cogs['WikiDatabase']
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		await db.create_page(member, 'Foo', 'first')
+		revision_ids = [(await db.revise_page(member, 'Foo', f'edit {i}')).revision_id for i in range(3)]
+
+		history = [revision.revision_id async for revision in db.get_page_history(member, 'Foo')]
+		assert history[:3] == revision_ids[::-1]
+		assert len(history) == 4
+
+async def test_listen_and_leader_election_connect_directly(dsn, pgbouncer_dsn):
+	async with pooled_bot(dsn, pgbouncer_dsn) as bot:
+		for _ in range(50):
+			if bot.leader_election.conn is not None:
+				break
+			await asyncio.sleep(0.1)
+
+		conn = await asyncpg.connect(dsn)
+		try:
+			backends = {
+				row['pid']: row['application_name']
+				for row in await conn.fetch('SELECT pid, application_name FROM pg_stat_activity')}
+		finally:
+			await conn.close()
+
+		# through PgBouncer, these would be PgBouncer's made up process IDs
+		for listener_conn in bot.listener_conns:
+			assert backends.get(listener_conn.get_server_pid()) == DIRECT_APPLICATION_NAME
+		assert backends.get(bot.leader_election.conn.get_server_pid()) == bot.leader_election.identity
+
+		# and notifications of edits made through PgBouncer reach the listener
+		edit = asyncio.ensure_future(bot.wait_for('cm_page_edit', timeout=5))
+		await bot.cogs['WikiDatabase'].create_page(FakeMember(1, FakeGuild(1), admin=True), 'Foo', 'first')
+		assert await edit == await bot.pool.fetchval('SELECT latest_revision_id FROM pages')
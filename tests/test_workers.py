@@ -0,0 +1,58 @@
+# Copyright © 2020 lambda#0987
+#
+# Cautious Memory is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cautious Memory is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Cautious Memory.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Which work utils.workers.WorkerPool sends to its processes with the default thresholds."""
+
+from benchmarks.common import FakeGuild, FakeMember
+from cautious_memory.utils import text
+from cautious_memory.utils.diff import change_stats
+
+from .common import make_bot
+
+# about as long as the wiki commands allow a page to be
+PAGE = '\n'.join(f'{i}. Step {i} of the guide: check the settings, then restart the bot.' for i in range(1, 26))
+
+def count_submissions(workers):
+	"""return a list that the names of the functions sent to workers are appended to"""
+	submitted = []
+	submit = workers.executor.submit
+
+	def counting_submit(func, *args, **kwargs):
+		submitted.append(func.func.__name__)
+		return submit(func, *args, **kwargs)
+
+	workers.executor.submit = counting_submit
+	return submitted
+
+async def test_page_edit_is_diffed_in_a_worker(dsn):
+	async with make_bot({'dsn': dsn}) as bot:
+		db = bot.cogs['WikiDatabase']
+		member = FakeMember(1, FakeGuild(1), admin=True)
+		await db.create_page(member, 'Guide', PAGE)
+		submitted = count_submissions(bot.workers)
+
+		new_content = PAGE.replace('restart the bot', 'reload the cog', 3)
+		revision = await db.revise_page(member, 'Guide', new_content)
+		assert submitted == ['change_stats']
+		stats = await bot.pool.fetchrow(
+			'SELECT chars_added, chars_removed, lines_added, lines_removed FROM revisions WHERE revision_id = $1',
+			revision.revision_id)
+		assert tuple(stats) == change_stats(PAGE, new_content)
+
+		# small edits and escaping stay inline
+		await db.create_page(member, 'Short', 'short page')
+		await db.revise_page(member, 'Short', 'a short page')
+		await bot.workers.run(text.escape_raw, PAGE, size=len(PAGE))
+		assert submitted == ['change_stats']